@@ -0,0 +1,87 @@
+'''
+Micro-benchmark of the per-sample reductions used by DPL builtins.
+
+Compares the previous pure Python loops against the NumPy reductions they were replaced with,
+on a series of 1M samples:
+
+    python benchmarks/builtins.py
+'''
+
+import math
+import time
+from datetime import timedelta
+
+import numpy as np
+
+from dplib import Series, DPL
+
+SAMPLES = 1000000
+
+def rms_loop(series):
+    data = series.array
+    ret = 0
+    i = 0
+    size = len(data)
+
+    while(i < size):
+        x = data[i]
+        ret = ret + x * x
+        i = i + 1
+
+    return math.sqrt(ret/size)
+
+def min_loop(series):
+    local_min = None
+    for x in series:
+        if local_min is None:
+            local_min = x
+        else:
+            local_min = min(x, local_min)
+    return local_min
+
+def max_loop(series):
+    local_max = None
+    for x in series:
+        if local_max is None:
+            local_max = x
+        else:
+            local_max = max(x, local_max)
+    return local_max
+
+def measure(f, repeat=3):
+    '''
+    Returns the best time (in seconds) of calling `f` `repeat` times.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def report(name, before, after):
+    print(f'{name:<8} before: {before * 1e9 / SAMPLES:8.2f} ns/sample   '
+          f'after: {after * 1e9 / SAMPLES:8.2f} ns/sample   '
+          f'speedup: {before / after:8.1f}x')
+
+def main():
+    times = np.datetime64('2020-01-01') + np.arange(SAMPLES) * np.timedelta64(100, 'us')
+    series = Series(np.random.default_rng(0).normal(size=SAMPLES), times)
+    windowed = series.window(timedelta(seconds=1))
+
+    report('rms',
+           measure(lambda: rms_loop(series.series)),
+           measure(lambda: DPL.eval('rms(window(A, "100s"))', { 'A': series })))
+    report('min',
+           measure(lambda: min_loop(series)),
+           measure(lambda: series.min_aggregation()))
+    report('max',
+           measure(lambda: max_loop(series)),
+           measure(lambda: series.max_aggregation()))
+    report('rms/1s',
+           measure(lambda: [rms_loop(window) for window in windowed]),
+           measure(lambda: DPL.eval('rms(window(A, "1s"))', { 'A': series })))
+
+if __name__ == '__main__':
+    main()
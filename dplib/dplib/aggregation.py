@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 
 class Aggregation:
@@ -445,8 +447,9 @@ class CumSumAggregation(Aggregation):
     name = 'cumsum'
     def merge(self, other):
         cumsum = other.series.series + self.value
-        other.series.series = cumsum
-        return CumSumAggregation(other.series, cumsum[-1])
+        series = copy.copy(other.series)
+        series.series = cumsum
+        return CumSumAggregation(series, cumsum[-1])
 
 class ValuesAggregation(Aggregation):
     name = 'values'
@@ -1,6 +1,7 @@
 from .result import Result
 from .exceptions import CyclicGraphException
 from .graph import Graph
+from .plan import Plan
 
 import pandas as pd
 
@@ -17,10 +18,12 @@ class BatchProcess:
         '''
         self.kpis = {}
         self.graph = Graph()
+        self._clear_plan()
 
     def add(self, name, kpi, mapping=None):
         mapping = {} if mapping is None else mapping
         self.kpis[name] = BatchProcessKPI(name, kpi, mapping)
+        self._clear_plan()
         return self
 
     def prune(self, *kpi_names):
@@ -30,6 +33,7 @@ class BatchProcess:
         for kpi_name in bp.graph.vertices:
             bp.kpis[kpi_name] = self.kpis[kpi_name]
         self.graph = Graph()
+        self._clear_plan()
         return bp
 
     def get_required_inputs(self):
@@ -81,31 +85,81 @@ class BatchProcess:
         except CyclicGraphException:
             raise CyclicGraphException('Batch Processes cannot contain recursive KPI computations.')
 
-    def run(self, dataset, parameters=[], previous_result=None, additional_builtins=None):
+    def _get_levels(self):
+        try:
+            return self.graph.get_levels()
+        except CyclicGraphException:
+            raise CyclicGraphException('Batch Processes cannot contain recursive KPI computations.')
+
+    def run(self, dataset, parameters=[], previous_result=None, additional_builtins=None, executor=None):
         '''
         Runs the batch process on the entire DataFrame (without reporting progress, one column at a time)
+
+        :param executor: a :class:`concurrent.futures.ThreadPoolExecutor` to compute the KPIs
+            that don't depend on each other at the same time (if None, KPIs are computed one at a time)
         '''
-        # Topological sort the KPIs to process KPIs with no dependencies first.
-        self._connect_graph()
-        order = self._get_topological_ordering()
+        plan = self._get_plan()
+        if executor is None:
+            # Topological sort the KPIs to process KPIs with no dependencies first.
+            if self._ordering is None:
+                self._ordering = [[kpi_name] for kpi_name in self._get_topological_ordering()]
+            levels = self._ordering
+        else:
+            # Group the KPIs into levels of KPIs that only depend on KPIs in earlier levels.
+            if self._levels is None:
+                self._levels = self._get_levels()
+            levels = self._levels
+        # The shared expressions of the last run were computed from its dataset.
+        plan.reset()
 
         input = Result(dataset)
         result = Result()
 
-        # Compute each KPI in order, adding them to the DataFrame
-        for kpi_name in order:
-            bpkpi = self.kpis[kpi_name]
-            kpi = bpkpi.kpi
-            mapping = bpkpi.mapping
-            kpi_result = kpi.run(kpi_name, input.merge(result), mapping,
-                                 parameters=parameters,
-                                 previous_result=previous_result,
-                                 additional_builtins=additional_builtins)
-            result = kpi_result.merge(result)
+        def run_kpi(kpi_name, level_input):
+            kpi = plan.kpis[kpi_name]
+            mapping = self.kpis[kpi_name].mapping
+            return kpi.run(kpi_name, level_input, mapping,
+                           parameters=parameters,
+                           previous_result=previous_result,
+                           additional_builtins=additional_builtins)
+
+        # Compute each level in order, adding them to the DataFrame
+        for level in levels:
+            level_input = input.merge(result)
+            if executor is None or len(level) == 1:
+                kpi_results = [run_kpi(kpi_name, level_input) for kpi_name in level]
+            else:
+                futures = [executor.submit(run_kpi, kpi_name, level_input) for kpi_name in level]
+                kpi_results = [future.result() for future in futures]
+            # Merge in the order of the level (not the order the KPIs finished in)
+            for kpi_result in kpi_results:
+                result = kpi_result.merge(result)
         if previous_result:
             result = previous_result.merge(result)
         return result
 
+    def plan(self):
+        '''
+        Creates a :class:`Plan` which evaluates common subexpressions of all KPIs once,
+        and folds constant arithmetic ahead of time.
+        '''
+        return Plan(self.kpis)
+
+    def _get_plan(self):
+        '''
+        Plans the KPIs together (so that expressions shared by many KPIs are only computed once) on the first run.
+        The plan (and the KPIs it compiled) is reused by every run after that, until KPIs are added.
+        '''
+        if self._plan is None:
+            self._connect_graph()
+            self._plan = self.plan()
+        return self._plan
+
+    def _clear_plan(self):
+        self._plan = None
+        self._ordering = None
+        self._levels = None
+
     def _get_windows(self, mappings={}):
         '''
         Gets all the windows in the KPIs (the times in "window(x, time)")
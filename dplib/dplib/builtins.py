@@ -1,14 +1,17 @@
 from .decorators import make_builtin_decorator
 
-from .series import Series
+from .series import Series, WindowedSeries
 from .aggregation import Aggregation, ValuesAggregation, AbsAggregation, \
     CumSumAggregation, IfAggregation, TableAggregation, \
     MinAggregation, MaxAggregation, AverageAggregation, \
     GreaterThanAggregation, LessThanAggregation
 
-import numpy as np
+import copy
 import math
 
+import numpy as np
+import pandas as pd
+
 BUILTINS = {}
 builtin = make_builtin_decorator(BUILTINS)
 
@@ -51,6 +54,8 @@ def window(series, duration):
 @builtin()
 def abs(obj):
     if isinstance(obj, Series):
+        # Copy, because `obj` may be shared with other expressions.
+        obj = copy.copy(obj)
         obj.series = np.abs(obj.series)
     else: # Assume its an aggregation
         return AbsAggregation(obj.series, obj)
@@ -130,7 +135,53 @@ def _or(series1, series2):
     else:
         return series1 or series2
 
-@builtin(aggregate=True)
+def fft_magnitudes(windows):
+    '''
+    Returns the magnitude of the full FFT of each row in `windows`, computed with one real FFT.
+    The magnitudes past the Nyquist frequency are mirrored from the real FFT.
+    '''
+    L = windows.shape[1]
+    vf = np.abs(np.fft.rfft(windows, axis=1))
+    k = np.arange(L)
+    return vf[:, np.minimum(k, L - k)]
+
+def thd_windows(windows, periods, base_harmonic=None):
+    '''
+    Computes `thd` for every row of `windows` at once (NaN where `thd` would return None).
+    '''
+    count, L = windows.shape
+    results = np.full(count, np.nan)
+    if L < 2:
+        return results
+
+    fft_vals = fft_magnitudes(windows)
+    rows = np.arange(count)
+
+    if base_harmonic:
+        sample_rates = 1 / periods
+        seconds_of_data = L / sample_rates
+        harmonics = np.where(seconds_of_data > 0, np.trunc(seconds_of_data * base_harmonic), base_harmonic).astype(int)
+    else:
+        # The first peak (argmax returns the first occurrence of the maximum)
+        harmonics = np.argmax(fft_vals[:, :int(L/2)], axis=1) if int(L/2) > 0 else np.zeros(count, dtype=int)
+    fund_freqs = fft_vals[rows, harmonics]
+    valid = (fund_freqs != 0) & (harmonics != 0)
+
+    # Windows with the same base harmonic have the same harmonic segments, so they are searched together.
+    for base in np.unique(harmonics[valid]):
+        base_rows = rows[valid & (harmonics == base)]
+        offset = int(base/2)
+        multiples = np.arange(2*base, (L + 1) // 2, base)
+        if offset == 0 or len(multiples) == 0:
+            sums = np.zeros(len(base_rows))
+        else:
+            segments = multiples[:, None] + np.arange(-offset, offset)
+            peaks = fft_vals[base_rows][:, segments].max(axis=2)
+            sums = np.cumsum(peaks * peaks, axis=1)[:, -1]
+        results[base_rows] = 100 * (np.sqrt(sums) / fund_freqs[base_rows])
+    return results
+
+@builtin(aggregate=True, batch=thd_windows)
 def thd(series, base_harmonic=None):
     # At least two values are needed to determine sampling rate.
     # Even more than this are needed to do an FFT as well, but
@@ -176,7 +227,40 @@ def thd(series, base_harmonic=None):
     square_sum = np.sqrt(sum)
     return 100 * (square_sum / fund_freq)
 
-@builtin('thd2', aggregate=True)
+def thd2_windows(windows, periods, base_harmonic, fs):
+    '''
+    Computes `thd2` for every row of `windows` at once.
+    '''
+    if base_harmonic <= 0:
+        return [thd2(pd.Series(window), base_harmonic, fs) for window in windows]
+    count, L = windows.shape
+    n = int(2 ** (np.ceil(np.log2(L)) + 1))
+    vf = np.abs(np.fft.rfft(windows, n, axis=1))
+    f = fs * np.arange(0, (n / 2) + 1) / n
+    rows = np.arange(count)
+    fund_ind = np.argmax(vf[:, 1:], axis=1) + 1
+    f_fund = f[fund_ind]
+    p_fund = vf[rows, fund_ind]
+
+    # The harmonic frequencies are accumulated the same way as in `thd2` (one addition at a time).
+    num_harmonics = int(f[-1] / base_harmonic) + 2
+    steps = np.full((count, num_harmonics), float(base_harmonic))
+    steps[:, 0] = f_fund + base_harmonic
+    f_hrm = np.cumsum(steps, axis=1)
+    searched = f_hrm < f[-1] - base_harmonic
+
+    # Look for the harmonic bin around each true harmonic.
+    width = 1.3 * fs / n
+    lo = np.searchsorted(f, f_hrm - width, side='left')
+    hi = np.searchsorted(f, f_hrm + width, side='right')
+    bins = lo[:, :, None] + np.arange(max(int((hi - lo).max()), 1))
+    in_range = bins < hi[:, :, None]
+    powers = np.where(in_range, vf[rows[:, None, None], np.minimum(bins, len(f) - 1)], -np.inf).max(axis=2)
+    powers = np.where(searched, powers, 0)
+    v_rms_harmonics = np.cumsum(powers ** 2, axis=1)[:, -1]
+    return 100 * np.sqrt(v_rms_harmonics) / p_fund
+
+@builtin('thd2', aggregate=True, batch=thd2_windows)
 def thd2(series, base_harmonic, fs):
     L = len(series)
 
@@ -206,31 +290,40 @@ def thd2(series, base_harmonic, fs):
     return 100 * np.sqrt(v_rms_harmonics) / p_fund
 
 
-@builtin('rms', aggregate=True)
-def rms(series):
-    data = series.array
-    ret = 0
-    i = 0
-    size = len(data)
-
-    while(i < size):
-        x = data[i]
-        ret = ret + x * x
-        i = i + 1
+def rms_windows(windows, periods):
+    '''
+    Computes `rms` for every row of `windows` at once.
+    '''
+    windows = windows.astype('float64')
+    return np.sqrt(np.nanmean(windows * windows, axis=1))
 
-    return math.sqrt(ret/size)
+@builtin('rms', aggregate=True, batch=rms_windows)
+def rms(series):
+    data = series.to_numpy(dtype='float64')
+    data = data[~np.isnan(data)]
+    if len(data) == 0:
+        return None
+    return math.sqrt(np.dot(data, data) / len(data))
 
 @builtin('analyze_freqs')
 def analyze_freqs(series, num_harm=None, base_harmonic=None):
     agg = None
-    for series in series.series:
+    # The FFTs of windows with the same length are computed together.
+    spectra = {}
+    if isinstance(series, WindowedSeries) and series.is_numeric():
+        rows, windows = series.get_uniform_windows()
+        spectra = dict(zip(rows, np.abs(np.fft.rfft(windows, axis=1))))
+    for i, series in enumerate(series.series):
         L = len(series)
         if L < 2:
             return None
 
         fs = 1 / (series.index[1] - series.index[0]).total_seconds()
 
-        vf = np.abs(np.fft.fft(series, L))
+        if i in spectra:
+            vf = spectra[i]
+        else:
+            vf = np.abs(np.fft.fft(series, L))
         f = fs * np.arange(0, (L / 2) + 1) / L
         vf = vf[:L // 2 + 1]
         fund_ind = np.argmax(vf[1:])
@@ -19,10 +19,12 @@ class Component:
         self.parameters = parameters
         self.kpis = {}
         self.bp = BatchProcess()
+        self.pruned_bps = {}
 
     def add(self, name, kpi_string, id=None, doc=None):
         id = id if id is not None else name
         self.kpis[name] = ComponentKPI(name, kpi_string, id, doc)
+        self.pruned_bps = {}
         return self
 
     def _validate_kpi_names(self, kpi_names):
@@ -43,6 +45,19 @@ class Component:
         bp = bp.prune(*kpi_ids)
         return bp
 
+    def get_pruned_bp(self, kpi_names, mappings={}):
+        '''
+        Gets the pruned batch process of the KPIs for the mappings, which is only made (and planned) once,
+        so that running the same KPIs on many windows doesn't plan and compile them for every window.
+        '''
+        try:
+            key = (tuple(kpi_names), frozenset(mappings.items()))
+        except TypeError: # Mapped to something that can't be hashed
+            return self.make_pruned_bp(kpi_names, mappings)
+        if key not in self.pruned_bps:
+            self.pruned_bps[key] = self.make_pruned_bp(kpi_names, mappings)
+        return self.pruned_bps[key]
+
     def get_required_inputs(self, kpi_names, mappings={}):
         bp = self.make_pruned_bp(kpi_names, mappings)
         return bp.get_required_inputs()
@@ -62,7 +77,7 @@ class Component:
             kpi_names = [kpi_names]
 
         self._validate_kpi_names(kpi_names)
-        bp = self.make_pruned_bp(kpi_names, mapping)
+        bp = self.get_pruned_bp(kpi_names, mapping)
 
         result = bp.run(Dataset.lift(dataset),
                         parameters=self.parameters,
@@ -1,7 +1,14 @@
 from .series import Series
 
 def make_builtin_decorator(env):
-    def builtin(name=None, aggregate=False):
+    '''
+    Creates a decorator which registers builtin functions into `env`.
+
+    Builtins which `aggregate` are called once per window of a windowed series. They may also
+    provide a `batch` function, which is called once with all windows of the same length (as a 2-D
+    array with one row per window, and the sample period of each row) and returns one value per row.
+    '''
+    def builtin(name=None, aggregate=False, batch=None):
         def decorator(f):
             def wrapper(*args, **kwargs):
                 if kwargs:
@@ -11,7 +18,11 @@ def make_builtin_decorator(env):
                     if isinstance(args[0], Series):
                         def perform_f(series):
                             return f(series, *args[1:])
-                        return args[0].aggregate(perform_f)
+                        perform_batch = None
+                        if batch is not None:
+                            def perform_batch(windows, periods):
+                                return batch(windows, periods, *args[1:])
+                        return args[0].aggregate(perform_f, perform_batch)
                     else:
                         raise Exception('Builtin asked to aggregate, but was given non-series argument.')
                 return f(*args)
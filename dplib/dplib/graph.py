@@ -96,3 +96,29 @@ class Graph:
             raise CyclicGraphException('Topological ordering failed because graph has at least one cycle.')
 
         return L
+
+    def get_levels(self):
+        '''
+        Groups the vertices into levels, where each vertex only depends on vertices in earlier levels
+        (so the vertices in one level are independent of each other).
+        Vertices are sorted within each level so that the order is always the same.
+        '''
+        levels = []
+        remaining = { vertex: len(self.edges_in[vertex]) for vertex in self.vertices }
+        level = [vertex for vertex, count in remaining.items() if count == 0]
+        while level:
+            level.sort(key=str)
+            levels.append(level)
+            next_level = []
+            for u in level:
+                del remaining[u]
+                for v in self.edges_out[u]:
+                    remaining[v] -= 1
+                    if remaining[v] == 0:
+                        next_level.append(v)
+            level = next_level
+
+        if remaining:
+            raise CyclicGraphException('Level ordering failed because graph has at least one cycle.')
+
+        return levels
@@ -73,23 +73,25 @@ class MiniPy:
         self.string_transformers.append(string_transformer)
 
 class Expression:
+    _reader = None
+
     def compile(self):
         '''
-        Compiles an AST of Readers, Operators, and Windows into a single Reader
-        '''
-        raise Exception('compile() not implemented.')
+        Compiles the expression into a Reader (a Python function of an environment).
 
-    @staticmethod
-    def compile(x):
+        The expression is lowered into a single Python function the first time it is compiled,
+        and the same Reader is returned every time after that.
         '''
-        Compiles the given value x into a Reader (a Python function)
+        if self._reader is None:
+            self._reader = Reader(Compiler().compile(self))
+        return self._reader
 
-        If the value is a MiniPy Expression, it compiles the expression to a Reader.
-        Otherwise, just return the value as it is already compiled.
+    def lower(self, compiler):
+        '''
+        Emits the statements which compute this expression into `compiler`, and
+        returns the Python expression (a variable or a constant) which holds its value.
         '''
-        if isinstance(x, Expression):
-            return x.compile()
-        return x
+        raise Exception('lower() not implemented.')
 
     def get_identifiers(self):
         '''
@@ -109,8 +111,8 @@ class Identifier(Expression):
         self.name = name.upper() # The case insensitive name
         self.original_name = name # The case sensitive name
 
-    def compile(self):
-        return Reader(lambda env: env.lookup(self.name))
+    def lower(self, compiler):
+        return compiler.emit(f'lookup({self.name!r})')
 
     def get_identifiers(self):
         return [self]
@@ -122,8 +124,8 @@ class Constant(Expression):
     def __init__(self, x):
         self.x = x
 
-    def compile(self):
-        return Reader(lambda env: self.x)
+    def lower(self, compiler):
+        return compiler.add('K', self.x)
 
 class SExpr(Expression):
     '''
@@ -134,14 +136,12 @@ class SExpr(Expression):
         self.exprs = exprs
         self.builtins = builtins
 
-    def compile(self):
-        values = list(map(Expression.compile, self.exprs))
-        def get_value(env):
-            f = self.builtins[self.name.upper()]
-            xs = list(map(lambda value: value.run(env), values))
-            return f(*xs)
-
-        return Reader(get_value)
+    def lower(self, compiler):
+        # Builtins are looked up when the function is called (not when it is compiled),
+        # so that they can be overridden after compiling.
+        args = [expr.lower(compiler) for expr in self.exprs]
+        builtins = compiler.add('B', self.builtins)
+        return compiler.emit(f'{builtins}[{self.name!r}]({", ".join(args)})')
 
     def get_identifiers(self):
         return flatten(list(map(lambda x: x.get_identifiers(), self.exprs)))
@@ -154,11 +154,50 @@ class FExpr(SExpr):
     Function application without evaluating arguments first.
     Passes in environment and unevaluated arguments.
     '''
-    def compile(self):
-        def get_value(env):
-            f = self.builtins[self.name.upper()]
-            return f(*self.exprs, env)
-        return Reader(get_value)
+    def lower(self, compiler):
+        args = [compiler.add('N', expr) for expr in self.exprs]
+        builtins = compiler.add('B', self.builtins)
+        return compiler.emit(f'{builtins}[{self.name!r}]({", ".join(args)}, env)')
+
+class Compiler:
+    '''
+    Lowers a MiniPy AST into one flat Python function which takes an Environment.
+
+    Each expression becomes one assignment to a local variable, so evaluating a program is a
+    sequence of builtin calls with no per-node overhead. The generated source only refers to
+    identifier and builtin names (as string literals), and to constants, nodes and builtin
+    dictionaries by their position in lists owned by the compiler. No text from the program is
+    ever executed, so this is exactly as safe as evaluating the AST.
+    '''
+    def __init__(self):
+        self.lines = []
+        self.scope = { 'K': [], 'N': [], 'B': [] }
+
+    def add(self, kind, x):
+        '''
+        Adds `x` to the list `kind` (K for constants, N for nodes, B for builtins) and returns how to refer to it.
+        '''
+        xs = self.scope[kind]
+        for i, y in enumerate(xs):
+            if y is x:
+                return f'{kind}[{i}]'
+        xs.append(x)
+        return f'{kind}[{len(xs) - 1}]'
+
+    def emit(self, expression):
+        name = f'v{len(self.lines)}'
+        self.lines.append(f'    {name} = {expression}')
+        return name
+
+    def compile(self, expr):
+        result = expr.lower(self)
+        source = '\n'.join(['def program(env):',
+                            '    lookup = env.lookup'] +
+                           self.lines +
+                           [f'    return {result}'])
+        scope = dict(self.scope, __builtins__={})
+        exec(compile(source, '<minipy>', 'exec'), scope)
+        return scope['program']
 
 class Reader:
     def __init__(self, f):
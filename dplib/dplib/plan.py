@@ -0,0 +1,163 @@
+import copy
+import numbers
+import threading
+from datetime import timedelta
+
+from .minipy import Expression, Identifier, Constant, SExpr, FExpr
+
+FOLDABLE = {'+', '-', '*', '/', '//', '>', '<', '>=', '<=', '==', '!=', 'USUB'}
+'''
+Builtins which are evaluated ahead of time when all of their arguments are constant numbers (or times).
+'''
+
+class Shared(Expression):
+    '''
+    An expression which appears more than once in a batch process.
+    It is evaluated the first time it is needed, and the value is reused after that.
+    KPIs may be run on many threads at once, so only one thread evaluates it (the others wait for the value).
+    '''
+    def __init__(self, key, expr, memo, locks):
+        self.key = key
+        self.expr = expr
+        self.memo = memo
+        self.locks = locks
+
+    def evaluate(self, env):
+        if self.key not in self.memo:
+            with self.locks.setdefault(self.key, threading.Lock()):
+                if self.key not in self.memo:
+                    self.memo[self.key] = self.expr.compile().run(env)
+        return self.memo[self.key]
+
+    def lower(self, compiler):
+        return compiler.emit(f'{compiler.add("N", self)}.evaluate(env)')
+
+    def get_identifiers(self):
+        return self.expr.get_identifiers()
+
+    def get_sexprs(self):
+        return self.expr.get_sexprs()
+
+class PlannedExpr:
+    '''
+    An expression (after constant folding), and the number which identifies its structure.
+    Two expressions with the same number compute the same value.
+    '''
+    def __init__(self, expr, key, children=None):
+        self.expr = expr
+        self.key = key
+        self.children = [] if children is None else children
+
+class Plan:
+    '''
+    A plan for evaluating the KPIs of a batch process together.
+
+    Every KPI's AST is hash-consed: each distinct subtree (taking into account what its identifiers are mapped to)
+    is given one number. Subtrees that appear more than once (across all KPIs) are evaluated once per batch.
+    Arithmetic on constants (including parameters) is folded ahead of time.
+    '''
+    def __init__(self, kpis):
+        '''
+        :param kpis: a dictionary of KPI names to :class:`BatchProcessKPI`
+        '''
+        self.memo = {}
+        self.locks = {}
+        self.keys = {}
+        self.counts = {}
+        self.folded = 0
+
+        planned = {}
+        for name, bpkpi in kpis.items():
+            planned[name] = self.plan(bpkpi.kpi.dpl.ast, bpkpi.mapping)
+            self.count(planned[name])
+
+        self.kpis = {}
+        for name, bpkpi in kpis.items():
+            kpi = copy.copy(bpkpi.kpi)
+            kpi.dpl = copy.copy(kpi.dpl)
+            kpi.dpl.ast = self.rewrite(planned[name])
+            kpi.dpl.compiled_ast = None
+            self.kpis[name] = kpi
+        self.shared = len([key for key, count in self.counts.items() if count > 1])
+
+    def get_key(self, *structure):
+        '''
+        Hash-conses `structure` (which only refers to other subtrees by their key).
+        '''
+        try:
+            return self.keys.setdefault(structure, len(self.keys))
+        except TypeError: # An unhashable constant is never shared
+            return -1 - len(self.keys)
+
+    def plan(self, expr, mapping):
+        if isinstance(expr, Constant):
+            return PlannedExpr(expr, self.get_key('constant', type(expr.x), expr.x))
+        elif isinstance(expr, Identifier):
+            if expr.original_name.lower() == 'nothing':
+                return PlannedExpr(expr, self.get_key('constant', type(None), None))
+            value = mapping.get(expr.original_name, expr.original_name)
+            if isinstance(value, str):
+                return PlannedExpr(expr, self.get_key('input', value))
+            return PlannedExpr(Constant(value), self.get_key('constant', type(value), value))
+        elif isinstance(expr, SExpr):
+            children = [self.plan(x, mapping) for x in expr.exprs]
+            if expr.name in FOLDABLE and not isinstance(expr, FExpr) and \
+               all(is_constant_number(child.expr) for child in children):
+                try:
+                    value = expr.builtins[expr.name](*[child.expr.x for child in children])
+                except Exception: # Leave it to fail when the KPI is run
+                    pass
+                else:
+                    self.folded += 1
+                    return PlannedExpr(Constant(value), self.get_key('constant', type(value), value))
+            node = expr.__class__(expr.name, [child.expr for child in children], expr.builtins)
+            builtin = get_builtin_key(expr.builtins.get(expr.name))
+            key = self.get_key(expr.__class__, expr.name, builtin, *[child.key for child in children])
+            return PlannedExpr(node, key, children)
+        raise Exception(f'Cannot plan expression of type {type(expr)}.')
+
+    def count(self, planned):
+        '''
+        Counts how many times each subtree is evaluated. The subtrees of a subtree that has already been
+        seen are not counted again, because the subtree (and everything in it) will only be evaluated once.
+        '''
+        if not planned.children: # Identifiers and constants are not worth sharing
+            return
+        self.counts[planned.key] = self.counts.get(planned.key, 0) + 1
+        if self.counts[planned.key] == 1:
+            for child in planned.children:
+                self.count(child)
+
+    def rewrite(self, planned):
+        if not planned.children:
+            return planned.expr
+        expr = planned.expr
+        expr.exprs = [self.rewrite(child) for child in planned.children]
+        if self.counts.get(planned.key, 0) > 1:
+            return Shared(planned.key, expr, self.memo, self.locks)
+        return expr
+
+    def reset(self):
+        '''
+        Forgets the values of the shared expressions (so that they are evaluated again in the next run).
+        '''
+        self.memo.clear()
+        self.locks.clear()
+
+    def report(self):
+        return f'{self.shared} shared subexpressions, {self.folded} folded constant expressions'
+
+def get_builtin_key(f):
+    '''
+    Each KPI has its own builtins (the operators are created for every MiniPy), so builtins are compared by their
+    code when they do not close over anything. Otherwise they are compared by identity
+    (KPIs in a batch process are always given the same additional builtins).
+    '''
+    if getattr(f, '__closure__', True) is None:
+        return f.__code__
+    return id(f)
+
+def is_constant_number(expr):
+    return isinstance(expr, Constant) and \
+        not isinstance(expr.x, bool) and \
+        isinstance(expr.x, (numbers.Number, timedelta))
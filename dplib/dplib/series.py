@@ -1,7 +1,7 @@
+import numpy as np
 import pandas as pd
 
 from .dataset import *
-from .stream import SeriesStream
 from .aggregation import \
     Aggregation, \
     MaxAggregation, \
@@ -107,33 +107,49 @@ class Series:
     def window(self, duration):
         if len(self.series) == 0:
             return Series([])
-        
-        windows = []
-        stream = SeriesStream(self.series)
 
-        start_time, _ = stream.get()
-        stream.unget()
-        end_time = start_time + duration
+        # Windows share the sample arrays of `self.series`, and are delimited by their start offsets.
+        offsets = self.get_window_offsets(duration)
+        end = len(self.series)
 
-        values = []
-        times = []
-        while stream.has_values():
-            time, value = stream.get()
-            if time >= end_time:
-                stream.unget()
-                windows.append(pd.Series(values, index=times))
-                start_time = time
-                end_time = start_time + duration
-                values = []
-                times = []
-            else:
-                values.append(value)
-                times.append(time)
-        if not self.cout_enabled:
-            windows.append(pd.Series(values, index=times))
-            values = []
-            times = []
-        return Series(windows, cout=pd.Series(values, index=times) if values and times else None)
+        # The last window may not be complete, so it is carried out to be
+        # computed when more data comes (unless carry-out is disabled).
+        cout = None
+        if self.cout_enabled:
+            end = offsets[-1]
+            cout = self.series.iloc[end:]
+            offsets = offsets[:-1]
+        return WindowedSeries(self.series.values[:end], self.series.index[:end], offsets, cout=cout)
+
+    def get_window_offsets(self, duration):
+        '''
+        Returns the positions in `self.series` where each window of length `duration` starts.
+
+        A window starts at the first sample, and contains every sample before its start time plus `duration`.
+        The next window starts at the first sample that falls outside of the previous window.
+        '''
+        times = self.series.index.values
+        if isinstance(self.series.index, pd.DatetimeIndex):
+            duration = pd.Timedelta(duration).to_timedelta64()
+
+        # Samples are normally in time order, in which case each window's end can be found with a binary search.
+        if self.series.index.is_monotonic_increasing:
+            offsets = [0]
+            while True:
+                end = np.searchsorted(times, times[offsets[-1]] + duration, side='left')
+                if end >= len(times):
+                    break
+                offsets.append(end)
+            return np.array(offsets, dtype='int64')
+
+        # Otherwise, scan the samples in order (a sample earlier than the window's start still belongs to the window).
+        offsets = [0]
+        end_time = times[0] + duration
+        for i in range(1, len(times)):
+            if times[i] >= end_time:
+                offsets.append(i)
+                end_time = times[i] + duration
+        return np.array(offsets, dtype='int64')
 
     def when(self, body, orelse):
         '''
@@ -142,39 +158,52 @@ class Series:
         This looks like an if expression, but don't be fooled, this computes both body and orelse regardless 
         if self is all False or all True
         '''
-        series = []
-        indices = []
-        for i in range(len(self.series)):
-            if self.series[i]:
-                if isinstance(body, Series):
-                    value = body.series[i]
-                    indices.append(self.series.index[i])
-                # For aggregations, the sizes of the series may be different
-                # so we have to locate the closest time to the sample to use.
-                elif isinstance(body, Aggregation):
-                    if len(body.series.series) == 0:
-                        continue
-                    index_value = self.series.index[i]
-                    index = body.series.series.index.get_loc(index_value, method='nearest')
-                    value = body.series.series[index]
-                    indices.append(self.series.index[i])                        
-                else:
-                    value = body
-                    indices.append(self.series.index[i])                                            
-            else:
-                if isinstance(orelse, Series):
-                    value = orelse.series[i]
-                    indices.append(self.series.index[i])
-                elif isinstance(orelse, Aggregation):
-                    if len(orelse.series.series) == 0:
-                        continue
-                    value = orelse.series.series[orelse.series.series.index.get_loc(self.series.index[i], method='nearest')]
-                    indices.append(self.series.index[i])                                            
-                else:
-                    value = orelse
-                    indices.append(self.series.index[i])                        
-            series.append(value)
-        return Series.create_with_series(pd.Series(series, index=indices))
+        test = self.series.values.astype(bool)
+        body_values, body_valid = self.get_when_values(body)
+        orelse_values, orelse_valid = self.get_when_values(orelse)
+        # A branch which is never taken (or has no values) borrows the other branch's values,
+        # so that it can't change the type of the result.
+        if not test.any():
+            body_values, body_valid = orelse_values, orelse_valid
+        elif test.all():
+            orelse_values, orelse_valid = body_values, body_valid
+        if body_valid is False:
+            body_values = orelse_values
+        elif orelse_valid is False:
+            orelse_values = body_values
+
+        # Values of different kinds (for example numbers and strings, or numbers and None)
+        # are selected as Python objects, and pandas infers their type (as it would for a list).
+        kinds = np.asarray(body_values).dtype.kind + np.asarray(orelse_values).dtype.kind
+        mixed = not (set(kinds) <= set('iuf') or kinds == 'bb')
+        if mixed:
+            body_values = np.asarray(body_values, dtype=object)
+            orelse_values = np.asarray(orelse_values, dtype=object)
+
+        # Samples are skipped when their branch is an aggregation without any values.
+        valid = np.where(test, body_valid, orelse_valid)
+        values = np.where(test, body_values, orelse_values)[valid]
+        index = self.series.index[valid]
+        if mixed:
+            values = values.tolist()
+        return Series.create_with_series(pd.Series(values, index=index, dtype=None if len(index) else 'float64'))
+
+    def get_when_values(self, branch):
+        '''
+        Returns the values of a `when` branch (aligned with the samples in self), and which of them are valid.
+        '''
+        n = len(self.series)
+        if isinstance(branch, Series):
+            return branch.series.values[:n], True
+        # For aggregations, the sizes of the series may be different
+        # so we have to locate the closest time to each sample to use.
+        elif isinstance(branch, Aggregation):
+            series = branch.series.series
+            if len(series) == 0:
+                return None, False
+            indices = series.index.get_indexer(self.series.index, method='nearest')
+            return series.values[indices], True
+        return branch, True
 
     def average_aggregation(self):
         xs = self.series.sum()
@@ -183,7 +212,7 @@ class Series:
                                                      self.series.size)
         return ret
 
-    def aggregate(self, f):
+    def aggregate(self, f, batch=None):
         values = []
         times = []
         for series in self.series:
@@ -199,32 +228,33 @@ class Series:
     def average(self):
         return self.aggregate(lambda x: x.mean())
 
+    def reduce_samples(self, nanf, f):
+        '''
+        Reduces all samples to one value with the NaN-skipping NumPy reduction `nanf`
+        (or with `f` when the samples are not numbers). Returns None when there are no samples.
+        '''
+        values = self.series.values
+        if len(values) == 0:
+            return None
+        if values.dtype.kind in 'biuf':
+            return nanf(values).item()
+        return f(values)
+
     def min_aggregation(self):
-        local_min = None
-        for x in self:
-            if local_min is None:
-                local_min = x
-            else:
-                local_min = min(x, local_min)
-        return MinAggregation(self, local_min)
+        return MinAggregation(self, self.reduce_samples(np.nanmin, min))
 
     def min(self):
         return self.aggregate(lambda x: x.min())
 
     def sum_aggregation(self):
-        return SumAggregation(self, sum(self))
+        value = self.reduce_samples(np.nansum, sum)
+        return SumAggregation(self, 0 if value is None else value)
 
     def sum(self):
         return self.aggregate(lambda x: x.sum())
 
     def max_aggregation(self):
-        local_max = None
-        for x in self:
-            if local_max is None:
-                local_max = x
-            else:
-                local_max = max(x, local_max)
-        return MaxAggregation(self, local_max)
+        return MaxAggregation(self, self.reduce_samples(np.nanmax, max))
 
     def max(self):
         return self.aggregate(lambda x: x.max())
@@ -269,3 +299,156 @@ class Series:
         s = Series(cout=cout)
         s.series = series.dropna()
         return s
+
+
+class WindowedSeries(Series):
+    '''
+    A Series which has been split into windows.
+
+    Rather than storing a Series of Series, the samples of every window are kept in one contiguous
+    `values` array (and `times` index), and `offsets` holds the position where each window starts.
+    '''
+    def __init__(self, values, times, offsets, cout=None):
+        self.values = np.asarray(values)
+        self.times = pd.Index(times)
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.cout = pd.Series([], dtype='float64') if cout is None else cout
+        self.cout_enabled = False
+        self._series = None
+
+    @property
+    def series(self):
+        '''
+        The windows as a pandas Series of pandas Series (only built when asked for).
+        '''
+        if self._series is None:
+            self._series = pd.Series(list(self), dtype='object') if len(self) else pd.Series([], dtype='float64')
+        return self._series
+
+    @series.setter
+    def series(self, series):
+        windowed = WindowedSeries.from_windows(list(series), self.cout)
+        self.values, self.times, self.offsets = windowed.values, windowed.times, windowed.offsets
+        self._series = None
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_window(i)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get_window(self, i):
+        start = self.offsets[i]
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.values)
+        return pd.Series(self.values[start:end], index=self.times[start:end])
+
+    def get_bounds(self):
+        return np.append(self.offsets, len(self.values))
+
+    def get_counts(self):
+        return np.diff(self.get_bounds())
+
+    def get_start_times(self):
+        return self.times[self.offsets]
+
+    def get_uniform_windows(self):
+        '''
+        Returns the positions of the windows which have the most common length,
+        and the values of those windows as a 2-D array (one row per window).
+        '''
+        counts = self.get_counts()
+        length = np.bincount(counts).argmax()
+        rows = np.nonzero(counts == length)[0]
+        offsets = self.offsets[rows]
+        # When the windows are next to each other, the array is a view of the values.
+        if np.array_equal(offsets, offsets[0] + np.arange(len(rows)) * length):
+            start = offsets[0]
+            windows = self.values[start:start + len(rows) * length].reshape(len(rows), length)
+        else:
+            windows = self.values[offsets[:, None] + np.arange(length)]
+        return rows, windows
+
+    def get_sample_periods(self, rows):
+        '''
+        Returns the time (in seconds) between the first two samples of each window in `rows`.
+        '''
+        counts = self.get_counts()
+        return np.array([(self.times[self.offsets[row] + 1] - self.times[self.offsets[row]]).total_seconds()
+                         if counts[row] > 1 else np.nan for row in rows])
+
+    def aggregate(self, f, batch=None):
+        '''
+        Calls `f` on each window. If `batch` is given, windows with the most common length
+        are computed together by `batch` instead (see `make_builtin_decorator`).
+        '''
+        results = [None] * len(self)
+        batched = np.zeros(len(self), dtype=bool)
+        if batch is not None and len(self) > 0 and self.is_numeric():
+            rows, windows = self.get_uniform_windows()
+            for row, value in zip(rows, batch(windows, self.get_sample_periods(rows))):
+                results[row] = value
+            batched[rows] = True
+
+        values = []
+        times = []
+        for i, time in enumerate(self.get_start_times()):
+            val = results[i] if batched[i] else f(self.get_window(i))
+            if val == None:
+                continue
+            values.append(val)
+            times.append(time)
+        return Series(values,
+                      times,
+                      cout=self.cout)
+
+    def is_numeric(self):
+        return self.values.dtype.kind in 'biuf'
+
+    def reduce(self, ufunc, f):
+        '''
+        Reduces each window with the NumPy ufunc `ufunc` in one segmented reduction.
+        Windows of non-numeric values are reduced one at a time with `f` instead.
+        '''
+        if len(self) == 0 or not self.is_numeric():
+            return self.aggregate(f)
+        values = self.values
+        if values.dtype.kind == 'b' and ufunc is np.add:
+            values = values.astype('int64')
+        return Series(ufunc.reduceat(values, self.offsets),
+                      self.get_start_times(),
+                      cout=self.cout)
+
+    def average(self):
+        if len(self) == 0 or not self.is_numeric():
+            return self.aggregate(lambda x: x.mean())
+        sums = np.add.reduceat(self.values.astype('float64'), self.offsets)
+        return Series(sums / self.get_counts(),
+                      self.get_start_times(),
+                      cout=self.cout)
+
+    def min(self):
+        return self.reduce(np.fmin, lambda x: x.min())
+
+    def sum(self):
+        return self.reduce(np.add, lambda x: x.sum())
+
+    def max(self):
+        return self.reduce(np.fmax, lambda x: x.max())
+
+    def is_windowed(self):
+        return len(self.offsets) > 0
+
+    @staticmethod
+    def from_windows(windows, cout=None):
+        '''
+        Creates a WindowedSeries from a list of pandas Series (one per window).
+        '''
+        windows = [window for window in windows if len(window) > 0]
+        if not windows:
+            return WindowedSeries([], pd.Index([]), [], cout=cout)
+        counts = [len(window) for window in windows]
+        offsets = np.cumsum([0] + counts[:-1])
+        values = np.concatenate([window.values for window in windows])
+        times = windows[0].index.append([window.index for window in windows[1:]])
+        return WindowedSeries(values, times, offsets, cout=cout)
@@ -1,5 +1,6 @@
 from unittest import TestCase
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from pandas._testing import assert_frame_equal
 import pandas as pd
@@ -107,6 +108,24 @@ class TestBatchProcess(TestCase, ResultAssertions):
 
         self.assertResultEqual(result, expected_result)
 
+    def test_batch_process_executor(self):
+        bp = make_power_bp() \
+            .add('Average Power', dp.KPI('avg(Power)')) \
+            .add('Max Current', dp.KPI('max(Current)'))
+        bp._connect_graph()
+        self.assertEqual(bp._get_levels(), [
+            ['Max Current', 'Power'],
+            ['Average Power', 'Load %'],
+            ['Power above 50% Load', 'Power at 50% Load'],
+        ])
+
+        dataset = DF2.merge(dp.Dataset({ 'MaxPower': dp.Series([35] * 5, TIME2) }))
+        expected_result = bp.run(dataset)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            result = bp.run(dataset, executor=executor)
+        self.assertResultEqual(result, expected_result)
+        self.assertEqual(result.get_aggregations(), expected_result.get_aggregations())
+
     def test_batch_process_basic(self):
         bp = dp.BatchProcess() \
             .add('Power', POWER, {
@@ -125,6 +144,48 @@ class TestBatchProcess(TestCase, ResultAssertions):
         result = bp.run(DF1)
         self.assertResultEqual(result, expected_result)
 
+    def test_batch_process_plan(self):
+        bp = dp.BatchProcess() \
+            .add('Power', POWER) \
+            .add('Average Power', dp.KPI('avg(Voltage * Current)')) \
+            .add('Max Power', dp.KPI('max(Voltage * Current) * (Scale * 2)'), {
+                'Scale': 0.5,
+            }) \
+            .add('Scaled Power', dp.KPI('(V * Current) * Factor'), {
+                'V': 'Voltage',
+                'Factor': 1.0,
+            })
+        plan = bp.plan()
+        # `Voltage * Current` is shared by all KPIs, and `Scale * 2` is folded
+        self.assertEqual(plan.shared, 1)
+        self.assertEqual(plan.folded, 1)
+
+        result = bp.run(DF2)
+        power = [1*3, 2*4, 3*5, 4*6, 5*7]
+        self.assertResultEqual(result, dp.result.Result(dp.Dataset({
+            'Power': dp.Series(power, TIME2),
+            'Scaled Power': dp.Series(power, TIME2),
+        })))
+        self.assertEqual(result.aggregations['Average Power'].get_value(), sum(power) / len(power))
+        self.assertEqual(result.aggregations['Max Power'].get_value(), max(power))
+
+        # The plan is reused by the next run, which doesn't reuse the shared values of the last one
+        plan = bp._plan
+        result = bp.run(DF1)
+        self.assertIs(bp._plan, plan)
+        power = [1.23 * 0.32, 5.32 * -3.2, 8.19 * 4.2555]
+        self.assertResultEqual(result, dp.result.Result(dp.Dataset({
+            'Power': dp.Series(power, TIME1),
+            'Scaled Power': dp.Series(power, TIME1),
+        })))
+        self.assertEqual(result.aggregations['Max Power'].get_value(), max(power))
+        bp.add('Current', dp.KPI('Current'))
+        self.assertIsNone(bp._plan)
+
+        # The same KPI with different mappings is not shared
+        bp = make_power_bp()
+        self.assertEqual(bp.plan().shared, 0)
+
     def test_batch_process_get_windows(self):
         bp = dp.BatchProcess() \
             .add('Window1', dp.KPI('avg(window(Signal, "2s"))'), {
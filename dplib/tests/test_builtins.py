@@ -1,6 +1,7 @@
 from unittest import TestCase
 from datetime import datetime, timedelta
 import functools
+import math
 
 import numpy as np
 
@@ -222,6 +223,42 @@ class TestBuiltins(TestCase):
                               5: 1/27,                          
                           })
 
+    def test_thd_batched_windows(self):
+        '''
+        Windows of equal length are computed together, and the uneven trailing window should still be computed.
+        '''
+        wave = WaveGenerator() \
+            .add(frequency=60, amplitude=1) \
+            .add(frequency=180, amplitude=1/3) \
+            .generate(sample_rate=1000, duration=3.5)
+        windowed = wave.to_series().window(timedelta(seconds=1))
+        self.assertEqual(list(windowed.get_counts()), [1000, 1000, 1000, 500])
+        for code in ['thd(window(A, "1s"), 60)', 'thd(window(A, "1s"))']:
+            series = DPL.eval(code, { 'A': wave.to_series() })
+            self.assertEqual(len(series), 4)
+            for value in series:
+                self.assertEqualsWithTolerance(value, 100/3)
+
+        # Each window on its own should give the same result as all windows together.
+        series = DPL.eval('thd2(window(A, "1s"), 60, 1000)', { 'A': wave.to_series() })
+        self.assertEqual(len(series), 4)
+        for value, window in zip(series, windowed):
+            single = DPL.eval('thd2(window(A, "10s"), 60, 1000)', { 'A': Series(window) })
+            self.assertEqualsWithTolerance(value, list(single)[0])
+
+    def test_rms(self):
+        now = datetime.now()
+        times = [now + timedelta(seconds=n) for n in range(6)]
+        xs = [3, -4, 1, 2, 2, 0]
+        series = DPL.eval('rms(window(A, "2s"))', { 'A': Series(xs, times) })
+        expected = [math.sqrt((3**2 + 4**2)/2), math.sqrt((1 + 4)/2), math.sqrt(4/2)]
+        for value, expected_value in zip(series, expected):
+            self.assertEqualsWithTolerance(value, expected_value)
+
+        # The trailing window has a different length (and is computed on its own)
+        series = DPL.eval('rms(window(A, "4s"))', { 'A': Series(xs, times) })
+        self.assertEqualsWithTolerance(list(series)[1], math.sqrt(4/2))
+
     def assertEqualsWithTolerance(self, i1, i2, tolerance=1e-7):
         '''
         Assert the difference between `i1` and `i2` is less than `tolerance`
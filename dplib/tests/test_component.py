@@ -237,7 +237,15 @@ class TestComponent(TestCase, ResultAssertions):
             'Sum': Series([(7 * P1) + (9 * P2), (6 * P1) + (8 * P2), (5 * P1) + (7 * P2)],
                           [NOW, NOW + timedelta(seconds=1), NOW + timedelta(seconds=2)]),
         }), result.dataset)
-    
+
+        # The batch process (and its plan) is made once for each set of KPIs and mappings.
+        bp = SUT.get_pruned_bp(['Sum'], { 'A': 'E', 'B': 'D', 'P1': P1, 'P2': P2 })
+        result = SUT.run(D1_MAPPED, 'Sum', { 'B': 'D', 'A': 'E', 'P2': P2, 'P1': P1 })
+        self.assertIs(SUT.get_pruned_bp(['Sum'], { 'A': 'E', 'B': 'D', 'P1': P1, 'P2': P2 }), bp)
+        self.assertIsNot(SUT.get_pruned_bp(['Sum'], { 'A': 'E', 'B': 'D', 'P1': P2, 'P2': P1 }), bp)
+        SUT.add('Difference', 'A - B')
+        self.assertIsNot(SUT.get_pruned_bp(['Sum'], { 'A': 'E', 'B': 'D', 'P1': P1, 'P2': P2 }), bp)
+
     def test_aggregation_with_dependent(self):
         SUT = Component('System Under Test') \
             .add('Sum', 'A + B') \
@@ -4,6 +4,7 @@ import copy
 
 import dplib as dp
 from dplib.graph import Graph
+from dplib.exceptions import CyclicGraphException
 
 def make_graph_sut():
     G = Graph()
@@ -91,6 +92,19 @@ class TestBatchProcess(TestCase):
         G.connect('Load %', 'THD Voltage')
         G.get_topological_ordering()
 
+    def test_graph_levels(self):
+        G = Graph()
+        G.connect('A', 'C')
+        G.connect('B', 'C')
+        G.connect('C', 'D')
+        G.connect('A', 'D')
+        G.add_vertex('E')
+        self.assertEqual(G.get_levels(), [['A', 'B', 'E'], ['C'], ['D']])
+
+        G.connect('D', 'A')
+        with self.assertRaises(CyclicGraphException):
+            G.get_levels()
+
     def test_graph_prune(self):
         G = Graph()
         G.connect('A', 'B')
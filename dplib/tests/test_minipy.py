@@ -193,6 +193,19 @@ class TestMiniPy(TestCase):
         ids = mpy.parse('((fcall(arg1 if unicorn else donkey, arg2, ie(arg3, wo(arg4))) + vcc)+ call2(neww))').get_identifiers()
         self.assertEqual(ids_to_set(ids), {'ARG1', 'UNICORN', 'DONKEY', 'ARG2', 'ARG3', 'ARG4', 'VCC', 'NEWW'})
 
+    def test_compile_once(self):
+        '''
+        Compiling an expression more than once should give the same compiled function, and builtins
+        should still be able to be overridden after compiling.
+        '''
+        mpy = MiniPy({ 'f': lambda x: x + 1 })
+        expr = mpy.parse('f(a) * 2 if a > 1 else f(3)')
+        self.assertIs(expr.compile(), expr.compile())
+        self.assertEqual(expr.compile().run({ 'a': 4 }), 10)
+        self.assertEqual(expr.compile().run({ 'a': 0 }), 4)
+        mpy.builtins['F'] = lambda x: x - 1
+        self.assertEqual(expr.compile().run({ 'a': 4 }), 6)
+
     def test_logical_operators(self):
         self.assertEqual(run('1 and 2'), 2)
         self.assertEqual(run('1 > 0 and 2 > 0'), True)
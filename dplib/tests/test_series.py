@@ -3,10 +3,12 @@ from datetime import datetime, timedelta
 
 from pandas.testing import assert_series_equal
 import pandas as pd
+import numpy as np
 
 from dplib.testing import SeriesAssertions
-from dplib.series import Series
+from dplib.series import Series, WindowedSeries
 from dplib.dataset import Dataset
+from dplib.aggregation import AverageAggregation
 
 def make_times(n, t=None, step=None):
     t = datetime.now() if t is None else t
@@ -93,6 +95,15 @@ class TestSeries(TestCase, SeriesAssertions):
         ds = Series([1, -2, 10])
         self.assertEqual(sum(ds), 9)
 
+    def test_min_max_sum_aggregation(self):
+        ds = Series([1, 4, -3, 30, 23, 4, 39, 11])
+        self.assertEqual(ds.min_aggregation().get_value(), -3)
+        self.assertEqual(ds.max_aggregation().get_value(), 39)
+        self.assertEqual(ds.sum_aggregation().get_value(), 109)
+        self.assertIsInstance(ds.max_aggregation().get_value(), int)
+        self.assertEqual(Series([]).min_aggregation().get_value(), None)
+        self.assertEqual(Series([]).sum_aggregation().get_value(), 0)
+
     def test_drop_null(self):
         ds = Series([None, 1, 2])
         self.assertEqual([1, 2], list(ds))
@@ -110,6 +121,18 @@ class TestSeries(TestCase, SeriesAssertions):
         s3 = s1.when(s2, None)
         assert_series_equal(s3.series, pd.Series([1.0, 3.0], index=[times[0], times[2]]))
 
+    def test_when_aggregation(self):
+        # Aggregation branches use the value nearest in time to each sample
+        times = make_times(4)
+        agg = AverageAggregation(Series([10, 20], times=[times[0], times[3]]), 15, 2)
+        series = Series([True, False, True, True], times=times).when(agg, 0)
+        assert_series_equal(series.series, pd.Series([10, 0, 20, 20], index=times))
+
+        # Samples are dropped when an aggregation branch has no values
+        agg = AverageAggregation(Series([]), None, 0)
+        series = Series([True, False, True, False], times=times).when(agg, 1)
+        assert_series_equal(series.series, pd.Series([1, 1], index=[times[1], times[3]]))
+
     def test_windows_with_cout(self):
         # Windows are created with full buckets of data
         # That is each window is filled until it exceeds the time window.
@@ -174,6 +197,36 @@ class TestSeries(TestCase, SeriesAssertions):
         series = Series(values, times).window(timedelta(seconds=1)).average()
         assert_series_equal(series.series, pd.Series([sum(values[:5])/5, values[5]], index=[times[0], times[5]]))
 
+    def test_window_offsets(self):
+        now = datetime.now()
+        times = [now + timedelta(seconds=n) for n in [0, 0.5, 1, 1.2, 2.5, 2.6, 3.4, 7]]
+        series = Series(range(len(times)), times)
+        self.assertEqual(list(series.get_window_offsets(timedelta(seconds=1))), [0, 2, 4, 7])
+        self.assertEqual(list(series.get_window_offsets(timedelta(seconds=10))), [0])
+
+        # Windows are views into the original series
+        windows = list(series.window(timedelta(seconds=1)))
+        self.assertEqual(list(map(list, windows)), [[0, 1], [2, 3], [4, 5, 6], [7]])
+        self.assertTrue(np.shares_memory(windows[1].values, series.series.values))
+
+    def test_windowed_series(self):
+        times = make_times(7)
+        series = Series([3, 1, 4, 1, 5, 9, 2], times).window(timedelta(seconds=3))
+        self.assertIsInstance(series, WindowedSeries)
+        self.assertEqual(list(series.offsets), [0, 3, 6])
+        self.assertEqual(list(series.values), [3, 1, 4, 1, 5, 9, 2])
+        self.assertEqual(series.windows_to_list(), [[3, 1, 4], [1, 5, 9], [2]])
+        index = [times[0], times[3], times[6]]
+        assert_series_equal(series.sum().series, pd.Series([8, 15, 2], index=index))
+        assert_series_equal(series.min().series, pd.Series([1, 1, 2], index=index))
+        assert_series_equal(series.max().series, pd.Series([4, 9, 2], index=index))
+        assert_series_equal(series.average().series, pd.Series([8/3, 5, 2], index=index))
+
+        windows = [pd.Series([1, 2], index=times[:2]), pd.Series([3], index=times[2:3])]
+        series = WindowedSeries.from_windows(windows)
+        self.assertEqual(list(series.offsets), [0, 2])
+        assert_series_equal(series.sum().series, pd.Series([3, 3], index=[times[0], times[2]]))
+
     def test_carry(self):
         # First 7 values are in sequence, next 7 are in different sequence with cout
         t1 = make_times(7, t=datetime.now() - timedelta(hours=1))
@@ -1,9 +1,17 @@
 import json
+import asyncio
 
 import dps_services.util as ddt
+import dps_services.database_manager as dbm
 
 from .util import *
 
+MAX_RETRIES = 10
+'''
+How many times a request is sent again while the server refuses it because it is busy
+(HTTP 429, e.g. when the Database Manager's insert queue is full).
+'''
+
 class APIClient:
     def __init__(self, url, key):
         # Ensure URL ends with a slash
@@ -22,15 +30,29 @@ class APIClient:
         return json.loads(await resp.text())
 
     async def post(self, session, postfix, data):
-        resp = await session.post(self.url + postfix,
-                                  json=data,
-                                  headers={
-                                      'Authorization': 'API ' + self.key,
-                                  })
+        resp = await self.send_post(session, postfix, data)
         if resp.status == 404:
             return 404
         return json.loads(await resp.text())
 
+    async def send_post(self, session, postfix, data, headers={}):
+        '''
+        Posts `data`, and waits (for as long as the Retry-After header says) to post again while the server responds with a 429.
+
+        :returns: the last response
+        '''
+        for _ in range(MAX_RETRIES):
+            resp = await session.post(self.url + postfix,
+                                      json=data,
+                                      headers={
+                                          'Authorization': 'API ' + self.key,
+                                          **headers,
+                                      })
+            if resp.status != 429:
+                break
+            await asyncio.sleep(float(resp.headers.get('Retry-After', 1)))
+        return resp
+
     async def put(self, session, postfix, id, data):
         resp = await session.put(self.url + postfix + '/' + str(id),
                                  json=data,
@@ -95,7 +117,19 @@ class DatabaseManagerAPIClient(APIClient):
     GET_DATASET_RANGE_POSTFIX   = 'api/v1/get_dataset_range'    
     GET_SIGNAL_NAMES_POSTFIX   = 'api/v1/get_signal_names'    
 
-    async def get_data(self, session, dataset, signals, start_time, end_time, limit=None):
+    async def get_data(self, session, dataset, signals, start_time, end_time, limit=None, columnar=False, binary=False,
+                       paginate=False, after=None):
+        '''
+        Gets the samples of `signals` between `start_time` and `end_time`.
+
+        If `paginate` is True, the result has a continuation token ("next") if there are more samples after this
+        page, which should be passed as `after` to get the next page.
+
+        If `columnar` is True, the results are requested with the times as nanoseconds
+        and one list of values per signal (older servers will still send rows).
+        If `binary` is also True, the binary format is asked for in the Accept header (so servers that can't
+        send it still send columnar JSON), and if it is sent, the times and values are NumPy arrays.
+        '''
         data = {
             "queries": [
                 {
@@ -109,10 +143,23 @@ class DatabaseManagerAPIClient(APIClient):
             ]
         }
 
+        if columnar:
+            data['format'] = 'columnar'
         if limit:
             data['queries'][0]['limit'] = limit
-        result = await self.post(session, self.QUERY_POSTFIX, data)
-        return result
+        if paginate:
+            data['queries'][0]['paginate'] = True
+        if after:
+            data['queries'][0]['after'] = after
+        if not (columnar and binary):
+            return await self.post(session, self.QUERY_POSTFIX, data)
+
+        resp = await self.send_post(session, self.QUERY_POSTFIX, data,
+                                    headers={ 'Accept': dbm.BINARY_CONTENT_TYPE + ', application/json' })
+        if resp.content_type == dbm.BINARY_CONTENT_TYPE:
+            # Copy into a bytearray so that the arrays can be written to.
+            return dbm.load_binary_results(bytearray(await resp.read()))
+        return json.loads(await resp.text())
 
     async def get_signal_names(self, session, dataset):
         '''
@@ -185,4 +232,8 @@ class DatabaseManagerAPIClient(APIClient):
             ]
         }
 
-        return await self.post(session, self.INSERT_POSTFIX, data)
+        # The samples would be lost without an error if a refused insert was treated like a response.
+        resp = await self.send_post(session, self.INSERT_POSTFIX, data)
+        if resp.status >= 400:
+            raise Exception(f'Failed to send data to the DPS Database Manager (status {resp.status}): {await resp.text()}')
+        return json.loads(await resp.text())
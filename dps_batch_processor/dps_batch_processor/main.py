@@ -1,7 +1,6 @@
 import os
 import json
 from datetime import datetime, timedelta
-from collections import defaultdict
 import traceback
 
 import asyncio
@@ -16,6 +15,8 @@ import dps_services.util as ddt
 
 from .util import *
 from .logger import Logger
+from .pool import ComponentPool
+from .pipeline import StageTimer, fetch_pages, split_windows
 from .api import DPSManagerAPIClient, \
     DatabaseManagerAPIClient, \
     STATUS_ERROR, \
@@ -31,25 +32,37 @@ exceptions = (aiohttp.client_exceptions.ClientConnectorError, aiohttp.client_exc
 @click.option('--polling-interval',     default=5,      help='The number of seconds to wait between checking for jobs.')
 @click.option('--max-batch-size',       default=10000, help='The maximum number of datapoints to process in one batch.')
 @click.option('--interval',             default=5,      help='The number of seconds to wait between checking for jobs.')
+@click.option('--concurrency',          default=1,      help='The number of jobs to process at once (each KPI computation is run in a pool of this many processes).')
+@click.option('--prefetch-pages',       default=2,      help='The number of pages of data to fetch ahead of the page being processed.')
 @click.option('--verbose',                              help='Show the progress of jobs in the command line.')
-def cli(dps_manager_url, database_manager_url, api_key, polling_interval, max_batch_size, interval=5, verbose=False):
-    do_cli(*args, **kwargs)
+def cli(dps_manager_url, database_manager_url, api_key, polling_interval, max_batch_size, interval=5, concurrency=1, prefetch_pages=2, verbose=False):
+    do_cli(dps_manager_url, database_manager_url, api_key, polling_interval, max_batch_size,
+           interval=interval, concurrency=concurrency, prefetch_pages=prefetch_pages, verbose=verbose)
 
-def do_cli(dps_manager_url, database_manager_url, api_key, polling_interval, max_batch_size, interval=5, verbose=False):    
+def do_cli(dps_manager_url, database_manager_url, api_key, polling_interval, max_batch_size, interval=5, concurrency=1, prefetch_pages=2, verbose=False):
     logger = Logger(verbose)
     loop = asyncio.get_event_loop()
 
-    # `main` is written as a `asyncio` co-routine, so that if multiple batch processors
-    # are supported (running multiple batch processes at once), this capability could be added,
-    # by spawning another instance of the `main` co-routine.
-    loop.run_until_complete(main(dps_manager_url, database_manager_url, api_key, max_batch_size, logger, interval))
+    # `main` runs `concurrency` instances of the `process_jobs` co-routine (each processing one job at a time).
+    loop.run_until_complete(main(dps_manager_url, database_manager_url, api_key, max_batch_size, logger, interval, concurrency, prefetch_pages))
     # Windows requires explicitly attaching signal handlers to
     # process signals for SIGINT/SIGTERM (for Ctrl-C to quit).
     loop.add_signal_handler(SIGINT, main_task.cancel)
     loop.add_signal_handler(SIGTERM, main_task.cancel)
     return loop
 
-async def main(dps_manager_url, database_manager_url, api_key, max_batch_size, logger, interval=5):
+async def main(dps_manager_url, database_manager_url, api_key, max_batch_size, logger, interval=5, concurrency=1, prefetch_pages=2):
+    # With one job at a time, KPIs are computed in this process (there is nothing else for the event loop to do).
+    # Otherwise, KPIs are computed in a pool of processes, so that the jobs can fetch and send data in the meantime.
+    pool = ComponentPool(concurrency) if concurrency > 1 else None
+    try:
+        await asyncio.gather(*[process_jobs(dps_manager_url, database_manager_url, api_key, max_batch_size, logger, interval, pool, prefetch_pages)
+                               for _ in range(concurrency)])
+    finally:
+        if pool:
+            pool.shutdown()
+
+async def process_jobs(dps_manager_url, database_manager_url, api_key, max_batch_size, logger, interval=5, pool=None, prefetch_pages=2):
     api = DPSManagerAPIClient(dps_manager_url, api_key)
     while True:
         async with aiohttp.ClientSession() as session:
@@ -63,12 +76,12 @@ async def main(dps_manager_url, database_manager_url, api_key, max_batch_size, l
                     logger.log('Acquired a job.')
                     await process_job(api, logger, session, job,
                                       DatabaseManagerAPIClient(database_manager_url, api_key),
-                                      max_batch_size)
+                                      max_batch_size, pool, prefetch_pages)
             except exceptions:
                 logger.error('Failed connecting to DPS Manager server.')
         await asyncio.sleep(interval)
 
-async def process_job(api, logger, session, job, dbc, max_batch_size):
+async def process_job(api, logger, session, job, dbc, max_batch_size, pool=None, prefetch_pages=2):
     async def handle_unexpected_exception():
         await send_error(f'{e}\n\nStack trace:\n {traceback.format_exc()}', logger, api, session, batch_process_id, result, inter_results, chartables, None, processed_samples, total_samples)
         logger.log(f'Sent error that occured during batch process:  {e}\n\nStack trace:\n {traceback.format_exc()}')
@@ -107,8 +120,7 @@ async def process_job(api, logger, session, job, dbc, max_batch_size):
     signals            = get_signal_identifiers(component, batch_process, parameters)
     max_window         = bp._get_max_window(mappings)
     dbm_has_data       = True
-    samples            = []
-    times              = []
+    frame              = None # The samples that have not been processed yet (one column per signal)
     result             = None
     inter_results      = dp.Dataset() # Intermediate results
     chartables         = set() # Keep track of which signals are plottable on a chart
@@ -180,116 +192,130 @@ async def process_job(api, logger, session, job, dbc, max_batch_size):
         logger.log('Ending batch process, as there are no input samples.')
         return
 
-    while dbm_has_data:
-        try:
-            data = await dbc.get_data(session, dataset, mapped_signals,
-                                      current_start_time, end_time,
-                                      limit=max_batch_size)
-        except exceptions:            
-            await send_error("Failed to connect to DPS Database Manager server when sending results.",
-                             logger, api, session, batch_process_id, result, inter_results, chartables, result_id, processed_samples, total_samples)
-            return
-        except Exception as e:
-            await handle_unexpected_exception()
-            return
-        # If no results are returned, print it as an error and return.
-        if 'results' not in data:
-            logger.error(data)
-            return
-        results = data['results'][0]
-        samples += results['samples']
-        times   += [ddt.parse_datetime(time) for time in results['times']]
-
-        # If there is no more data after this, end the process after this batch completes.
-        if len(signals) * len(samples) < max_batch_size or current_start_time == end_time:
-            dbm_has_data = False
-        else:
-            # Start the next batch of data at the last time we got from this batch.
-            # Don't use that batch's sample data because there is a chance the samples
-            # could be missing if the limit is not a multiple of the # of signals.
-            samples.pop()
-            current_start_time = times.pop()
-        
-        # If the computation contains a window,
-        # and if we have not accumulated enough data to fill the largest window,
-        # continue collecting data into the `samples` and `times` variables.
-        #
-        # There is also a check to make sure if there is more data to accumulate.
-        # If there is no more data to accumulate, we should finish processing that data
-        # otherwise, we would continuously ask for more data.
-        if max_window is not None and dbm_has_data:
-            delta_time = times[-1] - times[0]
-            if delta_time < max_window:
-                continue
-
-        # Split data into chunks of size `max_window`
-        series = dplib.Series(samples, times)
-
-        # If the computation contains a window, window the data based on the max window size.
-        # Otherwise, create a dummy window with just one item.
-        if max_window is not None:
-            windowed_series = list(series.window(max_window))
-            # If there is more data after this batch, use the last window in the next batch.
-            # This prevents a batch which ends on an odd number from happening. For example,
-            # at the end of the batch, if the batch's size is not the same as the window's.
-            # This should be tolerated at the very end of a batch process, but not in between
-            # batches.
-            if dbm_has_data:
-                last_series = windowed_series.pop()
-                times   = list(last_series.index)
-                samples = list(last_series)
+    # The job is processed as a pipeline of three stages that run at the same time:
+    # fetching page N+1 from the Database Manager (`fetch_pages`), computing page N (below),
+    # and uploading the intermediate results of page N-1 (`upload_inter_results`).
+    # The queues between the stages are bounded, so that a slow stage holds back the others.
+    timer   = StageTimer()
+    pages   = asyncio.Queue(maxsize=prefetch_pages)
+    uploads = asyncio.Queue(maxsize=1)
+
+    async def upload_inter_results():
+        while True:
+            upload = await uploads.get()
+            if upload is None:
+                return None
+            with timer.time('upload'):
+                ires = await flush_inter_results(api, logger, dbc, session, kpis_display_name_to_name, batch_process_id,
+                                                 result_id=result_id, total_samples=total_samples, **upload)
+            if ires == 404:
+                return 404
+
+    async def compute(df):
+        with timer.time('compute'):
+            if pool:
+                return await pool.run(system, df, kpis, mappings, result, frame_counter)
+            # Compute in a thread, so that the other stages can continue in the meantime.
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, lambda: component.run(df, kpis, mappings, previous_result=result,
+                                                                          additional_builtins={ 'GET_FRAME_COUNT': lambda: frame_counter }))
+
+    fetch_task  = asyncio.ensure_future(fetch_pages(dbc, session, pages, timer, dataset, signals, mapped_signals,
+                                                    current_start_time, end_time, max_batch_size))
+    upload_task = asyncio.ensure_future(upload_inter_results())
+    try:
+        while dbm_has_data:
+            page = await pages.get()
+            if page.exception is not None:
+                if isinstance(page.exception, exceptions):
+                    await send_error("Failed to connect to DPS Database Manager server when sending results.",
+                                     logger, api, session, batch_process_id, result, inter_results, chartables, result_id, processed_samples, total_samples)
+                else:
+                    e = page.exception
+                    await send_error(f'{e}\n\nStack trace:\n {"".join(traceback.format_exception(type(e), e, e.__traceback__))}',
+                                     logger, api, session, batch_process_id, result, inter_results, chartables, None, processed_samples, total_samples)
+                return
+            # If no results are returned, print it as an error and return.
+            if page.error is not None:
+                logger.error(page.error)
+                return
+            # Keep the samples left over from the last page (the last window, if it was incomplete).
+            frame = page.frame if frame is None else pd.concat([frame, page.frame])
+            dbm_has_data = page.has_more
+
+            # If the computation contains a window,
+            # and if we have not accumulated enough data to fill the largest window,
+            # continue collecting data into `frame`.
+            #
+            # There is also a check to make sure if there is more data to accumulate.
+            # If there is no more data to accumulate, we should finish processing that data
+            # otherwise, we would continuously ask for more data.
+            if max_window is not None and dbm_has_data:
+                delta_time = frame.index[-1] - frame.index[0]
+                if delta_time < max_window:
+                    continue
+
+            # If the computation contains a window, split the data into windows based on the max window size.
+            # Otherwise, create a dummy window with all of the data.
+            if max_window is not None:
+                windows = split_windows(frame, max_window)
+                # If there is more data after this batch, use the last window in the next batch.
+                # This prevents a batch which ends on an odd number from happening. For example,
+                # at the end of the batch, if the batch's size is not the same as the window's.
+                # This should be tolerated at the very end of a batch process, but not in between
+                # batches.
+                frame = windows.pop() if dbm_has_data else None
             else:
-                times   = []
-                samples = []
-        else:
-            windowed_series = [series.series] # Extract the pandas series from the `dp.Series`
-            times   = []
-            samples = []
-
-        # Convert the response from the Database Manager server into a `pd.DataFrame`.
-        for window in windowed_series:
-            df_data = defaultdict(list)
-            for batch in window:
-                for i, signal in enumerate(mapped_signals):
-                    df_data[signal].append(batch[i])
-
-            # Create a DataFrame `df` based on the data in the window.
-            # Then, run the batch process with the DataFrame `df`.
-            df           = pd.DataFrame(data=df_data, index=window.index)
-            logger.log('Processing DataFrame:\n', df)
-            
-            try:
-                print('mappings', mappings)
-                result       = component.run(df, kpis, mappings, previous_result=result, additional_builtins={ 'GET_FRAME_COUNT': lambda: frame_counter })
-                # if result: this merging is already being done withing component.run
-                #     next_result.aggregations = result.get_merged_aggregations(next_result)
-
-                # After every batch is run, send the intermediate results
-                inter_results = inter_results.merge(result.get_intermidiate_values())
-
-                aggregations = result.get_aggregations_for_ui()
-                logger.log('Aggregations for this step: ', aggregations)
-
-                processed_samples += sum(df.count()) # count all non-null values in the input data
-
-                for batch in window:
-                    frame_counter += len(batch)
-                logger.log('Updated frame counter: ', frame_counter)
-            except Exception as e:
-                # Send the error message to the server.
-                await send_error(f'Error occured when running KPI computation: {e}\n\nStack trace:\n {traceback.format_exc()}',
+                windows = [frame]
+                frame = None
+
+            # Run the batch process on each window (a `pd.DataFrame` with a column for each signal).
+            for df in windows:
+                logger.log('Processing DataFrame:\n', df)
+
+                try:
+                    result       = await compute(df)
+                    # if result: this merging is already being done withing component.run
+                    #     next_result.aggregations = result.get_merged_aggregations(next_result)
+
+                    # After every batch is run, send the intermediate results
+                    inter_results = inter_results.merge(result.get_intermidiate_values())
+
+                    aggregations = result.get_aggregations_for_ui()
+                    logger.log('Aggregations for this step: ', aggregations)
+
+                    processed_samples += int(df.count().sum()) # count all non-null values in the input data
+
+                    frame_counter += df.size
+                    logger.log('Updated frame counter: ', frame_counter)
+                except Exception as e:
+                    # Send the error message to the server.
+                    await send_error(f'Error occured when running KPI computation: {e}\n\nStack trace:\n {traceback.format_exc()}',
+                               logger, api, session, batch_process_id, result, inter_results, chartables, result_id, processed_samples, total_samples)
+                    return
+
+            chartables = chartables.union(set(inter_results.dataset.keys()))
+
+            # Upload this page's intermediate results while the next page is computed.
+            # If the previous upload failed, stop processing.
+            if upload_task.done() or \
+               await put_unless_done(uploads, dict(inter_results=inter_results, chartables=chartables,
+                                                   result=result, processed_samples=processed_samples), upload_task):
+                await send_error(f'Failed to send intermediate results to DPS Database Manager',
                            logger, api, session, batch_process_id, result, inter_results, chartables, result_id, processed_samples, total_samples)
                 return
 
-        chartables = chartables.union(set(inter_results.dataset.keys()))
+            inter_results = dp.Dataset()
 
-        ires = await flush_inter_results(api, logger, dbc, session, kpis_display_name_to_name, batch_process_id, inter_results, chartables, result, result_id, processed_samples, total_samples)
-        if ires == 404: 
+        # Wait for the remaining uploads to finish
+        await uploads.put(None)
+        if await upload_task == 404:
             await send_error(f'Failed to send intermediate results to DPS Database Manager',
                        logger, api, session, batch_process_id, result, inter_results, chartables, result_id, processed_samples, total_samples)
             return
-
-        inter_results = dp.Dataset()
+    finally:
+        fetch_task.cancel()
+        upload_task.cancel()
 
     # Write any remaining intermediate results
     await flush_inter_results(api, logger, dbc, session, kpis_display_name_to_name, batch_process_id, inter_results, chartables, result, result_id, processed_samples, total_samples)
@@ -297,7 +323,19 @@ async def process_job(api, logger, session, job, dbc, max_batch_size):
     await send_result(STATUS_COMPLETE, 
                       logger, api, session, kpis_display_name_to_name, batch_process_id, result, inter_results, chartables, result_id, processed_samples, total_samples)
 
-    logger.log('Finished processing job.')
+    logger.log(f'Finished processing job ({timer.report()}).')
+
+async def put_unless_done(queue, item, task):
+    '''
+    Puts `item` on the `queue`, unless `task` (which takes items off of the queue) finishes first.
+    Returns True if the task finished.
+    '''
+    put = asyncio.ensure_future(queue.put(item))
+    await asyncio.wait([put, task], return_when=asyncio.FIRST_COMPLETED)
+    if put.done():
+        return False
+    put.cancel()
+    return True
 
 async def flush_inter_results(api, logger, dbc, session, kpis, batch_process_id, inter_results, chartables, result, result_id, processed_samples, total_samples):
     try:
@@ -0,0 +1,116 @@
+import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+import dplib as dp
+import dps_services.util as ddt
+
+class StageTimer:
+    '''
+    Keeps track of how much time each stage of a job's pipeline (fetch, compute, and upload) has spent working.
+    '''
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[stage] += time.perf_counter() - start
+            self.counts[stage] += 1
+
+    def to_dict(self):
+        return {
+            stage: { 'seconds': self.totals[stage], 'count': self.counts[stage] }
+            for stage in self.totals
+        }
+
+    def report(self):
+        return ', '.join(f'{stage} took {self.totals[stage]:.3f}s ({self.counts[stage]} times)'
+                         for stage in self.totals)
+
+class Page:
+    '''
+    One page of samples from the Database Manager as a `pd.DataFrame` (or the reason why it could not be fetched).
+    '''
+    def __init__(self, frame=None, has_more=False, error=None, exception=None):
+        self.frame = frame
+        self.has_more = has_more
+        self.error = error
+        self.exception = exception
+
+def to_frame(results, signals):
+    '''
+    Creates a `pd.DataFrame` (with a column for each signal) from the results of a query.
+
+    Columnar results (times as nanoseconds, and one list of values per signal) are
+    put into one float64 array which the DataFrame uses without copying
+    (binary results already are NumPy arrays, so they are not copied at all).
+    Otherwise, the results have a list of samples for each time (as a string).
+    '''
+    if 'samples' not in results:
+        times  = np.asarray(results['times'], dtype='int64').view('datetime64[ns]')
+        values = np.asarray(results['values'], dtype='float64').reshape(len(signals), len(times))
+        return pd.DataFrame(values.T, index=pd.DatetimeIndex(times), columns=signals)
+    times = pd.DatetimeIndex([ddt.parse_datetime(time) for time in results['times']])
+    return pd.DataFrame(results['samples'], index=times, columns=signals)
+
+def split_windows(frame, duration):
+    '''
+    Splits `frame` into windows of length `duration` (views of `frame`, so nothing is copied).
+    '''
+    if len(frame) == 0:
+        return []
+    offsets = dp.Series(pd.Series(frame.index, index=frame.index)).get_window_offsets(duration)
+    ends = list(offsets[1:]) + [len(frame)]
+    return [frame.iloc[start:end] for start, end in zip(offsets, ends)]
+
+async def fetch_pages(dbc, session, queue, timer, dataset, signals, mapped_signals, start_time, end_time, max_batch_size):
+    '''
+    Fetches pages of data from the Database Manager, and puts them on `queue` (a bounded `asyncio.Queue`)
+    so that the next pages are fetched while the current page is being computed.
+    The last page has `has_more` set to False, or has an error/exception.
+    '''
+    try:
+        await fetch(dbc, session, queue, timer, dataset, signals, mapped_signals, start_time, end_time, max_batch_size)
+    except Exception as e:
+        await queue.put(Page(exception=e))
+
+async def fetch(dbc, session, queue, timer, dataset, signals, mapped_signals, start_time, end_time, max_batch_size):
+    current_start_time = start_time
+    after = None
+    has_more = True
+    while has_more:
+        with timer.time('fetch'):
+            data = await dbc.get_data(session, dataset, mapped_signals,
+                                      current_start_time, end_time,
+                                      limit=max_batch_size, columnar=True, binary=True,
+                                      paginate=True, after=after)
+        # If no results are returned, stop fetching.
+        if 'results' not in data:
+            await queue.put(Page(error=data))
+            return
+        result = data['results'][0]
+        frame = to_frame(result, mapped_signals)
+
+        if result.get('query', {}).get('paginate'):
+            # The server pages by (time, signal ID), so the next page starts right after this one.
+            after = result.get('next')
+            has_more = after is not None
+        # Older servers don't paginate, so a page can only be found by its start time.
+        # If there is no more data after this, end the process after this page.
+        elif len(signals) * len(frame) < max_batch_size or current_start_time == end_time:
+            has_more = False
+        else:
+            # Start the next page of data at the last time we got from this page.
+            # Don't use that page's sample data because there is a chance the samples
+            # could be missing if the limit is not a multiple of the # of signals.
+            current_start_time = frame.index[-1].to_pydatetime()
+            frame = frame.iloc[:-1]
+        await queue.put(Page(frame, has_more))
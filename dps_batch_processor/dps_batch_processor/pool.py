@@ -0,0 +1,70 @@
+import json
+import asyncio
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+from dplib.result import Result
+
+from .util import make_component
+
+class ComponentPool:
+    '''
+    Runs `dplib.Component` computations in a pool of processes (so that they don't block the event loop).
+
+    At most `workers` computations are given to the pool at a time.
+    '''
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.running = 0
+        self.condition = None
+
+    def get_condition(self):
+        # The condition must be created inside of the event loop.
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        return self.condition
+
+    def is_saturated(self):
+        return self.running >= self.workers
+
+    async def run(self, system, df, kpis, mappings, previous_result, frame_counter):
+        '''
+        Runs the KPIs of `system` on `df` in the pool. The `dplib.Component` can't be sent to another process
+        (it contains the compiled KPIs), so it is made again from `system` in the worker process.
+
+        Only the aggregations of `previous_result` are sent to the worker (which is all that the KPIs need from it),
+        and its dataset (the KPI values of every window so far) is merged with the worker's result here instead.
+        '''
+        condition = self.get_condition()
+        async with condition:
+            await condition.wait_for(lambda: not self.is_saturated())
+            self.running += 1
+        try:
+            loop = asyncio.get_event_loop()
+            previous_aggregations = None if previous_result is None else Result(aggregations=previous_result.aggregations)
+            result = await loop.run_in_executor(self.executor, run_component,
+                                                json.dumps(system), df, kpis, mappings,
+                                                previous_aggregations, frame_counter)
+        finally:
+            async with condition:
+                self.running -= 1
+                condition.notify_all()
+        if previous_result is not None and previous_result.dataset is not None and result.dataset is not None:
+            result.dataset = previous_result.dataset.merge(result.dataset)
+        return result
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+@lru_cache(maxsize=32)
+def get_component(system):
+    '''
+    Creates a `dplib.Component` from a system (as JSON). The same system is only compiled once per process.
+    '''
+    return make_component(json.loads(system))
+
+def run_component(system, df, kpis, mappings, previous_result, frame_counter):
+    component = get_component(system)
+    return component.run(df, kpis, mappings, previous_result=previous_result,
+                         additional_builtins={ 'GET_FRAME_COUNT': lambda: frame_counter })
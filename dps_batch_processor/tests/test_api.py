@@ -0,0 +1,48 @@
+import asyncio
+from unittest import TestCase
+from datetime import datetime
+
+import pandas as pd
+
+from dps_batch_processor.api import DatabaseManagerAPIClient, MAX_RETRIES
+
+class MockResponse:
+    def __init__(self, status, text='{}'):
+        self.status = status
+        self.headers = { 'Retry-After': '0' }
+        self._text = text
+
+    async def text(self):
+        return self._text
+
+class MockSession:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.posts = []
+
+    async def post(self, url, json, headers):
+        self.posts.append(url)
+        return MockResponse(self.statuses.pop(0) if self.statuses else 200)
+
+class MockDataset:
+    def __init__(self):
+        self.dataset = { 'Va': None }
+
+    def to_dataframe(self):
+        return pd.DataFrame({ 'Va': [1.0] }, index=[datetime(2020, 1, 1)])
+
+class TestAPI(TestCase):
+    def test_send_data_retries(self):
+        dbc = DatabaseManagerAPIClient('http://dbm', 'key')
+        # Inserts refused while the insert queue is full are sent again.
+        session = MockSession([429, 429])
+        self.assertEqual(asyncio.run(dbc.send_data(session, 'batch_process1', MockDataset())), {})
+        self.assertEqual(session.posts, ['http://dbm/api/v1/insert'] * 3)
+
+        # Inserts that are never written raise (instead of being lost without an error).
+        session = MockSession([429] * MAX_RETRIES)
+        with self.assertRaisesRegex(Exception, 'status 429'):
+            asyncio.run(dbc.send_data(session, 'batch_process1', MockDataset()))
+        self.assertEqual(len(session.posts), MAX_RETRIES)
+        with self.assertRaisesRegex(Exception, 'status 400'):
+            asyncio.run(dbc.send_data(MockSession([400]), 'batch_process1', MockDataset()))
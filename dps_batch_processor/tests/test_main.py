@@ -0,0 +1,82 @@
+import asyncio
+from unittest import TestCase
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import dps_services.util as ddt
+
+from dps_batch_processor.main import process_job
+from dps_batch_processor.logger import Logger
+from dps_batch_processor.api import STATUS_RUNNING, STATUS_COMPLETE
+
+START = datetime(2020, 1, 1)
+TIMES = [START + timedelta(seconds=i) for i in range(4)]
+SAMPLES = 4
+RESULT_ID = 7
+
+JOB = {
+    'batch_process_id': 3,
+    'batch_process': {
+        'system': {
+            'kpis': [{ 'name': 'Average', 'identifier': '', 'computation': 'avg(A)' }],
+            'parameters': [],
+        },
+        'kpis': ['Average'],
+        'mappings': [{ 'key': 'A', 'value': 'Va' }],
+        'interval': {
+            'start': ddt.format_datetime(TIMES[0]),
+            'end': ddt.format_datetime(TIMES[-1] + timedelta(seconds=1)),
+        },
+        'dataset': 'dataset',
+        'use_date_range': True,
+    },
+}
+
+class MockDPSManagerAPIClient:
+    def __init__(self):
+        self.results = []
+
+    async def send_result(self, session, kpis, batch_process_id, aggregations, inter_results, chartables,
+                          status=0, message=None, result_id=None, processed_samples=None, total_samples=None):
+        self.results.append({
+            'batch_process_id': batch_process_id,
+            'status': status,
+            'message': message,
+            'result_id': result_id,
+            'processed_samples': processed_samples,
+            'total_samples': total_samples,
+        })
+        return { 'result_id': RESULT_ID }
+
+class MockDatabaseManagerAPIClient:
+    async def get_count(self, session, dataset, signals, start_time, end_time):
+        return { 'results': [{ 'values': [SAMPLES] }] }
+
+    async def get_data(self, session, dataset, signals, start_time, end_time, limit=None, columnar=False, binary=False,
+                       paginate=False, after=None):
+        return { 'results': [{
+            'times': np.array([ddt.datetime_to_epoch_ns(time) for time in TIMES], dtype='int64'),
+            'values': np.arange(SAMPLES, dtype='float64'),
+            'query': { 'paginate': True },
+        }] }
+
+    async def send_data(self, session, dataset_name, dataset):
+        return {}
+
+class TestProcessJob(TestCase):
+    def test_process_job_sends_results(self):
+        api = MockDPSManagerAPIClient()
+        asyncio.run(process_job(api, Logger(False), None, JOB, MockDatabaseManagerAPIClient(), max_batch_size=100))
+
+        self.assertEqual([result['status'] for result in api.results],
+                         [STATUS_RUNNING, STATUS_RUNNING, STATUS_RUNNING, STATUS_COMPLETE])
+        # The first result is created before the result ID is known.
+        self.assertEqual(api.results[0]['result_id'], None)
+        # Every result after that (including the intermediate results uploaded during the pipeline) updates it.
+        for result in api.results[1:]:
+            self.assertEqual(result['batch_process_id'], 3)
+            self.assertEqual(result['result_id'], RESULT_ID)
+            self.assertEqual(result['processed_samples'], SAMPLES)
+            self.assertEqual(result['total_samples'], SAMPLES)
+            self.assertEqual(result['message'], None)
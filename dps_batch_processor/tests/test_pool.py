@@ -0,0 +1,52 @@
+import asyncio
+from unittest import TestCase
+from datetime import datetime, timedelta
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from dps_batch_processor.pool import ComponentPool
+from dps_batch_processor.util import make_component
+
+SYSTEM = {
+    'kpis': [
+        { 'name': 'Power', 'identifier': '', 'computation': 'Va * Ia' },
+        { 'name': 'Average Power', 'identifier': '', 'computation': 'avg(Power)' },
+        { 'name': 'Max Va', 'identifier': '', 'computation': 'max(Va)' },
+    ],
+    'parameters': [],
+}
+KPIS = ['Power', 'Average Power', 'Max Va']
+MAPPINGS = { 'Va': 'Va', 'Ia': 'Ia' }
+
+def make_windows():
+    start = datetime(2020, 1, 1)
+    windows = []
+    for i in range(3):
+        times = [start + timedelta(seconds=10 * i + j) for j in range(10)]
+        windows.append(pd.DataFrame({ 'Va': [float(10 * i + j) for j in range(10)],
+                                      'Ia': [float(j % 3) for j in range(10)] },
+                                    index=pd.DatetimeIndex(times)))
+    return windows
+
+class TestComponentPool(TestCase):
+    def test_run_matches_component_run(self):
+        component = make_component(SYSTEM)
+        expected = None
+        for df in make_windows():
+            expected = component.run(df, KPIS, MAPPINGS, previous_result=expected)
+
+        async def run_in_pool():
+            pool = ComponentPool(1)
+            try:
+                result = None
+                for df in make_windows():
+                    result = await pool.run(SYSTEM, df, KPIS, MAPPINGS, result, 0)
+                return result
+            finally:
+                pool.shutdown()
+        result = asyncio.run(run_in_pool())
+
+        self.assertEqual(result.get_aggregations_for_ui(), expected.get_aggregations_for_ui())
+        assert_frame_equal(result.get_dataframe(), expected.get_dataframe())
+        self.assertEqual(len(result.get_dataframe()), 30)
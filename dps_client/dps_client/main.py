@@ -1,5 +1,6 @@
 '''DPS Client - A client for communicating with the DPS Manager, and sending signal data.'''
 import math
+import time
 
 import requests
 import pandas as pd
@@ -19,6 +20,11 @@ The datetime format used in JSON requests.
 Example: 2020-06-30 03:54:45.175489 means June 30th, 2020 at 3:54:45AM and 175489 microseconds.
 '''
 
+MAX_INSERT_RETRIES = 10
+'''
+How many times an insert is sent again when the Database Manager's insert queue is full (HTTP 429).
+'''
+
 class Client:
     '''
     A connection to the DPS Database Manager.
@@ -166,7 +172,7 @@ class Client:
                 batch_request.value.extend(batch)
 
             pb_string = inserts_request.SerializeToString()
-            response = requests.post(url, data=pb_string, headers={
+            response = _post(url, data=pb_string, headers={
                 'Content-Type': 'application/protobuf',
                 'Authorization': 'API ' + self.api_key,
             })
@@ -177,7 +183,7 @@ class Client:
             return response
         elif self.protocol == 'json':
             o = self._flush()
-            response = requests.post(url, json={
+            response = _post(url, json={
                 'upsert': upsert,
                 'inserts': [
                     o
@@ -202,6 +208,17 @@ class BatchClient:
     def add(self, signal_name, value):
         self.signal_name_to_value[signal_name] = value
 
+def _post(url, **kwargs):
+    '''
+    Posts to the Database Manager, and waits to post again while it is refusing inserts because its insert queue is full.
+    '''
+    for _ in range(MAX_INSERT_RETRIES):
+        response = requests.post(url, **kwargs)
+        if response.status_code != 429:
+            break
+        time.sleep(float(response.headers.get('Retry-After', 1)))
+    return response
+
 def _normalize_url(url):
     if url[-1] != '/':
         url += '/'
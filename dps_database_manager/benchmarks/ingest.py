@@ -0,0 +1,84 @@
+'''
+Benchmark of inserting samples with COPY in the text format and in the binary format.
+
+Measures rows (samples) per second of encoding 100,000 times of 1, 10 and 100 signals, and (if a database
+is reachable with the TSDB_* environment variables) of copying them into a temporary copy of `signal_data`:
+
+    python benchmarks/ingest.py
+'''
+
+import os
+import sys
+import time
+from io import StringIO
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'dps_database_manager'))
+
+from copy_encoders import encode_text_copy, encode_binary_copy, make_binary_copy_stream
+
+TIMES = 100000
+SIGNALS = [1, 10, 100]
+
+def make_insert(signals):
+    rng = np.random.default_rng(0)
+    start = datetime(2020, 1, 1)
+    times = [start + timedelta(microseconds=100 * i) for i in range(TIMES // signals)]
+    batches = rng.normal(size=(len(times), signals)).tolist()
+    return list(range(1, signals + 1)), batches, times
+
+def measure(f, repeat=3):
+    '''
+    Returns the best time (in seconds) of calling `f` `repeat` times.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def connect():
+    try:
+        import psycopg2
+        from config import CONNECTION
+        return psycopg2.connect(CONNECTION)
+    except Exception as e:
+        print(f'Only measuring encoding (could not connect to the database: {e})'.strip())
+        return None
+
+def copy_text(conn, signal_ids, batches, times):
+    with conn.cursor() as cursor:
+        cursor.execute('CREATE TEMP TABLE ingest_benchmark (LIKE signal_data) ON COMMIT DROP')
+        cursor.copy_from(StringIO(encode_text_copy(signal_ids, batches, times)), 'ingest_benchmark',
+                         columns=('signal_id', 'time', 'value'))
+    conn.commit()
+
+def copy_binary(conn, signal_ids, batches, times):
+    with conn.cursor() as cursor:
+        cursor.execute('CREATE TEMP TABLE ingest_benchmark (LIKE signal_data) ON COMMIT DROP')
+        cursor.copy_expert('COPY ingest_benchmark (signal_id, time, value) FROM STDIN (FORMAT binary)',
+                           make_binary_copy_stream(signal_ids, batches, times))
+    conn.commit()
+
+def main():
+    conn = connect()
+    for signals in SIGNALS:
+        signal_ids, batches, times = make_insert(signals)
+        rows = len(times) * signals
+        runs = {
+            'text encode':   lambda: encode_text_copy(signal_ids, batches, times),
+            'binary encode': lambda: b''.join(encode_binary_copy(signal_ids, batches, times)),
+        }
+        if conn is not None:
+            runs['text copy'] = lambda: copy_text(conn, signal_ids, batches, times)
+            runs['binary copy'] = lambda: copy_binary(conn, signal_ids, batches, times)
+        for name, f in runs.items():
+            elapsed = measure(f)
+            print(f'{signals:>3} signals  {name:<13} {rows / elapsed:12,.0f} rows/s')
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,19 @@
 import sys
 from datetime import datetime
-from io import StringIO
 import itertools
-import math
 import requests
 
 from flask import Flask
 
 from sqlalchemy import and_, not_
-from sqlalchemy.sql import func
 from expiringdict import ExpiringDict
 
 import dps_services.database_manager as dbm
 import dps_services.util as util
 from db import *
+from copy_encoders import make_binary_copy_stream
+from signal_ranges import get_signal_ranges, update_signal_ranges
+from queries import make_pivot_query, make_aggregate_query, make_bucket_query, ROLLUPS
 from config import DEBUG
 
 dbc = None
@@ -41,43 +41,23 @@ class TimescaleDBDataStore(dbm.DataStore):
 
         I did some simple testing on my desktop, and found that upserting has an overhead of 20% - 30%.
         '''
-        with dbc.scope() as session:
-            dataset = dbc.get_dataset_by_name(dataset_name)
-            # If the dataset, doesn't exist in the database, create it and continue.
-            if dataset is None:
-                dataset = Dataset(name=dataset_name)
-                dbc.add(session, dataset)
-                session.commit()
-
-            signals = []
-            for signal_name in signal_names:
-                signal = dbc.get_signal_by_name_and_dataset_id(signal_name, dataset.dataset_id)
-                # If any of the signals, don't exist in the database, create it and continue.            
-                if signal is None:
-                    signal = Signal(dataset_id=dataset.dataset_id, name=signal_name)
-                    dbc.add(session, signal)
-                    session.commit()
-                signals.append(signal)
-
-            # I think this is the fastest way to generate the string we need
-            # List comprehensions are fast (faster than loops):
-            signal_datas = ''.join(
-                (''.join((f'{signals[j].signal_id}\t{times[i]}\t{sample}\n' for j, sample in enumerate(batch) if sample is not None and not math.isnan(sample))))
-                for i, batch in enumerate(batches))
-
-            conn = dbc.psycopg2_connpool.getconn()
-            try:
-                cursor = conn.cursor()
-                if upsert:
-                    self.UPSERT_QUERY.execute(cursor, StringIO(signal_datas))
-                else:
-                    # copy_from is the fastest way to insert bulk data into postgres
-                    # it might be even faster to use a binary stream instead of a string stream
-                    # but I didn't bother writing that.
-                    cursor.copy_from(StringIO(signal_datas), 'signal_data', columns=('signal_id', 'time', 'value'))                
-                conn.commit()
-            finally:
-                dbc.psycopg2_connpool.putconn(conn)
+        # Create the dataset and any signals that don't exist yet (all of the signals at once).
+        dataset = dbc.get_or_create_dataset(dataset_name)
+        signals = dbc.get_or_create_signals(dataset.dataset_id, signal_names)
+
+        # COPY is the fastest way to insert bulk data into postgres, and the binary format
+        # is encoded straight from NumPy arrays (one chunk of samples at a time).
+        signal_ids = [signal.signal_id for signal in signals]
+        with dbc.connection() as conn:
+            cursor = conn.cursor()
+            if upsert:
+                self.UPSERT_QUERY.execute(cursor, make_binary_copy_stream(signal_ids, batches, times), binary=True)
+            else:
+                cursor.copy_expert('COPY signal_data (signal_id, time, value) FROM STDIN (FORMAT binary)',
+                                   make_binary_copy_stream(signal_ids, batches, times))
+            if dbc.has_signal_ranges:
+                update_signal_ranges(cursor, get_signal_ranges(signal_ids, batches, times))
+            conn.commit()
 
     def get_signal_names(self, result, dataset_name, query, limit, offset):
         if dataset_name is not None:
@@ -96,37 +76,19 @@ class TimescaleDBDataStore(dbm.DataStore):
             result.set_total(q.count())
 
     def get_dataset_range(self, result, dataset_name):
+        '''
+        Gets the times of the first and last datapoints of all of the signals in the dataset (with one query).
+        '''
+        dataset_id = None
         if dataset_name is not None:
             dataset = dbc.get_cached_dataset(dataset_name, error_on_not_found=False)
             if not dataset:
                 return
-        signal_names = []
-        with dbc.scope() as session:
-            q = session.query(Signal)
-            if dataset_name is not None:
-                q = q.filter_by(dataset_id=dataset.dataset_id)
-            q = q.order_by(Signal.name)
-            for signal in q.all():
-                if dataset_name == None or signal.dataset_id == dataset.dataset_id:
-                    signal_names.append(signal.name)
-        signal_ids = list(map(lambda x: dbc.get_cached_signal(x, dataset.dataset_id).signal_id, signal_names))
-
-        first = None
-        last = None
-
-        for signal_id in signal_ids:
-            temp_first = session.query(func.min(SignalData.time)).filter(SignalData.signal_id == signal_id).one()
-            if first == None or (temp_first != None and len(temp_first) > 0 and temp_first[0] < first):
-                first = temp_first[0]
-            temp_last = session.query(func.max(SignalData.time)).filter(SignalData.signal_id == signal_id).one()
-            if last == None or (temp_last != None and len(temp_last) > 0 and temp_last[0] > last):
-                last = temp_last[0]
-
-        result.set_first(first)
-        result.set_last(last)
-        print('get-dataset-range')
-        print(first)
-        print(last)
+            dataset_id = dataset.dataset_id
+        ranges = [(first, last) for first, last, count in fetch_signal_ranges(dataset_id=dataset_id).values()]
+        if ranges:
+            result.set_first(min(first for first, last in ranges))
+            result.set_last(max(last for first, last in ranges))
 
     def get_dataset_names(self, result, query, limit, offset):
         with dbc.scope() as session:
@@ -139,6 +101,36 @@ class TimescaleDBDataStore(dbm.DataStore):
         '''
         Gets the times of the first and last datapoints for the signal.
         '''
+        self.get_ranges([result], [(dataset_name, signal_name)])
+
+    def get_ranges(self, results, signals):
+        '''
+        Gets the times of the first and last datapoints (and the number of datapoints, if it is known)
+        for each signal (with one query).
+        '''
+        signal_ids = []
+        for dataset_name, signal_name in signals:
+            if dataset_name is None:
+                dataset_id = None
+            else:
+                ds = dbc.get_cached_dataset(dataset_name, error_on_not_found=False)
+                if not ds: # Signals of datasets that don't exist have no range.
+                    signal_ids.append(None)
+                    continue
+                dataset_id = ds.dataset_id
+            signal_ids.append(dbc.get_cached_signal(signal_name, dataset_id).signal_id)
+
+        ranges = fetch_signal_ranges([signal_id for signal_id in signal_ids if signal_id is not None])
+        for result, signal_id in zip(results, signal_ids):
+            if signal_id not in ranges:
+                continue
+            first, last, count = ranges[signal_id]
+            result.set_first(first)
+            result.set_last(last)
+            if count is not None:
+                result.set_count(count)
+
+    def fetch_signals(self, result, dataset_name, signal_names, interval, limit):
         if dataset_name is None:
             dataset_id = None
         else:
@@ -146,27 +138,94 @@ class TimescaleDBDataStore(dbm.DataStore):
             if not ds:
                 return
             dataset_id = ds.dataset_id
-        signal = dbc.get_cached_signal(signal_name, dataset_id)
-        if not signal:
-            print('signal did not exist ', signal)
+        signal_ids = list(map(lambda x: dbc.get_cached_signal(x, dataset_id).signal_id, signal_names))
+
+        if not signal_ids:
             return
-        signal_id = signal.signal_id
 
-        # Get all signal_data within the time interval ordered by time (ascending).
-        # We have to take this data and batch all values that share a timestamp together (in increasing time order).
-        with dbc.scope() as session:
-            firstQ = self.time_filter(session.query(SignalData.time), None, [signal_id]).order_by(SignalData.time.asc()).limit(1)
-            first = firstQ.all()[0]
-            if not first: # If there are no records, quit early.
+        # Get all signal_data within the time interval ordered by time (ascending) and pivot it in the database,
+        # so that each row has the time, and one column for each signal (NULL when the signal has no sample at that time).
+        # The limit applies to the number of samples (not the number of rows).
+        query = result.query
+        if query.paginate and limit:
+            self.fetch_page(result, signal_ids, interval, limit, query.after)
+            return
+        with dbc.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*make_pivot_query(signal_ids, interval, limit))
+            for row in cursor:
+                result.add(list(row[1:]), row[0])
+            conn.commit()
+
+    def fetch_page(self, result, signal_ids, interval, limit, after):
+        '''
+        Fetches one page of samples that come after the sample (time, signal_id) in the continuation token `after`.
+        The page only ends on a complete time (every signal's sample at that time is in the same page).
+        Seeking to the last sample (instead of using OFFSET) means every page is as fast as the first.
+
+        The limit is at least the number of signals, so that a page that only has one time has all of its samples
+        (otherwise the next page would start in the middle of that time, and have another row with the same time).
+        '''
+        limit = max(limit, len(set(signal_ids)))
+        if after is not None:
+            after = dbm.load_continuation_token(after)
+        with dbc.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*make_pivot_query(signal_ids, interval, limit, after=after, keyset=True))
+            rows = cursor.fetchall()
+            conn.commit()
+
+        n = len(signal_ids)
+        # There are more samples if the page is full. Its last time may be missing some of its samples,
+        # so leave it for the next page (unless it is the only time, which is complete because of the limit).
+        has_more = sum(row[n + 2] for row in rows) >= limit
+        if has_more and len(rows) > 1:
+            rows = rows[:-1]
+        for row in rows:
+            result.add(list(row[1:n + 1]), row[0])
+        if has_more:
+            last = rows[-1]
+            result.set_next(dbm.dump_continuation_token(last[0], last[n + 1]))
+
+    def stream_signals(self, query, chunk_size):
+        '''
+        Reads the samples with a server-side (named) cursor, so only `chunk_size` rows (times) are in memory at once.
+        '''
+        if query.dataset is None:
+            dataset_id = None
+        else:
+            ds = dbc.get_cached_dataset(query.dataset, error_on_not_found=False)
+            if not ds:
                 return
-            
-            lastQ = self.time_filter(session.query(SignalData.time), None, [signal_id]).order_by(SignalData.time.desc()).limit(1)
-            last = lastQ.all()[0]
-            
-            result.set_first(first.time)
-            result.set_last(last.time)
+            dataset_id = ds.dataset_id
+        signal_ids = list(map(lambda x: dbc.get_cached_signal(x, dataset_id).signal_id, query.signals))
 
-    def fetch_signals(self, result, dataset_name, signal_names, interval, limit):
+        if not signal_ids:
+            return
+
+        with dbc.connection() as conn:
+            try:
+                cursor = conn.cursor(name='stream_signals')
+                cursor.itersize = chunk_size
+                cursor.execute(*make_pivot_query(signal_ids, query.interval, query.limit))
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    result = dbm.SignalQueryResult(query)
+                    for row in rows:
+                        result.add(list(row[1:]), row[0])
+                    yield result
+                cursor.close()
+            finally:
+                # Named cursors only exist inside of a transaction (which is only for reading).
+                # This also ends the transaction if the client stopped reading early.
+                conn.rollback()
+
+    def aggregate_signals(self, result, dataset_name, signal_names, interval, aggregation):
+        '''
+        Aggregates every signal (with every aggregation, if `aggregation` is a list) in one scan.
+        '''
         if dataset_name is None:
             dataset_id = None
         else:
@@ -176,35 +235,26 @@ class TimescaleDBDataStore(dbm.DataStore):
             dataset_id = ds.dataset_id
         signal_ids = list(map(lambda x: dbc.get_cached_signal(x, dataset_id).signal_id, signal_names))
 
-        # Get all signal_data within the time interval ordered by time (ascending).
-        # We have to take this data and batch all values that share a timestamp together (in increasing time order).
-        with dbc.scope() as session:
-            q = self.time_filter(session.query(SignalData), interval, signal_ids).order_by(SignalData.time.asc())
-            if limit:
-                q = q.limit(limit)
-            signal_datas = q.all()
-
-        if not signal_datas:
+        if not signal_ids:
             return
 
-        buffer = []
-        previous_time = signal_datas[0].time
-        for i, signal_data in enumerate(signal_datas):
-            # If the time has changed, or if this is the last batch,
-            # flush the buffer (call result.add(frame, time) with it)
-            if signal_data.time != previous_time:
-                flush_buffer(result, buffer, previous_time, signal_ids)
-                previous_time = signal_data.time
-                buffer = [signal_data]
-            else:
-                # When the time value doesn't change since the last one,
-                # append the data to the buffer (so it can all be sent
-                # with the same time value).
-                buffer.append(signal_data)
-        if buffer:
-            flush_buffer(result, buffer, previous_time, signal_ids)
+        aggregations = aggregation if isinstance(aggregation, list) else [aggregation]
+        with dbc.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*make_aggregate_query(signal_ids, interval, aggregations))
+            rows = { row[0]: list(row[1:]) for row in cursor }
+            conn.commit()
 
-    def aggregate_signals(self, result, dataset_name, signal_names, interval, aggregation):
+        for signal_id, signal_name in zip(signal_ids, signal_names):
+            # Signals without samples in the interval have no row (their count is 0, and the others are NULL).
+            values = rows.get(signal_id, [0 if x == 'count' else None for x in aggregations])
+            result.set(signal_name, values if isinstance(aggregation, list) else values[0])
+
+    def aggregate_buckets(self, result, dataset_name, signal_names, interval, aggregation, bucket):
+        '''
+        Aggregates every bucket of every signal in one scan (with TimescaleDB's `time_bucket`),
+        from the coarsest rollup that fits the buckets (or from the samples, if none of them do).
+        '''
         if dataset_name is None:
             dataset_id = None
         else:
@@ -214,54 +264,58 @@ class TimescaleDBDataStore(dbm.DataStore):
             dataset_id = ds.dataset_id
         signal_ids = list(map(lambda x: dbc.get_cached_signal(x, dataset_id).signal_id, signal_names))
 
-        # Get the correct SQLAlchemy functions for each of the "aggregation" directives
-        # Complete list is: max, min, average, and count.
-        f = None
-        if aggregation == 'max':
-            f = func.max
-        elif aggregation == 'min':
-            f = func.min
-        elif aggregation == 'average':
-            f = func.avg
-        elif aggregation == 'count':
-            f = func.count
-        else:
-            raise Exception(f'aggregate_signals was given an unsupported aggregation of "{aggregation}".')
-
-        with dbc.scope() as session:
-            for signal_id, signal_name in zip(signal_ids, signal_names):
-                signal_datas = session.query(f(SignalData.value)).filter(SignalData.signal_id == signal_id)
-                result.set(signal_name, self.time_filter(signal_datas, interval, signal_ids).scalar())
+        if not signal_ids:
+            return
 
-    def time_filter(self, query, interval, signal_ids):
-        if interval:
-            return query.filter(and_(SignalData.time >= interval.start, SignalData.time <= interval.end, SignalData.signal_id.in_(signal_ids)))
-        else:
-            return query.filter(and_(SignalData.signal_id.in_(signal_ids)))            
+        with dbc.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(*make_bucket_query(signal_ids, interval, aggregation, bucket, dbc.rollups))
+            for row in cursor:
+                result.add(list(row[1:]), row[0])
+            conn.commit()
 
     def delete_dataset(self, dataset_name):
         dbc.delete_dataset(dataset_name)
 
-# A helper function used for `fetch_signals`
-def flush_buffer(result, buffer, previous_time, signal_ids):
-    frame = []
-    for signal_id in signal_ids:
-        # Search if the signal is present in the buffer, if it is, that
-        # means there is a value we must send for that signal.
-        # Otherwise if the signal isn't present, send a None.
-        signal_existed = False
-        for signal in buffer: # If the signal is in the buffer (there was data for this signal at this time)
-            if signal.signal_id == signal_id:
-                frame.append(signal.value)
-                signal_existed = True 
-                break
-        if not signal_existed:
-            frame.append(None) # Add None to indicate that this signal had no sample for this time
-    result.add(frame, previous_time)
+def fetch_signal_ranges(signal_ids=None, dataset_id=None):
+    '''
+    Returns a dictionary of each signal ID (that has samples) to its (first time, last time, count),
+    for the signals in `signal_ids`, or all of the signals of a dataset (if `dataset_id` is given instead).
+
+    The ranges are read from `signal_ranges`. If the database doesn't have it, the first and last times are found
+    with the (signal_id, time) indices instead, and the count is None.
+    '''
+    if signal_ids is not None:
+        if not signal_ids:
+            return {}
+        signals, params = 'SELECT unnest(%s) AS signal_id', [list(set(signal_ids))]
+    elif dataset_id is not None:
+        signals, params = 'SELECT signal_id FROM signals WHERE dataset_id = %s', [dataset_id]
+    else:
+        signals, params = 'SELECT signal_id FROM signals', []
+    if dbc.has_signal_ranges:
+        sql = f'SELECT signal_id, first, last, count FROM signal_ranges WHERE signal_id IN ({signals})'
+    else:
+        sql = f'''
+            SELECT signal_id,
+                   (SELECT time FROM signal_data d WHERE d.signal_id = s.signal_id ORDER BY time ASC LIMIT 1),
+                   (SELECT time FROM signal_data d WHERE d.signal_id = s.signal_id ORDER BY time DESC LIMIT 1),
+                   NULL
+            FROM ({signals}) AS s
+        '''
+    with dbc.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        ranges = { row[0]: tuple(row[1:]) for row in cursor if row[1] is not None }
+        conn.commit()
+    return ranges
 
 def make_app():
     global dbc
     dbc = DatabaseClient()
+    dbc.find_rollups(ROLLUPS)
+    dbc.find_signal_ranges()
+    dbc.find_unique_names()
     app = Flask(__name__)
     return dbm.init_app(app, TimescaleDBDataStore, DEBUG)
 
@@ -6,5 +6,7 @@ URL        = os.getenv('TSDB_URL', 'localhost')
 PORT       = os.getenv('TSDB_PORT', 5432)
 DATABASE   = os.getenv('TSDB_DATABASE', 'postgres')
 DEBUG      = bool(os.getenv('DBM_DEBUG'))
+POOL_SIZE    = int(os.getenv('TSDB_POOL_SIZE', 10))      # The most database connections used by queries and inserts at once
+POOL_TIMEOUT = float(os.getenv('TSDB_POOL_TIMEOUT', 30)) # How many seconds a request waits for a connection when they are all in use
 CONNECTION = f'postgresql://{USERNAME}:{PASSWORD}@{URL}:{PORT}/{DATABASE}' \
     if PASSWORD else f'postgresql://{USERNAME}@{URL}:{PORT}/{DATABASE}'
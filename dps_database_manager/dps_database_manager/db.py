@@ -1,14 +1,22 @@
+import threading
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine, Table, Column, Integer, Float, DateTime, String, ForeignKey
+from sqlalchemy import create_engine, Table, Column, Integer, BigInteger, Float, DateTime, String, ForeignKey
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 import psycopg2
-from psycopg2.pool import SimpleConnectionPool        
+from psycopg2.pool import ThreadedConnectionPool
+from expiringdict import ExpiringDict
 
-from config import CONNECTION
+from config import CONNECTION, POOL_SIZE, POOL_TIMEOUT
+
+MISSING_MAX_AGE = 10
+'''
+How long (in seconds) a signal or dataset that doesn't exist is remembered as missing,
+before the database is asked for it again (it may have been created by another Database Manager).
+'''
 
 Base = declarative_base()
 
@@ -29,68 +37,275 @@ class SignalData(Base):
     value = Column(Float())
     time = Column(DateTime(), primary_key=True)
 
+class SignalRange(Base):
+    __tablename__ = 'signal_ranges'
+    signal_id = Column(Integer, ForeignKey('signals.signal_id'), primary_key=True)
+    first = Column(DateTime())
+    last = Column(DateTime())
+    count = Column(BigInteger())
+
+class BlockingConnectionPool:
+    '''
+    Wraps a psycopg2 pool of at most `size` connections, so that borrowing a connection while they are all in use
+    waits (for at most `timeout` seconds) for one to be given back, instead of raising a PoolError right away.
+    '''
+    def __init__(self, pool, size, timeout):
+        self.pool = pool
+        self.available = threading.BoundedSemaphore(size)
+        self.timeout = timeout
+
+    def getconn(self):
+        if not self.available.acquire(timeout=self.timeout):
+            raise Exception(f'Timed out after {self.timeout} seconds waiting for a database connection (all of them are in use).')
+        try:
+            return self.pool.getconn()
+        except:
+            self.available.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            self.pool.putconn(conn)
+        finally:
+            self.available.release()
+
 class DatabaseClient:
     def __init__(self):
         self.engine = create_engine(CONNECTION, echo=False)
         self.Session = sessionmaker(bind=self.engine, autoflush=False, expire_on_commit=False)
 
         # Keep a direct database driver connection for inserts (high speed)
-        self.psycopg2_connpool = SimpleConnectionPool(1, 10, dsn=CONNECTION)
+        # (requests are handled on many threads, so the pool must be thread-safe).
+        # Streamed queries hold a connection until they are sent, so requests wait for a connection
+        # when they are all in use (instead of failing).
+        self.psycopg2_connpool = BlockingConnectionPool(ThreadedConnectionPool(1, POOL_SIZE, dsn=CONNECTION),
+                                                        POOL_SIZE, POOL_TIMEOUT)
 
         # Keep caches for datasets and signals to avoid database lookups.
+        # The caches are dictionaries (so lookups take constant time), and are shared by every request's thread.
+        self.lock = threading.RLock()
         self.cache()
 
+        self.rollups = []
+        self.has_signal_ranges = False
+        self.has_unique_names = False
+
+    def table_exists(self, table):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT to_regclass(%s)', (table,))
+            exists = cursor.fetchone()[0] is not None
+            conn.commit()
+        return exists
+
+    def find_rollups(self, rollups):
+        '''
+        Keeps the rollups (a list of (table, bucket width)) which exist in the database
+        (databases created before the rollups were added to schema.sql don't have them).
+        '''
+        self.rollups = [(table, width) for table, width in rollups if self.table_exists(table)]
+
+    def find_signal_ranges(self):
+        '''
+        Checks if the database has the `signal_ranges` table (databases created before it was added to schema.sql don't).
+        '''
+        self.has_signal_ranges = self.table_exists(SignalRange.__tablename__)
+
+    def unique_index_exists(self, table, columns):
+        '''
+        Checks if `table` has a unique index (or a unique constraint) on exactly `columns` (in any order).
+        '''
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_index i
+                    WHERE i.indrelid = to_regclass(%s) AND i.indisunique
+                      AND ARRAY(SELECT a.attname::text
+                                FROM unnest(i.indkey::int2[]) k(attnum)
+                                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                                ORDER BY a.attname) = %s::text[])
+            ''', (table, sorted(columns)))
+            exists = cursor.fetchone()[0]
+            conn.commit()
+        return exists
+
+    def find_unique_names(self):
+        '''
+        Checks if dataset names, and the signal names of each dataset, are unique, which creating them with ON CONFLICT needs
+        (databases created before the constraints were added to schema.sql don't have them, and may have duplicate names).
+        '''
+        self.has_unique_names = self.unique_index_exists(Dataset.__tablename__, ['name']) and \
+                                self.unique_index_exists(Signal.__tablename__, ['dataset_id', 'name'])
+
     def cache(self):
+        '''
+        Loads every signal and dataset into the cache.
+        '''
         with self.scope() as session:
-            self.signals = session.query(Signal).all()
-            self.datasets = session.query(Dataset).all()            
+            signals = session.query(Signal).all()
+            datasets = session.query(Dataset).all()
+        with self.lock:
+            self.signals_by_key = {}
+            self.signals_by_name = {}
+            self.datasets_by_name = {}
+            self.missing = ExpiringDict(max_len=10000, max_age_seconds=MISSING_MAX_AGE)
+            for signal in signals:
+                self.index_signal(signal)
+            for dataset in datasets:
+                self.index_dataset(dataset)
+
+    def index_signal(self, signal):
+        self.signals_by_key[(signal.dataset_id, signal.name)] = signal
+        # Signals looked up without a dataset get the first signal with the name.
+        self.signals_by_name.setdefault(signal.name, signal)
+        self.missing.pop(('signal', signal.dataset_id, signal.name), None)
+        self.missing.pop(('signal', None, signal.name), None)
+
+    def index_dataset(self, dataset):
+        self.datasets_by_name[dataset.name] = dataset
+        self.missing.pop(('dataset', dataset.name), None)
+
+    def lookup(self, key, cached, load):
+        '''
+        Returns the object from `cached()`. If it isn't cached, it is loaded from the database with `load()` (and cached),
+        unless it was recently found not to exist (so that a missing signal doesn't query the database every time).
+        '''
+        obj = cached()
+        if obj is not None:
+            return obj
+        with self.lock:
+            obj = cached()
+            if obj is not None or key in self.missing:
+                return obj
+            obj = load()
+            if obj is None:
+                self.missing[key] = True
+            elif isinstance(obj, Dataset):
+                self.index_dataset(obj)
+            else:
+                self.index_signal(obj)
+            return obj
+
+    def load(self, Model, **filters):
+        with self.scope() as session:
+            return session.query(Model).filter_by(**filters).order_by(next(iter(Model.__table__.primary_key))).first()
+
+    def get_signal(self, signal_name, dataset_id):
+        if dataset_id is None:
+            return self.lookup(('signal', None, signal_name),
+                               lambda: self.signals_by_name.get(signal_name),
+                               lambda: self.load(Signal, name=signal_name))
+        return self.lookup(('signal', dataset_id, signal_name),
+                           lambda: self.signals_by_key.get((dataset_id, signal_name)),
+                           lambda: self.load(Signal, name=signal_name, dataset_id=dataset_id))
 
     def get_cached_signal(self, signal_name, dataset_id):
-        def lookup():
-            for signal in self.signals:
-                if signal.name == signal_name and (dataset_id is None or signal.dataset_id == dataset_id):
-                    return signal
-        signal = lookup()
+        signal = self.get_signal(signal_name, dataset_id)
         if signal:
             return signal
-        # If signal not found in cache, refresh the cache.
-        self.cache()
-        signal = lookup()
-        if signal:
-            return signal
-        # If the signal is still not found, error.
         raise Exception(f'Signal "{signal_name}" does not exist.')
 
     def get_cached_dataset(self, dataset_name, filter_func=None, error_on_not_found=True):
         if filter_func is None:
-            filter_func = lambda dataset, name: dataset.name == dataset_name
-        def lookup():
-            for dataset in self.datasets:
-                if filter_func(dataset, dataset_name):
-                    return dataset
-        dataset = lookup()
-        if dataset:
-            return dataset
-        # If signal not found in cache, refresh the cache.
-        self.cache()        
-        dataset = lookup()
+            dataset = self.get_dataset_by_name(dataset_name)
+        else:
+            # Datasets can only be looked up by name in constant time.
+            with self.lock:
+                datasets = list(self.datasets_by_name.values())
+            dataset = next((dataset for dataset in datasets if filter_func(dataset, dataset_name)), None)
         if dataset:
             return dataset
-        # If the signal is still not found, error.
         if error_on_not_found:
             raise Exception(f'Dataset "{dataset_name}" does not exist.')
 
     def get_dataset_by_name(self, dataset_name):
-        for dataset in self.datasets:
-            if dataset.name == dataset_name:
-                return dataset
-        return None
+        return self.lookup(('dataset', dataset_name),
+                           lambda: self.datasets_by_name.get(dataset_name),
+                           lambda: self.load(Dataset, name=dataset_name))
 
     def get_signal_by_name_and_dataset_id(self, signal_name, dataset_id):
-        for signal in self.signals:
-            if signal.dataset_id == dataset_id and signal.name == signal_name:
-                return signal
-        return None
+        return self.get_signal(signal_name, dataset_id)
+
+    def get_or_create_dataset(self, dataset_name):
+        '''
+        Returns the dataset (creating it, if it doesn't exist).
+        '''
+        dataset = self.datasets_by_name.get(dataset_name)
+        if dataset is not None:
+            return dataset
+        if not self.has_unique_names:
+            return self.create_dataset(dataset_name)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            # If another insert creates the dataset at the same time, it is in neither part of the query
+            # (it was committed after the query started), so try again.
+            while True:
+                cursor.execute('''
+                    WITH created AS (
+                        INSERT INTO datasets (name) VALUES (%s) ON CONFLICT (name) DO NOTHING RETURNING dataset_id
+                    )
+                    SELECT dataset_id FROM created UNION ALL SELECT dataset_id FROM datasets WHERE name = %s
+                ''', (dataset_name, dataset_name))
+                row = cursor.fetchone()
+                conn.commit()
+                if row is not None:
+                    break
+        dataset = Dataset(dataset_id=row[0], name=dataset_name)
+        with self.lock:
+            self.index_dataset(dataset)
+        return dataset
+
+    def get_or_create_signals(self, dataset_id, signal_names):
+        '''
+        Returns the signals of the dataset with each of the names (creating all of the ones that don't exist at once).
+        '''
+        missing = list(dict.fromkeys(name for name in signal_names if (dataset_id, name) not in self.signals_by_key))
+        if missing and not self.has_unique_names:
+            self.create_signals(dataset_id, missing)
+        elif missing:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                created = {}
+                # Signals that another insert creates at the same time are in neither part of the query
+                # (they were committed after the query started), so try again for them.
+                while missing:
+                    cursor.execute('''
+                        WITH created AS (
+                            INSERT INTO signals (dataset_id, name) SELECT %s, unnest(%s::varchar[])
+                            ON CONFLICT (dataset_id, name) DO NOTHING RETURNING signal_id, name
+                        )
+                        SELECT signal_id, name FROM created
+                        UNION ALL SELECT signal_id, name FROM signals WHERE dataset_id = %s AND name = ANY(%s)
+                    ''', (dataset_id, missing, dataset_id, missing))
+                    created.update({ name: signal_id for signal_id, name in cursor })
+                    conn.commit()
+                    missing = [name for name in missing if name not in created]
+            with self.lock:
+                for name, signal_id in created.items():
+                    self.index_signal(Signal(signal_id=signal_id, dataset_id=dataset_id, name=name))
+        return [self.signals_by_key[(dataset_id, name)] for name in signal_names]
+
+    def create_dataset(self, dataset_name):
+        '''
+        Returns the dataset (creating it, if it doesn't exist) without ON CONFLICT (for databases without unique names).
+        '''
+        dataset = self.get_dataset_by_name(dataset_name)
+        if dataset is None:
+            with self.scope() as session:
+                dataset = Dataset(name=dataset_name)
+                self.add(session, dataset)
+        return dataset
+
+    def create_signals(self, dataset_id, signal_names):
+        '''
+        Creates the signals of the dataset with each of the names that don't exist yet
+        without ON CONFLICT (for databases without unique names).
+        '''
+        with self.scope() as session:
+            for signal_name in signal_names:
+                if self.get_signal(signal_name, dataset_id) is None:
+                    self.add(session, Signal(dataset_id=dataset_id, name=signal_name))
 
     def delete_dataset(self, dataset_name):
         with self.scope() as session:
@@ -100,22 +315,48 @@ class DatabaseClient:
             signals = session.query(Signal).filter_by(dataset_id=dataset.dataset_id).all()
             for signal in signals:
                 session.query(SignalData).filter_by(signal_id=signal.signal_id).delete()
+                if self.has_signal_ranges:
+                    session.query(SignalRange).filter_by(signal_id=signal.signal_id).delete()
             session.query(Signal).filter_by(dataset_id=dataset.dataset_id).delete()
             session.delete(dataset)
             session.commit()
             
-            # Refresh the caches.
-            self.cache()
+            # Remove the dataset and its signals from the caches. The signals were loaded by this session
+            # (so they are not the cached objects), and are compared by ID. Signals looked up without a dataset
+            # are loaded again (to get the first of the remaining signals with the name).
+            with self.lock:
+                self.datasets_by_name.pop(dataset.name, None)
+                for signal in signals:
+                    self.signals_by_key.pop((signal.dataset_id, signal.name), None)
+                    cached = self.signals_by_name.get(signal.name)
+                    if cached is not None and cached.signal_id == signal.signal_id:
+                        del self.signals_by_name[signal.name]
 
     def scope(self):
         return session_scope(self.Session)
 
+    @contextmanager
+    def connection(self):
+        '''
+        Borrows a direct database driver connection (for queries that don't need the ORM).
+        '''
+        conn = self.psycopg2_connpool.getconn()
+        try:
+            yield conn
+        except:
+            # Don't give the connection back in the middle of a failed transaction.
+            conn.rollback()
+            raise
+        finally:
+            self.psycopg2_connpool.putconn(conn)
+
     def add(self, session, obj):
         # Not perfect - if commit fails, the cache doesn't rollback.
-        if isinstance(obj, Dataset):
-            self.datasets.append(obj)
-        if isinstance(obj, Signal):
-            self.signals.append(obj)
+        with self.lock:
+            if isinstance(obj, Dataset):
+                self.index_dataset(obj)
+            if isinstance(obj, Signal):
+                self.index_signal(obj)
         return session.add(obj)
 
 @contextmanager
@@ -163,10 +404,16 @@ class UpsertQuery:
 
         self.create_temp_table_sql = 'CREATE TEMP TABLE source(LIKE %s INCLUDING ALL) ON COMMIT DROP;' % table_name
 
-    def execute(self, cursor, data):
+    def execute(self, cursor, data, binary=False):
+        '''
+        Upserts the rows in `data` (a file in the text COPY format, or the binary COPY format if `binary` is True).
+        '''
         cur = cursor
         cur.execute(self.create_temp_table_sql);  
-        cur.copy_from(data, 'source', columns=self.selector_fields + self.setter_fields)
+        if binary:
+            cur.copy_expert('COPY source (%s) FROM STDIN (FORMAT binary)' % ','.join(self.selector_fields + self.setter_fields), data)
+        else:
+            cur.copy_from(data, 'source', columns=self.selector_fields + self.setter_fields)
         cur.execute(self.query)
         cur.execute('DROP TABLE source')
         data.close()
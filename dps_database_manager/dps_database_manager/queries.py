@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+
+def make_pivot_query(signal_ids, interval, limit, after=None, keyset=False):
+    '''
+    Returns the SQL (and its parameters) that selects the samples of `signal_ids` as rows of
+    the time followed by one value for each signal.
+
+    If `keyset` is True, the samples are ordered by (time, signal_id), only samples after `after` (a (time, signal_id)
+    tuple, or None) are selected, and each row also has the largest signal ID and the number of samples at that time.
+    The seek is done for each signal on its own (with the index on (signal_id, time)), and the first `limit` samples
+    of all of the signals are taken from the first `limit` samples of each signal.
+    '''
+    if keyset:
+        page, params = make_keyset_page_query(signal_ids, interval, limit, after)
+    else:
+        params = []
+        where = ['signal_id = ANY(%s)']
+        params.append(list(set(signal_ids)))
+        if interval:
+            where.append('time >= %s AND time <= %s')
+            params += [interval.start, interval.end]
+        page = f'SELECT signal_id, time, value FROM signal_data WHERE {" AND ".join(where)} ORDER BY time ASC'
+        if limit:
+            page += ' LIMIT %s'
+            params.append(limit)
+
+    columns = ', '.join(['max(value) FILTER (WHERE signal_id = %s)'] * len(signal_ids))
+    if keyset:
+        columns += ', max(signal_id), count(*)'
+    sql = f'SELECT time, {columns} FROM ({page}) AS page GROUP BY time ORDER BY time ASC'
+    return sql, list(signal_ids) + params
+
+def make_keyset_page_query(signal_ids, interval, limit, after=None):
+    '''
+    Returns the SQL (and its parameters) that selects the first `limit` samples (signal_id, time, value) of `signal_ids`
+    that come after `after` (a (time, signal_id) tuple, or None), ordered by (time, signal_id).
+    '''
+    params = [sorted(set(signal_ids))]
+    where = ['signal_id = s.signal_id']
+    if interval:
+        where.append('time >= %s AND time <= %s')
+        params += [interval.start, interval.end]
+    if after is not None:
+        # `time >= %s` is what seeks in the index, the row comparison only skips the samples at that time
+        # that were already in the last page.
+        where.append('time >= %s AND (time, signal_id) > (%s, %s)')
+        params += [after[0]] + list(after)
+    params += [limit, limit]
+    sql = f'''
+        SELECT s.signal_id, d.time, d.value
+        FROM unnest(%s::int[]) AS s(signal_id)
+        CROSS JOIN LATERAL (
+            SELECT time, value FROM signal_data
+            WHERE {" AND ".join(where)}
+            ORDER BY time ASC LIMIT %s
+        ) AS d
+        ORDER BY d.time ASC, s.signal_id ASC LIMIT %s
+    '''
+    return sql, params
+
+SQL_AGGREGATIONS = {
+    'max': 'max',
+    'min': 'min',
+    'average': 'avg',
+    'count': 'count',
+}
+
+def make_aggregate_query(signal_ids, interval, aggregations):
+    '''
+    Returns the SQL (and its parameters) that selects each of `aggregations` of the samples of each of `signal_ids`,
+    as rows of the signal ID followed by the value of each aggregation.
+    '''
+    for aggregation in aggregations:
+        if aggregation not in SQL_AGGREGATIONS:
+            raise Exception(f'aggregate_signals was given an unsupported aggregation of "{aggregation}".')
+    columns = ', '.join(f'{SQL_AGGREGATIONS[aggregation]}(value)' for aggregation in aggregations)
+    params = [list(set(signal_ids))]
+    sql = f'SELECT signal_id, {columns} FROM signal_data WHERE signal_id = ANY(%s)'
+    if interval:
+        sql += ' AND time >= %s AND time <= %s'
+        params += [interval.start, interval.end]
+    return sql + ' GROUP BY signal_id', params
+
+ROLLUP_AGGREGATIONS = {
+    'max': 'max(max) FILTER (WHERE signal_id = %s)',
+    'min': 'min(min) FILTER (WHERE signal_id = %s)',
+    'average': 'sum(sum) FILTER (WHERE signal_id = %s) / sum(count) FILTER (WHERE signal_id = %s)',
+    # sum() of a bigint is a numeric (which is read as a Decimal), so it is cast back to the type of count().
+    'count': 'coalesce(sum(count) FILTER (WHERE signal_id = %s), 0)::bigint',
+}
+'''
+How each aggregation is computed from the buckets of a rollup (with the signal ID as each parameter).
+'''
+
+ROLLUPS = [
+    ('signal_data_1d', timedelta(days=1)),
+    ('signal_data_1h', timedelta(hours=1)),
+    ('signal_data_1m', timedelta(minutes=1)),
+]
+'''
+The rollups of `signal_data` (from coarsest to finest) which are created in schema.sql, and the width of their buckets.
+'''
+
+ROLLUP_ORIGIN = datetime(2000, 1, 3)
+'''
+Where TimescaleDB's `time_bucket` starts counting buckets from (when it isn't given an origin).
+'''
+
+def get_rollup(rollups, interval, bucket):
+    '''
+    Returns the coarsest rollup (in `rollups`) whose buckets fit exactly into buckets of `bucket` seconds
+    over `interval`, or None if the samples have to be aggregated from `signal_data`.
+    '''
+    width = timedelta(seconds=bucket)
+    for table, rollup_width in rollups:
+        if width % rollup_width == timedelta(0) and \
+           (interval.start - ROLLUP_ORIGIN) % rollup_width == timedelta(0) and \
+           (interval.end - ROLLUP_ORIGIN) % rollup_width == timedelta(0):
+            return table
+    return None
+
+def make_bucket_query(signal_ids, interval, aggregation, bucket, rollups=()):
+    '''
+    Returns the SQL (and its parameters) that aggregates the samples of `signal_ids` in buckets of `bucket` seconds
+    (starting at `interval.start`), as rows of the start of the bucket followed by the aggregation of each signal.
+
+    The buckets of the coarsest rollup that fits are aggregated instead of the samples, if there is one (in `rollups`).
+    '''
+    if aggregation not in SQL_AGGREGATIONS:
+        raise Exception(f'aggregate_buckets was given an unsupported aggregation of "{aggregation}".')
+    width = timedelta(seconds=bucket)
+    table = get_rollup(rollups, interval, bucket)
+    if table is None:
+        columns = [f'{SQL_AGGREGATIONS[aggregation]}(value) FILTER (WHERE signal_id = %s)'] * len(signal_ids)
+        column_params = list(signal_ids)
+        table, time = 'signal_data', 'time'
+    else:
+        column = ROLLUP_AGGREGATIONS[aggregation]
+        columns = [column] * len(signal_ids)
+        column_params = [signal_id for signal_id in signal_ids for _ in range(column.count('%s'))]
+        time = 'bucket'
+    sql = f'SELECT time_bucket(%s, {time}, %s) AS b, {", ".join(columns)} FROM {table} ' \
+          f'WHERE signal_id = ANY(%s) AND {time} >= %s AND {time} < %s GROUP BY b ORDER BY b ASC'
+    return sql, [width, interval.start] + column_params + [list(set(signal_ids)), interval.start, interval.end]
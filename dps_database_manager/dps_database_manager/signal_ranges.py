@@ -0,0 +1,41 @@
+import numpy as np
+from psycopg2.extras import execute_values
+
+from copy_encoders import to_pgcopy_times, from_pgcopy_time
+
+def get_signal_ranges(signal_ids, batches, times, chunk_size=10000):
+    '''
+    Returns the (signal_id, first time, last time, count) of the samples of each signal in an insert.
+    '''
+    counts = np.zeros(len(signal_ids), dtype='int64')
+    firsts = np.full(len(signal_ids), np.iinfo('int64').max)
+    lasts = np.full(len(signal_ids), np.iinfo('int64').min)
+    for start in range(0, len(batches), chunk_size):
+        values = np.array(batches[start:start + chunk_size], dtype='float64').reshape(-1, len(signal_ids))
+        chunk_times = to_pgcopy_times(times[start:start + chunk_size])[:, None]
+        present = ~np.isnan(values)
+        counts += present.sum(axis=0)
+        firsts = np.minimum(firsts, np.where(present, chunk_times, firsts).min(axis=0))
+        lasts = np.maximum(lasts, np.where(present, chunk_times, lasts).max(axis=0))
+    return [(signal_id, from_pgcopy_time(first), from_pgcopy_time(last), int(count))
+            for signal_id, first, last, count in zip(signal_ids, firsts, lasts, counts) if count > 0]
+
+def update_signal_ranges(cursor, ranges):
+    '''
+    Extends the ranges in `signal_ranges` with the ranges of an insert (from `get_signal_ranges`).
+    The samples of an insert may be before or after the samples that were already inserted.
+
+    Samples that are upserted again are counted again, so the count is only exact for inserts.
+    '''
+    if not ranges:
+        return
+    # The rows are locked in order of signal ID, so that concurrent inserts of the same signals
+    # (in different orders) wait for each other instead of deadlocking.
+    ranges = sorted(ranges)
+    execute_values(cursor, '''
+        INSERT INTO signal_ranges (signal_id, first, last, count) VALUES %s
+        ON CONFLICT (signal_id) DO UPDATE SET
+            first = LEAST(signal_ranges.first, EXCLUDED.first),
+            last  = GREATEST(signal_ranges.last, EXCLUDED.last),
+            count = signal_ranges.count + EXCLUDED.count
+    ''', ranges)
@@ -1,7 +1,13 @@
+-- Datasets and signals are created by inserts with ON CONFLICT DO NOTHING (so that concurrent inserts
+-- don't create the same one twice), which needs their names to be unique. For an existing database, add them with
+-- (after removing any duplicate names; until then, datasets and signals are created one at a time, without ON CONFLICT):
+--   ALTER TABLE datasets ADD UNIQUE (name);
+--   ALTER TABLE signals ADD UNIQUE (dataset_id, name);
 CREATE TABLE datasets(
     dataset_id INT GENERATED ALWAYS AS IDENTITY,
     name       VARCHAR(200),
-    PRIMARY KEY (dataset_id)
+    PRIMARY KEY (dataset_id),
+    UNIQUE (name)
 );
 
 CREATE TABLE signals(
@@ -9,6 +15,7 @@ CREATE TABLE signals(
     dataset_id INT NOT NULL,
     name       VARCHAR(200) NOT NULL,
     PRIMARY KEY (signal_id),
+    UNIQUE (dataset_id, name),
     FOREIGN KEY (dataset_id) REFERENCES datasets(dataset_id)
 );
 
@@ -29,3 +36,44 @@ CREATE INDEX ON signal_data (signal_id, time ASC);
 -- improved insert speed by ~40% (for 100,000 records).
 -- The best solution is to keep the foreign key constraint, and before
 -- a bulk insert, drop the constraint, and add it back after the bulk insert is done.
+
+-- The first and last time, and the number of samples of each signal (kept up to date by every insert),
+-- so that the range of a signal or dataset doesn't need to scan `signal_data`.
+-- For a database that already has samples, fill it with:
+--   INSERT INTO signal_ranges SELECT signal_id, min(time), max(time), count(*) FROM signal_data GROUP BY signal_id;
+CREATE TABLE signal_ranges(
+    signal_id  INT NOT NULL,
+    first      TIMESTAMPTZ NOT NULL,
+    last       TIMESTAMPTZ NOT NULL,
+    count      BIGINT NOT NULL,
+    PRIMARY KEY (signal_id),
+    FOREIGN KEY (signal_id) REFERENCES signals(signal_id)
+);
+
+-- Rollups of `signal_data` (used by bucketed aggregations whose buckets are a multiple of the rollup's bucket).
+-- The average is kept as a sum and a count, so that it can be aggregated again into larger buckets.
+-- Recent samples which are not materialized yet are read from `signal_data` (materialized_only = false).
+CREATE MATERIALIZED VIEW signal_data_1m
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT signal_id, time_bucket(INTERVAL '1 minute', time) AS bucket,
+       min(value) AS min, max(value) AS max, sum(value) AS sum, count(*) AS count
+FROM signal_data
+GROUP BY signal_id, bucket;
+
+CREATE MATERIALIZED VIEW signal_data_1h
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT signal_id, time_bucket(INTERVAL '1 hour', time) AS bucket,
+       min(value) AS min, max(value) AS max, sum(value) AS sum, count(*) AS count
+FROM signal_data
+GROUP BY signal_id, bucket;
+
+CREATE MATERIALIZED VIEW signal_data_1d
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT signal_id, time_bucket(INTERVAL '1 day', time) AS bucket,
+       min(value) AS min, max(value) AS max, sum(value) AS sum, count(*) AS count
+FROM signal_data
+GROUP BY signal_id, bucket;
+
+SELECT add_continuous_aggregate_policy('signal_data_1m', start_offset => NULL, end_offset => INTERVAL '1 minute', schedule_interval => INTERVAL '1 minute');
+SELECT add_continuous_aggregate_policy('signal_data_1h', start_offset => NULL, end_offset => INTERVAL '1 hour', schedule_interval => INTERVAL '10 minutes');
+SELECT add_continuous_aggregate_policy('signal_data_1d', start_offset => NULL, end_offset => INTERVAL '1 day', schedule_interval => INTERVAL '1 hour');
@@ -11,6 +11,7 @@ setup(
         'Flask',
         'SQLAlchemy',
         'psycopg2-binary',
+        'numpy',
         'expiringdict',
         'requests',
     ],
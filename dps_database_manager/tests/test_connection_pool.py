@@ -0,0 +1,74 @@
+import os
+import sys
+import threading
+from unittest import TestCase
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'dps_database_manager'))
+
+from db import BlockingConnectionPool, DatabaseClient
+
+class MockConnection:
+    def rollback(self):
+        pass
+
+class MockPool:
+    '''
+    Like psycopg2's pools, raises right away when all of the connections are in use.
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.used == self.size:
+                raise Exception('connection pool exhausted')
+            self.used += 1
+            return MockConnection()
+
+    def putconn(self, conn):
+        with self.lock:
+            self.used -= 1
+
+def make_client(size, timeout):
+    dbc = DatabaseClient.__new__(DatabaseClient)
+    dbc.psycopg2_connpool = BlockingConnectionPool(MockPool(size), size, timeout)
+    return dbc
+
+class TestConnectionPool(TestCase):
+    def test_concurrent_streams(self):
+        dbc = make_client(2, 10)
+        streaming, done = threading.Semaphore(0), threading.Event()
+        streamed = []
+        def stream(i):
+            # Each stream holds its connection until it has been sent.
+            with dbc.connection():
+                streaming.release()
+                done.wait()
+                streamed.append(i)
+        threads = [threading.Thread(target=stream, args=(i,)) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for _ in range(2):
+            streaming.acquire()
+        # The other streams wait for a connection (instead of failing).
+        self.assertFalse(streaming.acquire(timeout=0.1))
+        done.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(streamed), list(range(5)))
+        self.assertEqual(dbc.psycopg2_connpool.pool.used, 0)
+
+    def test_timeout(self):
+        dbc = make_client(1, 0.05)
+        with dbc.connection():
+            with self.assertRaisesRegex(Exception, 'Timed out after 0.05 seconds waiting for a database connection'):
+                with dbc.connection():
+                    pass
+        # The connection is given back (even when the query fails).
+        with self.assertRaises(ZeroDivisionError):
+            with dbc.connection():
+                1 / 0
+        with dbc.connection():
+            pass
@@ -0,0 +1,102 @@
+import os
+import sys
+import math
+import struct
+from unittest import TestCase
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'dps_database_manager'))
+
+from copy_encoders import encode_binary_copy, make_binary_copy_stream, ChunkStream, \
+    to_pgcopy_time, from_pgcopy_time, PGCOPY_EPOCH
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+def decode_binary_copy(data):
+    '''
+    Decodes (signal_id, time, value) tuples from the binary COPY format with `struct`.
+    '''
+    assert data[:len(SIGNATURE)] == SIGNATURE
+    offset = len(SIGNATURE)
+    flags, extension_length = struct.unpack_from('>ii', data, offset)
+    assert flags == 0 and extension_length == 0
+    offset += 8
+    rows = []
+    while True:
+        fields, = struct.unpack_from('>h', data, offset)
+        offset += 2
+        if fields == -1:
+            break
+        assert fields == 3
+        signal_id_length, signal_id, time_length, time, value_length, value = struct.unpack_from('>iiiqid', data, offset)
+        assert (signal_id_length, time_length, value_length) == (4, 8, 8)
+        offset += 4 + 4 + 4 + 8 + 4 + 8
+        rows.append((signal_id, PGCOPY_EPOCH + timedelta(microseconds=time), value))
+    assert offset == len(data), 'There must be nothing after the trailer.'
+    return rows
+
+class TestCopyEncoders(TestCase):
+    def test_encode_binary_copy(self):
+        start = datetime(2020, 6, 30, 3, 54, 45, 175489)
+        times = [start, start + timedelta(microseconds=1)]
+        data = b''.join(encode_binary_copy([5, 7], [[1.5, -2.0], [3.25, 1e300]], times))
+        self.assertEqual(decode_binary_copy(data), [
+            (5, times[0], 1.5), (7, times[0], -2.0),
+            (5, times[1], 3.25), (7, times[1], 1e300),
+        ])
+
+    def test_encode_binary_copy_empty(self):
+        self.assertEqual(decode_binary_copy(b''.join(encode_binary_copy([1, 2], [], []))), [])
+
+    def test_encode_binary_copy_skips_missing_samples(self):
+        times = [datetime(2021, 1, 1), datetime(2021, 1, 2), datetime(2021, 1, 3)]
+        data = b''.join(encode_binary_copy([1, 2], [[None, 1.0], [math.nan, None], [2.0, math.nan]], times))
+        self.assertEqual(decode_binary_copy(data), [(2, times[0], 1.0), (1, times[2], 2.0)])
+
+    def test_encode_binary_copy_converts_times_to_utc(self):
+        time = datetime(2021, 7, 12, 10, 37, 19, 839234, tzinfo=timezone(timedelta(hours=-5)))
+        (signal_id, utc_time, value), = decode_binary_copy(b''.join(encode_binary_copy([1], [[0.5]], [time])))
+        # Naive times are UTC.
+        self.assertEqual(utc_time, datetime(2021, 7, 12, 15, 37, 19, 839234))
+        self.assertEqual(to_pgcopy_time(time), to_pgcopy_time(utc_time))
+        self.assertEqual(from_pgcopy_time(to_pgcopy_time(utc_time)), utc_time)
+        self.assertEqual(to_pgcopy_time(datetime(1999, 12, 31, 23, 59, 59, 999999)), -1)
+
+    def test_encode_binary_copy_chunks(self):
+        start = datetime(2020, 1, 1)
+        times = [start + timedelta(seconds=i) for i in range(10)]
+        batches = [[float(i), float(-i)] for i in range(10)]
+        chunks = list(encode_binary_copy([1, 2], batches, times, chunk_size=3))
+        # The header, a chunk for every 3 times, and the trailer.
+        self.assertEqual(len(chunks), 1 + 4 + 1)
+        self.assertEqual(b''.join(chunks), b''.join(encode_binary_copy([1, 2], batches, times)))
+
+    def test_chunk_stream(self):
+        chunks = [b'abc', b'', b'defgh', b'i', b'', b'jklmnop']
+        expected = b''.join(chunks)
+        for size in [1, 2, 3, 4, 7, 100]:
+            stream = ChunkStream(chunks)
+            data = b''
+            while True:
+                buffer = bytearray(size)
+                n = stream.readinto(buffer)
+                if n == 0:
+                    break
+                self.assertLessEqual(n, size)
+                data += bytes(buffer[:n])
+            self.assertEqual(data, expected)
+
+    def test_make_binary_copy_stream(self):
+        start = datetime(2020, 1, 1)
+        times = [start + timedelta(milliseconds=i) for i in range(1000)]
+        batches = [[float(i), None, float(i) / 2] for i in range(1000)]
+        stream = make_binary_copy_stream([1, 2, 3], batches, times, chunk_size=7)
+        data = b''
+        while True:
+            # Reads that don't line up with the chunks.
+            block = stream.read(1000)
+            if not block:
+                break
+            data += block
+        self.assertEqual(data, b''.join(encode_binary_copy([1, 2, 3], batches, times)))
+        self.assertEqual(len(decode_binary_copy(data)), 2000)
@@ -0,0 +1,127 @@
+import os
+import sys
+from unittest import TestCase
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'dps_database_manager'))
+
+from queries import make_pivot_query, make_keyset_page_query, make_aggregate_query, make_bucket_query, \
+    get_rollup, ROLLUPS
+
+Interval = namedtuple('Interval', ['start', 'end'])
+
+START = datetime(2021, 3, 1)
+INTERVAL = Interval(START, START + timedelta(days=7))
+
+def normalize(sql):
+    return ' '.join(sql.split())
+
+class TestQueries(TestCase):
+    def assertParams(self, query):
+        sql, params = query
+        self.assertEqual(sql.count('%s'), len(params), 'There must be a parameter for each placeholder.')
+        return normalize(sql), params
+
+    def test_make_pivot_query(self):
+        sql, params = self.assertParams(make_pivot_query([3, 1, 2], INTERVAL, 100))
+        # A column for each signal, in the order of the signals.
+        self.assertEqual(sql, 'SELECT time, max(value) FILTER (WHERE signal_id = %s), max(value) FILTER (WHERE signal_id = %s), '
+                              'max(value) FILTER (WHERE signal_id = %s) FROM (SELECT signal_id, time, value FROM signal_data '
+                              'WHERE signal_id = ANY(%s) AND time >= %s AND time <= %s ORDER BY time ASC LIMIT %s) AS page '
+                              'GROUP BY time ORDER BY time ASC')
+        self.assertEqual(params[:3], [3, 1, 2])
+        self.assertEqual(sorted(params[3]), [1, 2, 3])
+        self.assertEqual(params[4:], [INTERVAL.start, INTERVAL.end, 100])
+
+        sql, params = self.assertParams(make_pivot_query([1], None, None))
+        self.assertNotIn('LIMIT', sql)
+        self.assertNotIn('time >=', sql)
+        self.assertEqual(params, [1, [1]])
+
+    def test_make_pivot_query_keyset(self):
+        after = (START + timedelta(hours=1), 2)
+        sql, params = self.assertParams(make_pivot_query([3, 1, 2], INTERVAL, 100, after=after, keyset=True))
+        self.assertTrue(sql.startswith('SELECT time, max(value) FILTER (WHERE signal_id = %s), max(value) FILTER (WHERE signal_id = %s), '
+                                       'max(value) FILTER (WHERE signal_id = %s), max(signal_id), count(*) FROM ('))
+        self.assertTrue(sql.endswith(') AS page GROUP BY time ORDER BY time ASC'))
+        page_sql, page_params = make_keyset_page_query([3, 1, 2], INTERVAL, 100, after)
+        self.assertIn(normalize(page_sql), sql)
+        self.assertEqual(params, [3, 1, 2] + page_params)
+
+    def test_make_keyset_page_query(self):
+        after = (START + timedelta(hours=1), 2)
+        sql, params = self.assertParams(make_keyset_page_query([3, 1, 3, 2], INTERVAL, 50, after))
+        # Each signal is seeked on its own (in its index), after the last sample of the last page.
+        self.assertEqual(sql, 'SELECT s.signal_id, d.time, d.value FROM unnest(%s::int[]) AS s(signal_id) '
+                              'CROSS JOIN LATERAL ( SELECT time, value FROM signal_data '
+                              'WHERE signal_id = s.signal_id AND time >= %s AND time <= %s '
+                              'AND time >= %s AND (time, signal_id) > (%s, %s) '
+                              'ORDER BY time ASC LIMIT %s ) AS d ORDER BY d.time ASC, s.signal_id ASC LIMIT %s')
+        self.assertEqual(params, [[1, 2, 3], INTERVAL.start, INTERVAL.end, after[0], after[0], 2, 50, 50])
+
+        # The first page
+        sql, params = self.assertParams(make_keyset_page_query([1, 2], None, 10))
+        self.assertIn('WHERE signal_id = s.signal_id ORDER BY time ASC LIMIT %s', sql)
+        self.assertEqual(params, [[1, 2], 10, 10])
+
+    def test_make_aggregate_query(self):
+        sql, params = self.assertParams(make_aggregate_query([2, 1, 2], INTERVAL, ['min', 'average', 'count']))
+        self.assertEqual(sql, 'SELECT signal_id, min(value), avg(value), count(value) FROM signal_data '
+                              'WHERE signal_id = ANY(%s) AND time >= %s AND time <= %s GROUP BY signal_id')
+        self.assertEqual(sorted(params[0]), [1, 2])
+        self.assertEqual(params[1:], [INTERVAL.start, INTERVAL.end])
+
+        sql, params = self.assertParams(make_aggregate_query([1], None, ['max']))
+        self.assertEqual(sql, 'SELECT signal_id, max(value) FROM signal_data WHERE signal_id = ANY(%s) GROUP BY signal_id')
+        with self.assertRaisesRegex(Exception, 'unsupported aggregation of "median"'):
+            make_aggregate_query([1], None, ['max', 'median'])
+
+    def test_get_rollup(self):
+        day, hour, minute = timedelta(days=1), timedelta(hours=1), timedelta(minutes=1)
+        self.assertEqual(get_rollup(ROLLUPS, INTERVAL, 86400), 'signal_data_1d')
+        self.assertEqual(get_rollup(ROLLUPS, INTERVAL, 7 * 86400), 'signal_data_1d')
+        # The coarsest rollup whose buckets fit.
+        self.assertEqual(get_rollup(ROLLUPS, INTERVAL, 3 * 3600), 'signal_data_1h')
+        self.assertEqual(get_rollup(ROLLUPS, INTERVAL, 90 * 60), 'signal_data_1m')
+        self.assertIsNone(get_rollup(ROLLUPS, INTERVAL, 90))
+        # Both ends of the interval have to be on a bucket of the rollup.
+        self.assertEqual(get_rollup(ROLLUPS, Interval(START + hour, START + day), 86400), 'signal_data_1h')
+        self.assertEqual(get_rollup(ROLLUPS, Interval(START, START + day + minute), 86400), 'signal_data_1m')
+        self.assertIsNone(get_rollup(ROLLUPS, Interval(START, START + day + timedelta(seconds=1)), 86400))
+        self.assertIsNone(get_rollup(ROLLUPS, Interval(START - timedelta(microseconds=1), START + day), 86400))
+        # Only the rollups that the database has are used.
+        self.assertEqual(get_rollup(ROLLUPS[2:], INTERVAL, 86400), 'signal_data_1m')
+        self.assertIsNone(get_rollup((), INTERVAL, 86400))
+
+    def test_make_bucket_query(self):
+        sql, params = self.assertParams(make_bucket_query([3, 1], INTERVAL, 'max', 90))
+        # Buckets start at the start of the interval, and the end of the interval is not in the last bucket.
+        self.assertEqual(sql, 'SELECT time_bucket(%s, time, %s) AS b, max(value) FILTER (WHERE signal_id = %s), '
+                              'max(value) FILTER (WHERE signal_id = %s) FROM signal_data '
+                              'WHERE signal_id = ANY(%s) AND time >= %s AND time < %s GROUP BY b ORDER BY b ASC')
+        self.assertEqual(params[:4], [timedelta(seconds=90), INTERVAL.start, 3, 1])
+        self.assertEqual(sorted(params[4]), [1, 3])
+        self.assertEqual(params[5:], [INTERVAL.start, INTERVAL.end])
+
+        # Without any rollups, the samples are aggregated.
+        sql, params = self.assertParams(make_bucket_query([3, 1], INTERVAL, 'average', 3600))
+        self.assertIn('FROM signal_data WHERE', sql)
+        self.assertIn('avg(value) FILTER (WHERE signal_id = %s)', sql)
+
+    def test_make_bucket_query_rollup(self):
+        sql, params = self.assertParams(make_bucket_query([3, 1], INTERVAL, 'average', 3600, ROLLUPS))
+        self.assertEqual(sql, 'SELECT time_bucket(%s, bucket, %s) AS b, '
+                              'sum(sum) FILTER (WHERE signal_id = %s) / sum(count) FILTER (WHERE signal_id = %s), '
+                              'sum(sum) FILTER (WHERE signal_id = %s) / sum(count) FILTER (WHERE signal_id = %s) '
+                              'FROM signal_data_1h WHERE signal_id = ANY(%s) AND bucket >= %s AND bucket < %s GROUP BY b ORDER BY b ASC')
+        self.assertEqual(params[:6], [timedelta(hours=1), INTERVAL.start, 3, 3, 1, 1])
+        self.assertEqual(params[7:], [INTERVAL.start, INTERVAL.end])
+
+        sql, params = self.assertParams(make_bucket_query([3, 1], INTERVAL, 'count', 86400, ROLLUPS))
+        self.assertIn('coalesce(sum(count) FILTER (WHERE signal_id = %s), 0)::bigint', sql)
+        self.assertIn('FROM signal_data_1d', sql)
+        self.assertEqual(params[2:4], [3, 1])
+
+        with self.assertRaisesRegex(Exception, 'unsupported aggregation of "median"'):
+            make_bucket_query([1], INTERVAL, 'median', 60, ROLLUPS)
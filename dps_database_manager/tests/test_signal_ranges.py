@@ -0,0 +1,62 @@
+import os
+import sys
+import math
+from unittest import TestCase
+from datetime import datetime, timedelta, timezone
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'dps_database_manager'))
+
+import signal_ranges
+from signal_ranges import get_signal_ranges, update_signal_ranges
+
+START = datetime(2021, 1, 1)
+TIMES = [START + timedelta(seconds=i) for i in range(5)]
+
+class TestSignalRanges(TestCase):
+    def test_get_signal_ranges(self):
+        batches = [[1.0, None, 3.0],
+                   [math.nan, None, 4.0],
+                   [2.0, None, None],
+                   [None, None, 5.0],
+                   [6.0, None, math.nan]]
+        self.assertEqual(get_signal_ranges([3, 1, 2], batches, TIMES), [
+            (3, TIMES[0], TIMES[4], 3),
+            (2, TIMES[0], TIMES[3], 3),
+        ])
+
+    def test_get_signal_ranges_empty(self):
+        self.assertEqual(get_signal_ranges([1, 2], [], []), [])
+        self.assertEqual(get_signal_ranges([1], [[None], [math.nan]], TIMES[:2]), [])
+
+    def test_get_signal_ranges_unordered_times(self):
+        # The samples of an insert aren't always in order of time.
+        times = [TIMES[3], TIMES[0], TIMES[4], TIMES[1]]
+        batches = [[1.0, 1.0], [2.0, None], [None, 3.0], [4.0, 4.0]]
+        self.assertEqual(get_signal_ranges([1, 2], batches, times), [
+            (1, TIMES[0], TIMES[3], 3),
+            (2, TIMES[1], TIMES[4], 3),
+        ])
+
+    def test_get_signal_ranges_chunks(self):
+        times = [START + timedelta(milliseconds=i) for i in range(100)]
+        batches = [[float(i) if i % 3 else None, float(i) if 10 <= i < 20 else None] for i in range(100)]
+        expected = get_signal_ranges([1, 2], batches, times)
+        self.assertEqual(expected, [(1, times[1], times[98], 66), (2, times[10], times[19], 10)])
+        for chunk_size in [1, 7, 99]:
+            self.assertEqual(get_signal_ranges([1, 2], batches, times, chunk_size=chunk_size), expected)
+
+    def test_get_signal_ranges_converts_times_to_utc(self):
+        time = datetime(2021, 7, 12, 10, 37, 19, 839234, tzinfo=timezone(timedelta(hours=-5)))
+        self.assertEqual(get_signal_ranges([1], [[0.5]], [time]),
+                         [(1, datetime(2021, 7, 12, 15, 37, 19, 839234), datetime(2021, 7, 12, 15, 37, 19, 839234), 1)])
+
+    def test_update_signal_ranges_sorts_signals(self):
+        calls = []
+        execute_values = signal_ranges.execute_values
+        signal_ranges.execute_values = lambda cursor, sql, ranges: calls.append(ranges)
+        try:
+            update_signal_ranges(None, [])
+            update_signal_ranges(None, [(5, TIMES[0], TIMES[1], 2), (2, TIMES[1], TIMES[2], 1), (3, TIMES[0], TIMES[0], 1)])
+        finally:
+            signal_ranges.execute_values = execute_values
+        self.assertEqual(calls, [[(2, TIMES[1], TIMES[2], 1), (3, TIMES[0], TIMES[0], 1), (5, TIMES[0], TIMES[1], 2)]])
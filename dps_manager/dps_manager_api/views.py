@@ -2,6 +2,7 @@ from io import StringIO
 import csv
 import json
 from threading import Lock
+from time import sleep
 import uuid
 import math
 import uuid
@@ -43,12 +44,26 @@ from .serializers import \
 
 from dplib import Component, KPI
 
-def dbm_post(endpoint, json):
-    return requests.post(settings.DBM_URL + '/api/v1/' + endpoint,
-                         json=json,
-                         headers={
-                             'Authorization': 'API ' + DPS_MANAGER_SECRET_API_KEY,
-                         })
+MAX_INSERT_RETRIES = 10
+'''
+How many times a request is sent again when the Database Manager's insert queue is full (HTTP 429).
+'''
+
+def dbm_post(endpoint, json, stream=False):
+    '''
+    Posts to the Database Manager, and waits to post again while it is refusing inserts because its insert queue is full.
+    '''
+    for _ in range(MAX_INSERT_RETRIES):
+        resp = requests.post(settings.DBM_URL + '/api/v1/' + endpoint,
+                             json=json,
+                             stream=stream,
+                             headers={
+                                 'Authorization': 'API ' + DPS_MANAGER_SECRET_API_KEY,
+                             })
+        if resp.status_code != 429:
+            break
+        sleep(float(resp.headers.get('Retry-After', 1)))
+    return resp
 
 User = get_user_model()
 class UserAPI(ObjectAPI):
@@ -604,7 +619,6 @@ def export_dataset(request):
     signal_display_names    = jo['signalDisplayNames']
     start_time = util.parse_datetime(jo['start'])
     end_time   = util.parse_datetime(jo['end'])
-    limit      = 50000 # how many samples to query for at once
 
     infer = jo['infer']
 
@@ -616,58 +630,38 @@ def export_dataset(request):
         end_time = util.parse_datetime(resp['last'])
 
     def data():
-        nonlocal dataset, signals, start_time, end_time, limit
+        nonlocal dataset, signals, start_time, end_time
 
         # yield the header
         yield ['Time'] + signal_display_names
-        
-        dbm_has_data = True
-        samples      = []
-        times        = []
-        result       = None
-    
-        while dbm_has_data:
-            resp = None
-            try:
-                resp = dbm_post('query', {
-                    "queries": [
-                        {
-                            "dataset": dataset,
-                            "signals": signals,
-                            "interval": {
-                                "start": util.format_datetime(start_time),
-                                "end":   util.format_datetime(end_time),
-                            },
-                            "limit": limit,
-                        }
-                    ]
-                })
-            except Exception as e:            
-                raise Exception('error when fetching data from DPS Database Manager. Reason: ' + str(e))
-            jo = resp.json()
-            if resp.status_code != 200 or 'results' not in jo:
-                raise Exception(resp.text)
-            
-            results = jo['results'][0]
-            samples += results['samples']
-            times   += [util.parse_datetime(time) for time in results['times']]
-
-            # If there is no more data after this, end the process after this batch completes.
-            if len(signals) * len(samples) < limit:
-                dbm_has_data = False
-            else:
-                # Start the next batch of data at the last time we got from this batch.
-                # Don't use that batch's sample data because there is a chance the samples
-                # could be missing if the limit is not a multiple of the # of signals.
-                samples.pop()
-                start_time = times.pop()
-    
-            for i in range(len(times)):
-                t = times[i].isoformat() + 'Z'
-                yield ([t] + samples[i])
-                
-            samples = []
-            times = []
+
+        # The Database Manager streams the samples in chunks (one result per line),
+        # so neither server has to hold the whole dataset in memory.
+        try:
+            resp = dbm_post('stream_query', {
+                "queries": [
+                    {
+                        "dataset": dataset,
+                        "signals": signals,
+                        "interval": {
+                            "start": util.format_datetime(start_time),
+                            "end":   util.format_datetime(end_time),
+                        },
+                    }
+                ]
+            }, stream=True)
+        except Exception as e:
+            raise Exception('error when fetching data from DPS Database Manager. Reason: ' + str(e))
+        if resp.status_code != 200:
+            raise Exception(resp.text)
+
+        for line in resp.iter_lines():
+            if not line:
+                continue
+            results = json.loads(line)
+            for time, sample in zip(results['times'], results['samples']):
+                t = util.parse_datetime(time).isoformat() + 'Z'
+                yield ([t] + sample)
 
     def serialize(data):
         return data
@@ -747,9 +741,14 @@ def get_chart_data(request):
             "start": "...",
             "end":   "..."
         },
-        "offset": 5
+        "offset": 5,
+        "downsample": 1000,
+        "downsample_method": "lttb"
     }
 
+    If "downsample" is given, each series is the raw samples downsampled to (at most) that many points
+    (with "lttb" or "minmax") instead of an aggregation of each time unit (and "aggregation" is not needed).
+
     The result should be like this:
     {
         "series": [
@@ -777,6 +776,7 @@ def get_chart_data(request):
     offset    = jo['offset'] # How many hours away from UTC the time is
     pad       = jo.get('pad', True) # Whether or not to add an additional time unit to the beginning and end of the time range
     infer     = jo.get('infer', False) # Whether or not to infer the time range (has priority over interval if it is more precise)
+    downsample = jo.get('downsample') # The most points for each series (instead of aggregating each time unit)
     interval_start = util.parse_datetime(interval['start'])
     interval_end = util.parse_datetime(interval['end'])
     
@@ -788,17 +788,13 @@ def get_chart_data(request):
         interval_start = inferred_start_time = None
         interval_end = inferred_end_time = None
 
-        for s in series:
-            signal      = s['signal']
-            dataset     = s['dataset']
-
-            # Infer what the correct time range should be
-            resp = dbm_post('get_range', {
-                'dataset': dataset,
-                'signal': signal,
-            }).json()['results'][0]
-            first = resp['first']
-            last = resp['last']
+        # Infer what the correct time range should be (getting the ranges of all of the signals at once)
+        resp = dbm_post('get_ranges', {
+            'ranges': [{ 'dataset': s['dataset'], 'signal': s['signal'] } for s in series],
+        }).json()
+        for signal_range in resp['results']:
+            first = signal_range['first']
+            last = signal_range['last']
             if first:
                 if not inferred_start_time:
                     inferred_start_time = util.parse_datetime(first)
@@ -813,24 +809,43 @@ def get_chart_data(request):
         interval_start = inferred_start_time
         interval_end = inferred_end_time
 
-    intervals = get_sample_ranges(interval_start,
-                                  interval_end,
-                                  offset,
-                                  pad)
+    if downsample:
+        # Downsample the samples in the Database Manager, so that only the points that are plotted are sent.
+        for s in series:
+            queries.append({
+                'signals':           [s['signal']],
+                'dataset':           s['dataset'],
+                'downsample':        downsample,
+                'downsample_method': jo.get('downsample_method', 'lttb'),
+                'interval': {
+                    'start': util.format_datetime(interval_start),
+                    'end':   util.format_datetime(interval_end),
+                }
+            })
+    else:
+        intervals = get_sample_ranges(interval_start,
+                                      interval_end,
+                                      offset,
+                                      pad)
+
+        # Every interval has the same length, so each series is one bucketed aggregation
+        # (which the Database Manager does in one scan, instead of one query per interval).
+        bucket_start = intervals[0][0]
+        bucket_end   = intervals[-1][1]
+        bucket       = (intervals[0][1] - intervals[0][0]).total_seconds()
+        for s in series:
+            signal      = s['signal']
+            dataset     = s['dataset']
+            aggregation = s['aggregation']
 
-    for s in series:
-        signal      = s['signal']
-        dataset     = s['dataset']
-        aggregation = s['aggregation']
-        
-        for start, end in intervals:
             queries.append({
                 'signals':     [signal],
                 'dataset':     dataset,
                 'aggregation': aggregation,
+                'bucket':      bucket,
                 'interval': {
-                    'start': util.format_datetime(start),
-                    'end':   util.format_datetime(end),
+                    'start': util.format_datetime(bucket_start),
+                    'end':   util.format_datetime(bucket_end),
                 }
             })
 
@@ -844,18 +859,14 @@ def get_chart_data(request):
     resp = resp['results']
 
     results = []
-    for i, s in enumerate(series):
+    for s, result in zip(series, resp):
         data = []
-        for j, (start, end) in enumerate(intervals):
-            result = resp[(i * len(intervals)) + j]
-            
-            # Get the time between start and end to use in chart
-            # dt = end - start
-            # start += dt/2
-            y = result['values'][0]
+        # Only buckets which have samples (or samples that were kept by downsampling) are returned.
+        for time, values in zip(result['times'], result['samples']):
+            y = values[0]
             if y is not None: # skip nulls
                 data.append({
-                    'x': start,
+                    'x': util.parse_datetime(time),
                     'y': y,
                 })
         results.append({ 'label': s['signal'],
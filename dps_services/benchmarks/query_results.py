@@ -0,0 +1,77 @@
+'''
+Benchmark of the formats the Database Manager can send query results in.
+
+Compares the bytes on the wire, and the time it takes a client to decode a response into arrays of
+times (int64 nanoseconds) and values (float64), for 100,000 samples of 4 signals:
+
+    python benchmarks/query_results.py
+'''
+
+import json
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import dps_services.util as util
+import dps_services.database_manager as dbm
+
+SAMPLES = 100000
+SIGNALS = ['Va', 'Vb', 'Vc', 'Ia']
+
+def make_result():
+    query = dbm.Query('benchmark', SIGNALS, None)
+    result = dbm.SignalQueryResult(query)
+    rng = np.random.default_rng(0)
+    start = datetime(2020, 1, 1)
+    for i in range(SAMPLES):
+        result.add(rng.normal(size=len(SIGNALS)).tolist(), start + timedelta(microseconds=100 * i))
+    return result
+
+def decode_rows(data):
+    result = json.loads(data)['results'][0]
+    times = np.array([util.datetime_to_epoch_ns(util.parse_datetime(x)) for x in result['times']], dtype='int64')
+    values = np.array(result['samples'], dtype='float64').T
+    return times, values
+
+def decode_columnar(data):
+    result = json.loads(data)['results'][0]
+    return np.array(result['times'], dtype='int64'), np.array(result['values'], dtype='float64')
+
+def decode_binary(data):
+    result = dbm.load_binary_results(data)['results'][0]
+    return result['times'], result['values']
+
+def measure(f, repeat=3):
+    '''
+    Returns the best time (in seconds) of calling `f` `repeat` times.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    result = make_result()
+    responses = {
+        'rows':     (json.dumps(dbm.DataStore.to_results_response([result])).encode('utf-8'), decode_rows),
+        'columnar': (json.dumps(dbm.DataStore.to_columnar_results_response([result])).encode('utf-8'), decode_columnar),
+        'binary':   (dbm.DataStore.to_binary_results_response([result]), decode_binary),
+    }
+
+    expected = decode_binary(responses['binary'][0])
+    rows_size, _ = responses['rows']
+    rows_time = None
+    for name, (data, decode) in responses.items():
+        times, values = decode(data)
+        assert np.array_equal(times, expected[0]) and np.array_equal(values, expected[1])
+        elapsed = measure(lambda: decode(data))
+        rows_time = elapsed if rows_time is None else rows_time
+        print(f'{name:<9} size: {len(data) / 1e6:7.2f} MB ({len(data) / len(rows_size):4.2f}x of rows)   '
+              f'decode: {elapsed * 1e3:9.3f} ms   speedup: {rows_time / elapsed:9.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,25 @@
 from .query import parse_query_json
 from .query import load_query_json
+from .query import load_query_format
+from .query import load_stream_options
 from .query import Query, Interval
+from .query import dump_continuation_token, load_continuation_token
+from .query import FORMAT_ROWS, FORMAT_COLUMNAR, FORMAT_BINARY, COLUMNAR_CONTENT_TYPE
+
+from .binary import load_binary_results
+from .binary import BINARY_CONTENT_TYPE
+
+from .downsample import make_downsampler
+from .downsample import LTTBDownsampler, MinMaxDownsampler
+from .downsample import DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX
 
 from .insert import parse_insert_json
 from .insert import load_insert_json
 from .insert import Insert
+from .insert import validate_inserts
+
+from .ingest_queue import IngestQueue
+from .ingest_queue import merge_inserts
 
 from .delete import parse_delete_json
 from .delete import load_delete_json
@@ -13,5 +28,6 @@ from .delete import Delete
 from .data_store import DataStore
 from .data_store import SignalQueryResult
 from .data_store import AggregateQueryResult
+from .data_store import BucketQueryResult
 
 from .main import init_app
@@ -0,0 +1,60 @@
+import json
+import struct
+
+import numpy as np
+
+BINARY_CONTENT_TYPE = 'application/vnd.dps.columnar+octet-stream'
+'''
+The content type of query results in the binary format.
+
+The binary format is a count of the results (a little-endian uint32), followed by each result.
+Each result is the length of its header (uint32), the header (UTF-8 JSON), and then the raw bytes of each array
+described in the header's "arrays" (a list of `{ "name": ..., "dtype": ..., "shape": [...] }`).
+Headers are padded with spaces so that every array starts at a multiple of 8 bytes.
+'''
+
+COUNT = struct.Struct('<I')
+
+def dump_binary_result(header, arrays):
+    '''
+    Encodes one result in the binary format.
+
+    :param header: a dictionary of the JSON values of the result
+    :param arrays: a dictionary of the array values of the result (array names to NumPy arrays)
+    '''
+    arrays = { name: np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<')) for name, array in arrays.items() }
+    header = dict(header, arrays=[
+        { 'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape) }
+        for name, array in arrays.items()
+    ])
+    header = json.dumps(header).encode('utf-8')
+    # Pad so that the arrays are aligned
+    header += b' ' * (-(COUNT.size + len(header)) % 8)
+    return b''.join([COUNT.pack(len(header)), header] + [array.tobytes() for array in arrays.values()])
+
+def dump_binary_results(results):
+    '''
+    Encodes a list of encoded results (from `dump_binary_result`) in the binary format.
+    '''
+    return b''.join([COUNT.pack(len(results)), b'\0' * 4] + results)
+
+def load_binary_results(data):
+    '''
+    Decodes query results in the binary format into the same dictionary as a JSON response (`{ 'results': [...] }`).
+    Arrays are NumPy arrays that share the memory of `data` (so they are read-only).
+    '''
+    count, = COUNT.unpack_from(data, 0)
+    offset = 8
+    results = []
+    for _ in range(count):
+        length, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        result = json.loads(bytes(data[offset:offset + length]).decode('utf-8'))
+        offset += length
+        for array in result.pop('arrays'):
+            dtype = np.dtype(array['dtype'])
+            size = int(np.prod(array['shape'], dtype='int64'))
+            result[array['name']] = np.frombuffer(data, dtype=dtype, count=size, offset=offset).reshape(array['shape'])
+            offset += size * dtype.itemsize
+        results.append(result)
+    return { 'results': results }
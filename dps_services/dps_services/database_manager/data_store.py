@@ -1,6 +1,13 @@
+import json
+
+import numpy as np
+
 import dps_services.util as util
 
-from .query import load_query_json
+from .query import Query, Interval
+from .query import load_query_json, FORMAT_COLUMNAR, FORMAT_BINARY, FORMAT_ROWS
+from .binary import dump_binary_result, dump_binary_results
+from .downsample import make_downsampler
 from .delete import load_delete_json
 
 class DataStore:
@@ -12,6 +19,16 @@ class DataStore:
         return {
             'results': list(map(lambda x: x.to_dict(), results))
         }
+
+    @staticmethod
+    def to_columnar_results_response(results):
+        return {
+            'results': list(map(lambda x: x.to_columnar_dict(), results))
+        }
+
+    @staticmethod
+    def to_binary_results_response(results):
+        return dump_binary_results(list(map(lambda x: x.to_binary(), results)))
     
     @classmethod
     def insert(DataStoreClass, insert_request):
@@ -19,11 +36,38 @@ class DataStore:
         ds.execute_inserts(insert_request)
     
     @classmethod
-    def query(DataStoreClass, query_request):
+    def query(DataStoreClass, query_request, format=FORMAT_ROWS):
         ds = DataStoreClass()
         results = ds.execute_queries(load_query_json(query_request))
+        if format == FORMAT_COLUMNAR:
+            return DataStore.to_columnar_results_response(results)
+        if format == FORMAT_BINARY:
+            return DataStore.to_binary_results_response(results)
         return DataStore.to_results_response(results)
 
+    @classmethod
+    def stream_query(DataStoreClass, query_request, format=FORMAT_ROWS, chunk_size=10000):
+        '''
+        Returns a generator of the results of the queries as lines of JSON (one result per line).
+        Signal queries are sent in results of (at most) `chunk_size` rows (times), as they are read from the database.
+
+        The queries are validated before this returns (so that validation errors are not raised while streaming).
+        '''
+        ds = DataStoreClass()
+        queries = load_query_json(query_request)
+        def lines():
+            for query in queries:
+                if query.aggregation is None and not query.downsample:
+                    results = ds.stream_signals(query, chunk_size)
+                else:
+                    results = ds.execute_queries([query])
+                for result in results:
+                    if format == FORMAT_COLUMNAR:
+                        yield json.dumps(result.to_columnar_dict()) + '\n'
+                    else:
+                        yield json.dumps(result.to_dict()) + '\n'
+        return lines()
+
     @classmethod
     def delete(DataStoreClass, delete_request):
         ds = DataStoreClass()
@@ -50,6 +94,23 @@ class DataStore:
         ds.get_range(results, request['dataset'], request['signal'])
         return DataStore.to_results_response([results])
 
+    @classmethod
+    def execute_get_ranges(DataStoreClass, request):
+        '''
+        Gets the range of many signals at once. The request has a list of "ranges" (each with a "dataset" and a "signal"),
+        and there is a result for each of them (in the same order).
+        '''
+        ds = DataStoreClass()
+        with util.RequestValidator(request) as validator:
+            ranges = validator.require('ranges', list)
+            for i, signal_range in enumerate(ranges if isinstance(ranges, list) else []):
+                with validator.scope_list('ranges', i):
+                    validator.require('dataset', str, optional=True)
+                    validator.require('signal', str)
+        results = [GetRangeResult() for signal_range in ranges]
+        ds.get_ranges(results, [(signal_range.get('dataset'), signal_range['signal']) for signal_range in ranges])
+        return DataStore.to_results_response(results)
+
     @classmethod
     def execute_get_dataset_range(DataStoreClass, request):
         ds = DataStoreClass()
@@ -71,7 +132,16 @@ class DataStore:
         '''
         results = []
         for query in queries:
-            if query.aggregation is None:
+            if query.bucket:
+                result = BucketQueryResult(query)
+                self.aggregate_buckets(result, \
+                                       query.dataset, query.signals, \
+                                       query.interval, \
+                                       aggregation=query.aggregation, bucket=query.bucket)
+            elif query.downsample:
+                result = SignalQueryResult(query)
+                self.downsample_signals(result, query)
+            elif query.aggregation is None:
                 result = SignalQueryResult(query)
                 self.fetch_signals(result, \
                                    query.dataset, query.signals, \
@@ -91,9 +161,46 @@ class DataStore:
     def fetch_signals(self, result, dataset_name, signal_names, interval, limit):
         '''
         Writes the results of the query to the `SignalQueryResult` object (using `results.add(values, time)`)
+
+        If `result.query.paginate` is True, the results should start after the sample in the continuation token
+        `result.query.after` (if any), and `result.set_next(token)` should be called if there are more samples.
         '''
         raise Exception('DataStore.fetch_signals not implemented.')
 
+    def stream_signals(self, query, chunk_size):
+        '''
+        Yields `SignalQueryResult` objects with (at most) `chunk_size` rows (times) each.
+
+        By default, the whole query is fetched at once with `fetch_signals`. Data stores should
+        override this to read the samples in chunks (so that memory use doesn't depend on the size of the query).
+        '''
+        result = SignalQueryResult(query)
+        self.fetch_signals(result, query.dataset, query.signals, query.interval, query.limit)
+        yield result
+
+    def downsample_signals(self, result, query, chunk_size=100000):
+        '''
+        Writes (at most) `query.downsample` samples of each signal to the `SignalQueryResult` object,
+        chosen with `query.downsample_method`. The samples are read with `stream_signals`,
+        and are downsampled as they are read (so only `chunk_size` rows are in memory at once).
+        '''
+        start = util.datetime_to_epoch_ns(query.interval.start)
+        end = util.datetime_to_epoch_ns(query.interval.end)
+        downsamplers = [make_downsampler(query.downsample_method, start, end, query.downsample)
+                        for signal in query.signals]
+        for chunk in self.stream_signals(Query(query.dataset, query.signals, query.interval), chunk_size):
+            times, values = chunk.to_arrays()
+            for downsampler, signal_values in zip(downsamplers, values):
+                downsampler.add(times, signal_values)
+
+        # Each signal keeps different times, so signals are None at the times they weren't kept.
+        rows = {}
+        for i, downsampler in enumerate(downsamplers):
+            for time, value in zip(*downsampler.finish()):
+                rows.setdefault(time, [None] * len(query.signals))[i] = value
+        for time in sorted(rows):
+            result.add(rows[time], util.epoch_ns_to_datetime(time))
+
     def get_signal_names(self, result, dataset_name, query, limit, offset):
         '''
         Writes the results of the query to the `GetNamesResult` object (using `results.add(name)`)
@@ -112,6 +219,15 @@ class DataStore:
         '''
         raise Exception('DataStore.get_range not implemented.')
 
+    def get_ranges(self, results, signals):
+        '''
+        Writes the range of each signal (a list of (dataset name, signal name)) to each of the `GetRangeResult` objects.
+
+        By default, each signal's range is found with its own `get_range`.
+        '''
+        for result, (dataset_name, signal_name) in zip(results, signals):
+            self.get_range(result, dataset_name, signal_name)
+
     def get_dataset_range(self, result, dataset_name):
         '''
         Writes the results of the query to the `GetRangeResult` object (using `results.set_first(time)` and `results.set_last(time)`)
@@ -133,9 +249,26 @@ class DataStore:
     def aggregate_signals(self, result, dataset_name, signal_names, interval, aggregation):
         '''
         Writes the results of the query to the `AggregateQueryResult` object (using `results.set(signal_name, value)`)
+
+        If `aggregation` is a list of aggregations, the value of each signal is a list of the value of each aggregation.
         '''
         raise Exception('DataStore.aggregate_signals not implemented.')
 
+    def aggregate_buckets(self, result, dataset_name, signal_names, interval, aggregation, bucket):
+        '''
+        Writes the aggregation of each bucket (of `bucket` seconds, starting at `interval.start`)
+        to the `BucketQueryResult` object (using `results.add(values, bucket_start)`).
+
+        By default, each bucket is aggregated with its own `aggregate_signals`. Data stores should
+        override this to aggregate every bucket at once.
+        '''
+        for start, end in result.query.get_buckets():
+            bucket_result = AggregateQueryResult(Query(dataset_name, signal_names, Interval(start, end), aggregation))
+            self.aggregate_signals(bucket_result, dataset_name, signal_names, bucket_result.query.interval, aggregation)
+            values = list(bucket_result.results.values())
+            if any(value is not None for value in values):
+                result.add(values, start)
+
     def delete_dataset(self, dataset_name):
         '''
         Deletes a dataset, and all data that is associated with that dataset.
@@ -149,6 +282,7 @@ class SignalQueryResult:
         self.samples = []
         self.signals = query.signals
         self.previous_time = None
+        self.next = None
         
     def add(self, values, time, validate=True):
         if validate:
@@ -159,14 +293,65 @@ class SignalQueryResult:
         self.times.append(time)
         self.samples.append(values)
 
+    def set_next(self, token):
+        '''
+        Sets the continuation token of the next page (for paginated queries that have more data).
+        '''
+        self.next = token
+
+    def with_next(self, d):
+        if self.next is not None:
+            d['next'] = self.next
+        return d
+
     def to_dict(self):
-        return {
+        return self.with_next({
             'samples': self.samples,
             'times': list(map(lambda x: util.format_datetime(x), self.times)),
             'query': self.query.to_dict()
-        }
+        })
+
+    def to_columnar_dict(self):
+        '''
+        The results with one list of values for each signal (None when a signal has no sample at a time),
+        and the times as nanoseconds since 1970-01-01.
+        '''
+        if self.samples:
+            values = [list(column) for column in zip(*self.samples)]
+        else:
+            values = [[] for signal in self.signals]
+        return self.with_next({
+            'values': values,
+            'times': list(map(lambda x: util.datetime_to_epoch_ns(x), self.times)),
+            'query': self.query.to_dict()
+        })
+
+    def to_arrays(self):
+        '''
+        Returns the times (as an int64 array of nanoseconds since 1970-01-01), and the values
+        (as a float64 array with a row for each signal, and NaN when a signal has no sample at a time).
+        '''
+        times = np.array(list(map(lambda x: util.datetime_to_epoch_ns(x), self.times)), dtype='int64')
+        values = np.array(self.samples, dtype='float64').reshape(len(self.times), len(self.signals))
+        return times, np.ascontiguousarray(values.T)
+
+    def to_binary(self):
+        times, values = self.to_arrays()
+        return dump_binary_result(self.with_next({ 'query': self.query.to_dict() }), {
+            'values': values,
+            'times': times,
+        })
+
+class BucketQueryResult(SignalQueryResult):
+    '''
+    The results of a bucketed aggregation: the start time of each bucket (that has samples), and the aggregation of
+    each signal in that bucket. It is sent in the same formats as the samples of a `SignalQueryResult`.
+    '''
 
 class AggregateQueryResult:
+    '''
+    The value of each signal's aggregation (or a list of values, when the query has a list of aggregations).
+    '''
     def __init__(self, query):
         self.query = query
         self.results = { signal: 0 for signal in self.query.signals }
@@ -182,6 +367,12 @@ class AggregateQueryResult:
             'query': self.query.to_dict()
         }
 
+    def to_columnar_dict(self):
+        return self.to_dict()
+
+    def to_binary(self):
+        return dump_binary_result(self.to_dict(), {})
+
 class GetNamesResult:
     def __init__(self):
         self.results = []
@@ -203,6 +394,7 @@ class GetRangeResult:
     def __init__(self):
         self.first = None
         self.last = None        
+        self.count = None
 
     def set_first(self, first):
         self.first = first
@@ -210,6 +402,12 @@ class GetRangeResult:
     def set_last(self, last):
         self.last = last
 
+    def set_count(self, count):
+        '''
+        Sets the number of samples in the range (if the data store knows it without counting them).
+        '''
+        self.count = count
+
     def to_dict(self):
         first = self.first
         if first:
@@ -217,7 +415,10 @@ class GetRangeResult:
         last = self.last
         if last:
             last = util.format_datetime(last)
-        return {
+        d = {
             'first': first,
             'last': last,
         }
+        if self.count is not None:
+            d['count'] = self.count
+        return d
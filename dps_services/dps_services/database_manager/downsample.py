@@ -0,0 +1,148 @@
+import numpy as np
+
+DOWNSAMPLE_LTTB   = 'lttb'
+DOWNSAMPLE_MINMAX = 'minmax'
+DOWNSAMPLE_METHODS = [DOWNSAMPLE_LTTB, DOWNSAMPLE_MINMAX]
+
+class Downsampler:
+    '''
+    Downsamples one signal to at most `points` samples in one pass over its (time ordered) samples.
+
+    Samples are given in chunks (with `add`), and are put into buckets of equal time between `start` and `end`
+    (times are nanoseconds since 1970-01-01). Only the samples of the buckets which are not finished are kept,
+    so memory use doesn't depend on the number of samples.
+    '''
+    def __init__(self, start, end, points):
+        self.start = start
+        self.end = end
+        self.points = points
+        self.buckets = self.get_bucket_count(points)
+        self.current = None
+        self.current_index = None
+        self.times = []
+        self.values = []
+
+    def get_bucket_count(self, points):
+        return points
+
+    def get_bucket_indices(self, times):
+        width = max(self.end - self.start, 1)
+        indices = np.floor((times - self.start) / width * self.buckets).astype('int64')
+        return np.clip(indices, 0, self.buckets - 1)
+
+    def add(self, times, values):
+        '''
+        Adds a chunk of samples (an int64 array of times and a float64 array of values, where NaN means there is no sample).
+        '''
+        present = ~np.isnan(values)
+        times, values = times[present], values[present]
+        if len(times) == 0:
+            return
+        indices = self.get_bucket_indices(times)
+        splits = np.flatnonzero(np.diff(indices)) + 1
+        for ts, vs, index in zip(np.split(times, splits), np.split(values, splits), indices[np.r_[0, splits]]):
+            if index != self.current_index and self.current is not None:
+                self.close_bucket(*self.get_current())
+                self.current = None
+            if self.current is None:
+                self.current = []
+                self.current_index = index
+            self.current.append((ts, vs))
+
+    def get_current(self):
+        return np.concatenate([ts for ts, vs in self.current]), np.concatenate([vs for ts, vs in self.current])
+
+    def emit(self, time, value):
+        self.times.append(int(time))
+        self.values.append(float(value))
+
+    def close_bucket(self, times, values):
+        raise Exception('Downsampler.close_bucket not implemented.')
+
+    def finish(self):
+        '''
+        Finishes the last bucket. Returns the times and values of the downsampled samples.
+        '''
+        if self.current is not None:
+            self.close_bucket(*self.get_current())
+            self.current = None
+        return self.times, self.values
+
+class MinMaxDownsampler(Downsampler):
+    '''
+    Keeps the smallest and largest sample (in time order) of each bucket (so there are `points / 2` buckets).
+    Spikes are never lost, which is what a plot with one bucket per pixel needs.
+    '''
+    def get_bucket_count(self, points):
+        return max(points // 2, 1)
+
+    def close_bucket(self, times, values):
+        low, high = int(np.argmin(values)), int(np.argmax(values))
+        for i in sorted({ low, high }):
+            self.emit(times[i], values[i])
+
+class LTTBDownsampler(Downsampler):
+    '''
+    Largest-Triangle-Three-Buckets: the first and last samples are kept, and one sample is kept from each of the
+    `points - 2` buckets between them. The sample that is kept makes the largest triangle with the sample kept from
+    the previous bucket, and the average of the next bucket.
+
+    A bucket's sample can only be chosen once the next bucket is finished,
+    so there are (at most) two buckets in memory at a time.
+    '''
+    def __init__(self, start, end, points):
+        super().__init__(start, end, points)
+        self.selected = None
+        self.waiting = None
+
+    def get_bucket_count(self, points):
+        return max(points - 2, 1)
+
+    def add(self, times, values):
+        # The first sample is always kept (it isn't a part of any bucket).
+        if self.selected is None:
+            present = np.flatnonzero(~np.isnan(values))
+            if len(present) == 0:
+                return
+            first = present[0]
+            self.selected = (float(times[first]), float(values[first]))
+            self.emit(times[first], values[first])
+            times, values = times[first + 1:], values[first + 1:]
+        super().add(times, values)
+
+    def select(self, times, values, next_time, next_value):
+        previous_time, previous_value = self.selected
+        # Twice the area of the triangle of the previous selected sample, each sample, and the next point.
+        areas = np.abs((previous_time - next_time) * (values - previous_value) -
+                       (previous_time - times.astype('float64')) * (next_value - previous_value))
+        i = int(np.argmax(areas))
+        self.selected = (float(times[i]), float(values[i]))
+        self.emit(times[i], values[i])
+
+    def close_bucket(self, times, values):
+        if self.waiting is not None:
+            self.select(*self.waiting, float(np.mean(times)), float(np.mean(values)))
+        self.waiting = (times, values)
+
+    def finish(self):
+        # There is no current bucket only if there was at most one sample (which was already kept).
+        if self.current is None:
+            return self.times, self.values
+        # The last sample is always kept (it isn't a part of any bucket).
+        times, values = self.get_current()
+        self.current = None
+        if len(times) > 1:
+            self.close_bucket(times[:-1], values[:-1])
+        if self.waiting is not None:
+            self.select(*self.waiting, float(times[-1]), float(values[-1]))
+            self.waiting = None
+        self.emit(times[-1], values[-1])
+        return self.times, self.values
+
+DOWNSAMPLERS = {
+    DOWNSAMPLE_LTTB: LTTBDownsampler,
+    DOWNSAMPLE_MINMAX: MinMaxDownsampler,
+}
+
+def make_downsampler(method, start, end, points):
+    return DOWNSAMPLERS[method](start, end, points)
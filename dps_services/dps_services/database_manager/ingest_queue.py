@@ -0,0 +1,182 @@
+import sys
+import time
+import queue
+import threading
+import traceback
+
+from .insert import Insert
+
+class IngestQueue:
+    '''
+    Writes inserts behind the requests that made them (so that a slow database doesn't stall the clients).
+
+    Inserts are put on a bounded queue (of at most `max_size` insert requests), and `writers` threads take them off of it.
+    Each writer takes as many queued requests as it can (until it has `max_batch_size` samples), and merges the inserts
+    of the same signals of a dataset into one insert, so that they are written with one COPY.
+
+    Inserts that fail to be written are lost (they have already been acknowledged), so they should be validated
+    before they are queued (see `validate_inserts`). When a merged insert fails, its inserts are written again one at a time,
+    so that one bad insert doesn't lose the samples of the others. The number of failures, the number of samples
+    that were lost, and the last failure are kept in `stats`.
+    '''
+    def __init__(self, AppDataStore, max_size=1000, writers=2, max_batch_size=1000000):
+        self.AppDataStore = AppDataStore
+        self.max_size = max_size
+        self.max_batch_size = max_batch_size
+        self.queue = queue.Queue(maxsize=max_size)
+
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.flushed_samples = 0
+        self.last_flush_latency = None
+        self.max_flush_latency = None
+        self.errors = 0
+        self.dropped_samples = 0
+        self.last_error = None
+
+        self.writers = [threading.Thread(target=self.write, daemon=True) for _ in range(writers)]
+        for writer in self.writers:
+            writer.start()
+
+    def put(self, inserts):
+        '''
+        Queues a list of `Insert` objects (the inserts of one request).
+
+        :returns: False if the queue is full (and the inserts were not queued)
+        '''
+        try:
+            self.queue.put_nowait((time.perf_counter(), inserts))
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        '''
+        Waits until every queued insert has been written.
+        '''
+        self.queue.join()
+
+    def take(self):
+        '''
+        Takes the next queued requests off of the queue (waiting for at least one).
+
+        :returns: the time the oldest request was queued, and a list of the requests' inserts
+        '''
+        queued_at, inserts = self.queue.get()
+        requests = [inserts]
+        size = count_samples(inserts)
+        while size < self.max_batch_size:
+            try:
+                _, inserts = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            requests.append(inserts)
+            size += count_samples(inserts)
+        return queued_at, requests
+
+    def write(self):
+        while True:
+            queued_at, requests = self.take()
+            try:
+                try:
+                    self.flush(queued_at, [insert for inserts in requests for insert in inserts])
+                except Exception as e:
+                    # The inserts couldn't be grouped, so write each request on its own.
+                    self.log_error(e)
+                    for inserts in requests:
+                        try:
+                            self.flush(queued_at, inserts)
+                        except Exception as e:
+                            self.drop(e, inserts)
+            finally:
+                for _ in requests:
+                    self.queue.task_done()
+
+    def flush(self, queued_at, inserts):
+        '''
+        Writes the merged inserts of each group of `inserts` (see `group_inserts`) on their own.
+        If a merged insert fails, each of its inserts is written on its own, so that only the inserts that fail are lost.
+        '''
+        flushed_samples = 0
+        for group in group_inserts(inserts):
+            try:
+                self.AppDataStore.insert([merge_group(group)])
+                flushed_samples += count_samples(group)
+            except Exception as e:
+                if len(group) == 1:
+                    self.drop(e, group)
+                    continue
+                self.log_error(e)
+                for insert in group:
+                    try:
+                        self.AppDataStore.insert([insert])
+                        flushed_samples += count_samples([insert])
+                    except Exception as e:
+                        self.drop(e, [insert])
+        latency = time.perf_counter() - queued_at
+        with self.lock:
+            self.flushes += 1
+            self.flushed_samples += flushed_samples
+            self.last_flush_latency = latency
+            self.max_flush_latency = latency if self.max_flush_latency is None else max(self.max_flush_latency, latency)
+
+    def log_error(self, e):
+        print(''.join(traceback.format_exception(type(e), e, e.__traceback__)), file=sys.stderr)
+
+    def drop(self, e, inserts):
+        '''
+        Counts `inserts` as lost (because writing them raised `e`).
+        '''
+        self.log_error(e)
+        with self.lock:
+            self.errors += 1
+            self.dropped_samples += count_samples(inserts)
+            self.last_error = str(e)
+
+    def stats(self):
+        '''
+        The depth of the queue, and how long (in seconds, from being queued to being written) flushes take.
+        '''
+        with self.lock:
+            return {
+                'depth': self.queue.qsize(),
+                'max_size': self.max_size,
+                'writers': len(self.writers),
+                'flushes': self.flushes,
+                'flushed_samples': self.flushed_samples,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency,
+                'errors': self.errors,
+                'dropped_samples': self.dropped_samples,
+                'last_error': self.last_error,
+            }
+
+def count_samples(inserts):
+    return sum(len(insert.times or []) * len(insert.signals or []) for insert in inserts)
+
+def group_inserts(inserts):
+    '''
+    Groups inserts of the same signals of a dataset (that are all inserts, or all upserts), in the order they were queued in.
+    '''
+    groups = {}
+    for insert in inserts:
+        groups.setdefault((insert.dataset, tuple(insert.signals), insert.upsert), []).append(insert)
+    return list(groups.values())
+
+def merge_group(inserts):
+    '''
+    Merges a group of inserts (from `group_inserts`) into one insert.
+    The samples stay in the order they were queued in (so the last upsert of a sample wins).
+    '''
+    first = inserts[0]
+    merged = Insert(first.dataset, list(first.signals), [], [], upsert=first.upsert)
+    for insert in inserts:
+        merged.samples.extend(insert.samples)
+        merged.times.extend(insert.times)
+    return merged
+
+def merge_inserts(inserts):
+    '''
+    Merges inserts of the same signals of a dataset (that are all inserts, or all upserts) into one insert.
+    '''
+    return [merge_group(group) for group in group_inserts(inserts)]
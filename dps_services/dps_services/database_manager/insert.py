@@ -73,3 +73,29 @@ def load_insert_protobuf(insert_protobuf):
         times = [time.ToDatetime() for time in insert.times]
         inserts.append(Insert(insert.dataset, insert.signals, samples, times, upsert=insert.upsert))
     return inserts
+
+def validate_inserts(inserts):
+    '''
+    Checks that each insert has a dataset, signals, and a time for each batch of samples (with a sample for each signal),
+    so that inserts which are written later (see `IngestQueue`) are not acknowledged if they can't be written.
+    An insert with an empty list of signals (and no samples) only creates its dataset.
+
+    :raises util.ValidationException: if any insert is invalid
+    '''
+    errors = []
+    for i, insert in enumerate(inserts):
+        prefix = f'inserts[{i}].'
+        if not insert.dataset:
+            errors.append(f'Request is missing required parameter {util.quoted(prefix + "dataset")}.')
+        if insert.signals is None:
+            errors.append(f'Request is missing required parameter {util.quoted(prefix + "signals")}.')
+        samples = insert.samples or []
+        times = insert.times or []
+        if len(samples) != len(times):
+            errors.append(f'Expected a time for each batch of samples, but received {len(times)} times and {len(samples)} batches for {util.quoted(prefix + "samples")}.')
+        for j, batch in enumerate(samples):
+            if len(batch) != len(insert.signals or []):
+                errors.append(f'Expected {len(insert.signals or [])} samples (one for each signal) at index {j} for list {util.quoted(prefix + "samples")}, but received {len(batch)}.')
+                break
+    if errors:
+        raise util.ValidationException(errors)
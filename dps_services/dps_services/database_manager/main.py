@@ -4,7 +4,7 @@ from datetime import datetime
 
 import requests
 
-from flask import request, make_response, jsonify
+from flask import request, make_response, jsonify, Response, stream_with_context
 
 from expiringdict import ExpiringDict
 
@@ -14,6 +14,10 @@ import dps_client.insert_pb2 as insert_pb2
 from .data_store import DataStore
 from .insert import load_insert_protobuf
 from .insert import load_insert_json
+from .insert import validate_inserts
+from .ingest_queue import IngestQueue
+from .query import load_query_format, load_stream_options, FORMATS, FORMAT_BINARY
+from .binary import BINARY_CONTENT_TYPE
 
 def init_app(app, AppDataStore, debug=False):
     DPSMANURL  = os.getenv('DPS_MANAGER_URL', None)
@@ -22,6 +26,15 @@ def init_app(app, AppDataStore, debug=False):
     if DPSMANURL[-1] != '/':
         DPSMANURL += '/'
     
+    INSERT_QUEUE_SIZE = int(os.getenv('DPS_INSERT_QUEUE_SIZE', 0))
+    INSERT_QUEUE_WRITERS = int(os.getenv('DPS_INSERT_QUEUE_WRITERS', 2))
+    insert_queue = IngestQueue(AppDataStore, INSERT_QUEUE_SIZE, INSERT_QUEUE_WRITERS) if INSERT_QUEUE_SIZE > 0 else None
+    '''
+    If DPS_INSERT_QUEUE_SIZE is set, inserts are acknowledged as soon as they are validated and queued
+    (at most that many insert requests are queued, then inserts are refused with a 429 until the queue has room),
+    and they are written by DPS_INSERT_QUEUE_WRITERS threads.
+    '''
+
     auth_cache = ExpiringDict(max_len=1000, max_age_seconds=60 * 10)
     '''
     A cache of all logged in API keys. This allows an API key to work for 10 minutes after its last authentication with DPS Manager.
@@ -65,6 +78,16 @@ def init_app(app, AppDataStore, debug=False):
             o = load_insert_protobuf(insert_request)
         else: # Otherwise, assume JSON.
             o = load_insert_json(request.get_json())
+        if insert_queue is not None:
+            try:
+                validate_inserts(o)
+            except util.ValidationException as e:
+                return util.make_error_response(e, 400)
+            if not insert_queue.put(o):
+                resp = make_response(jsonify({ 'message': 'The insert queue is full. Try again later.' }), 429)
+                resp.headers['Retry-After'] = '1'
+                return resp
+            return make_response('{}')
         AppDataStore.insert(o)
         # return make_response({})
         return make_response('{}')
@@ -84,7 +107,22 @@ def init_app(app, AppDataStore, debug=False):
         ret = authenticate()
         if ret != True:
             return ret
-        return AppDataStore.query(jo)
+        format = load_query_format(jo, request.headers.get('Accept'))
+        if format == FORMAT_BINARY:
+            resp = make_response(AppDataStore.query(jo, format))
+            resp.headers['Content-Type'] = BINARY_CONTENT_TYPE
+            return resp
+        return AppDataStore.query(jo, format)
+
+    @app.route('/' + util.make_api_url('stream_query'), methods=['POST'])
+    @util.json_api
+    def stream_query(jo):
+        ret = authenticate()
+        if ret != True:
+            return ret
+        format, chunk_size = load_stream_options(jo, request.headers.get('Accept'))
+        lines = AppDataStore.stream_query(jo, format, chunk_size)
+        return Response(stream_with_context(lines), mimetype='application/x-ndjson')
 
     @app.route('/' + util.make_api_url('get_signal_names'), methods=['POST'])
     @util.json_api
@@ -118,6 +156,14 @@ def init_app(app, AppDataStore, debug=False):
             return ret
         return AppDataStore.execute_get_range(jo)
 
+    @app.route('/' + util.make_api_url('get_ranges'), methods=['POST'])
+    @util.json_api
+    def get_ranges(jo):
+        ret = authenticate()
+        if ret != True:
+            return ret
+        return AppDataStore.execute_get_ranges(jo)
+
     @app.route('/', methods=['GET'])
     def info():
         capabilities = []
@@ -126,23 +172,31 @@ def init_app(app, AppDataStore, debug=False):
             capabilities.append('delete_dataset')
         if AppDataStore.fetch_signals is not DataStore.fetch_signals:
             capabilities.append('fetch_signals')
+        if AppDataStore.stream_signals is not DataStore.stream_signals:
+            capabilities.append('stream_signals')
         if AppDataStore.get_signal_names is not DataStore.get_signal_names:
             capabilities.append('get_signal_names')
         if AppDataStore.get_dataset_names is not DataStore.get_dataset_names:
             capabilities.append('get_dataset_names')
         if AppDataStore.get_range is not DataStore.get_range:
             capabilities.append('get_range')
+        if AppDataStore.get_ranges is not DataStore.get_ranges:
+            capabilities.append('get_ranges')
         if AppDataStore.aggregate_signals is not DataStore.aggregate_signals:
             capabilities.append('aggregate_signals')
         if AppDataStore.insert_signals is not DataStore.insert_signals:
             capabilities.append('insert_signals')
         
-        return {
+        info = {
             'type': 'database-manager',
             'version': '1.0.0',
             'protocols': ['application/json', 'application/protobuf'],
+            'formats': FORMATS,
             'capabilities': capabilities,
             'debug': debug,
         }
+        if insert_queue is not None:
+            info['insert_queue'] = insert_queue.stats()
+        return info
 
     return app
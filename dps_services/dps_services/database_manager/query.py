@@ -1,14 +1,48 @@
 import json
+import base64
+import numbers
+from datetime import datetime, timedelta
 
 import dps_services.util as util
 
+from .binary import BINARY_CONTENT_TYPE
+from .downsample import DOWNSAMPLE_LTTB, DOWNSAMPLE_METHODS
+
+FORMAT_ROWS     = 'rows'
+FORMAT_COLUMNAR = 'columnar'
+FORMAT_BINARY   = 'binary'
+FORMATS         = [FORMAT_ROWS, FORMAT_COLUMNAR, FORMAT_BINARY]
+
+AGGREGATIONS = ['average', 'count', 'min', 'max']
+
+COLUMNAR_CONTENT_TYPE = 'application/vnd.dps.columnar+json'
+'''
+The content type a client can accept (in the Accept header) to receive query results in the columnar format.
+'''
+
 class Query:
-    def __init__(self, dataset, signals, interval, aggregation=None, limit=None):
+    def __init__(self, dataset, signals, interval, aggregation=None, limit=None, paginate=False, after=None, bucket=None,
+                 downsample=None, downsample_method=DOWNSAMPLE_LTTB):
+        '''
+        :param aggregation: the aggregation of each signal (or a list of aggregations, to get several at once)
+        :param bucket: the width of each bucket (in seconds) of a bucketed aggregation
+            (each bucket starts at a multiple of `bucket` after the start of the interval)
+        :param downsample: the most samples each signal should be downsampled to (for plotting)
+        :param downsample_method: how the samples are chosen ("lttb" or "minmax")
+        :param paginate: if the results should be split into pages of `limit` samples (with a continuation token
+            to get the next page, instead of restarting the query at the last time)
+        :param after: the continuation token of the previous page (implies `paginate`)
+        '''
         self.dataset = dataset
         self.signals = signals
         self.interval = interval
         self.aggregation = aggregation
         self.limit = limit
+        self.paginate = paginate or after is not None
+        self.after = after
+        self.bucket = bucket
+        self.downsample = downsample
+        self.downsample_method = downsample_method
 
     def __eq__(self, other):
         if isinstance(self, other.__class__):
@@ -16,11 +50,16 @@ class Query:
                    self.signals == other.signals and \
                    self.interval == other.interval and \
                    self.aggregation == other.aggregation and \
-                   self.limit == other.limit
+                   self.limit == other.limit and \
+                   self.paginate == other.paginate and \
+                   self.after == other.after and \
+                   self.bucket == other.bucket and \
+                   self.downsample == other.downsample and \
+                   self.downsample_method == other.downsample_method
         return False
 
     def __repr__(self):
-        return f'Query(dataset={self.dataset}, signals={self.signals}, interval={self.interval}, aggregation={self.aggregation}, limit={self.limit})'
+        return f'Query(dataset={self.dataset}, signals={self.signals}, interval={self.interval}, aggregation={self.aggregation}, limit={self.limit}, paginate={self.paginate}, after={self.after}, bucket={self.bucket}, downsample={self.downsample}, downsample_method={self.downsample_method})'
 
     def to_dict(self):
         d = {
@@ -33,8 +72,46 @@ class Query:
             d['limit'] = self.limit
         if self.interval:
             d['interval'] = self.interval.to_dict()
+        if self.paginate:
+            d['paginate'] = True
+        if self.after:
+            d['after'] = self.after
+        if self.bucket:
+            d['bucket'] = self.bucket
+        if self.downsample:
+            d['downsample'] = self.downsample
+            d['downsample_method'] = self.downsample_method
         return d
-            
+
+    def get_buckets(self):
+        '''
+        Returns the (start, end) of each bucket of a bucketed aggregation.
+        '''
+        width = timedelta(seconds=self.bucket)
+        start = self.interval.start
+        buckets = []
+        while start < self.interval.end:
+            buckets.append((start, start + width))
+            start += width
+        return buckets
+
+def dump_continuation_token(time, signal_id):
+    '''
+    Creates the (opaque) token that identifies the last sample of a page (by its time and signal ID).
+    '''
+    token = json.dumps([time.isoformat(), signal_id])
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+def load_continuation_token(token):
+    '''
+    Returns the time and signal ID of the last sample of the previous page (or None, if the token is invalid).
+    '''
+    try:
+        time, signal_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return datetime.fromisoformat(time), int(signal_id)
+    except (ValueError, TypeError):
+        return None
+
 class Interval:
     def __init__(self, start, end):
         self.start = start
@@ -84,7 +161,67 @@ def load_query_json(query_json):
                         interval_start = validator.require('start', datetime_format_string=util.DATETIME_FORMAT_STRING)
                         interval_end = validator.require('end', datetime_format_string=util.DATETIME_FORMAT_STRING)
                         interval = Interval(interval_start, interval_end)
-                aggregation = validator.require('aggregation', str, optional=True,
-                                                one_of=['average', 'count', 'min', 'max'])
-            queries.append(Query(dataset, signals, interval, aggregation, limit))
+                aggregation = validator.require('aggregation', optional=True)
+                if isinstance(aggregation, list):
+                    if not aggregation:
+                        validator.errors.append(f'Expected parameter "queries[{i}].aggregation" to have at least one aggregation, but was [].')
+                    for j, item in enumerate(aggregation):
+                        validator.validate(item, f'aggregation[{j}]', str, one_of=AGGREGATIONS)
+                else:
+                    validator.validate(aggregation, 'aggregation', str, optional=True, one_of=AGGREGATIONS)
+                paginate = validator.require('paginate', bool, optional=True)
+                after = validator.require('after', str, optional=True)
+                if after and load_continuation_token(after) is None:
+                    validator.errors.append(f'Invalid continuation token {util.quoted(after)} for parameter "queries[{i}].after".')
+                bucket = validator.require('bucket', optional=True)
+                if bucket is not None:
+                    if not isinstance(bucket, numbers.Real) or isinstance(bucket, bool) or bucket <= 0:
+                        validator.errors.append(f'Expected parameter "queries[{i}].bucket" to be a positive number of seconds, but was {util.quoted(bucket)}.')
+                    elif not isinstance(aggregation, str) or not interval:
+                        validator.errors.append(f'Bucketed query "queries[{i}]" must have an "aggregation" and an "interval".')
+                downsample = validator.require('downsample', int, optional=True)
+                downsample_method = validator.require('downsample_method', str, optional=True,
+                                                      one_of=DOWNSAMPLE_METHODS) or DOWNSAMPLE_LTTB
+                if downsample:
+                    if isinstance(downsample, int) and downsample < 3:
+                        validator.errors.append(f'Expected parameter "queries[{i}].downsample" to be at least 3, but was {util.quoted(downsample)}.')
+                    if aggregation or not interval:
+                        validator.errors.append(f'Downsampled query "queries[{i}]" must have an "interval" and no "aggregation".')
+            queries.append(Query(dataset, signals, interval, aggregation, limit, bool(paginate), after, bucket,
+                                 downsample, downsample_method))
         return queries
+
+def load_query_format(query_json, accept=None):
+    '''
+    Gets the format the results of a query request should be sent in ("rows", "columnar", or "binary").
+
+    The binary format is negotiated with the Accept header, so that clients can ask for "columnar" in the request
+    (which older servers understand) and get the binary format from servers that can send it.
+
+    :params query_json: the dictionary containing the request (which may have a "format")
+    :params accept: the Accept header of the request (used when the request has no "format", or asks for "columnar")
+    '''
+    with util.RequestValidator(query_json) as validator:
+        format = validator.require('format', str, optional=True, one_of=FORMATS)
+    if format and format != FORMAT_COLUMNAR:
+        return format
+    if accept and BINARY_CONTENT_TYPE in accept:
+        return FORMAT_BINARY
+    if format or (accept and COLUMNAR_CONTENT_TYPE in accept):
+        return FORMAT_COLUMNAR
+    return FORMAT_ROWS
+
+def load_stream_options(query_json, accept=None):
+    '''
+    Gets the format (either "rows" or "columnar") and the chunk size (the number of rows, or times, in each result)
+    of a streaming query request.
+    '''
+    format = load_query_format(query_json, accept)
+    with util.RequestValidator(query_json) as validator:
+        if format == FORMAT_BINARY:
+            validator.errors.append('Streaming queries can only be sent in the "rows" or "columnar" format.')
+        chunk_size = validator.require('chunk_size', optional=True)
+        if chunk_size is not None:
+            if not isinstance(chunk_size, int) or isinstance(chunk_size, bool) or chunk_size <= 0:
+                validator.errors.append(f'Expected parameter "chunk_size" to be a positive number of rows, but was {util.quoted(chunk_size)}.')
+    return format, 10000 if chunk_size is None else chunk_size
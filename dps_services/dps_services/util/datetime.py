@@ -1,4 +1,6 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
 
 DATETIME_FORMAT_STRING = '%Y-%m-%d %H:%M:%S.%f'
 '''
@@ -13,6 +15,20 @@ def parse_datetime(datetime_string):
 def format_datetime(datetime_object):
     return datetime.strftime(datetime_object, DATETIME_FORMAT_STRING)
 
+def datetime_to_epoch_ns(datetime_object):
+    '''
+    Returns the number of nanoseconds since 1970-01-01 (as an int).
+    Like `format_datetime`, the timezone of `datetime_object` (if any) is ignored.
+    '''
+    delta = datetime_object.replace(tzinfo=None) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+def epoch_ns_to_datetime(ns):
+    '''
+    Returns the (naive) datetime that is `ns` nanoseconds after 1970-01-01 (nanoseconds are truncated to microseconds).
+    '''
+    return EPOCH + timedelta(microseconds=int(ns) // 1000)
+
 def validate_datetime(datetime_string, datetime_format_string=DATETIME_FORMAT_STRING):
     try:
         return datetime.strptime(datetime_string, datetime_format_string)
@@ -1,6 +1,10 @@
+import json
+import threading
 from unittest import TestCase
 from datetime import datetime, timedelta
 
+import numpy as np
+
 import dps_services.database_manager as dbm
 import dps_services.util as util
 
@@ -190,6 +194,176 @@ class TestDatabaseManager(TestCase):
                          dbm.Interval(datetime1, datetime2),
                          aggregation='max')])
 
+    def test_parse_query_pagination_jsons(self):
+        token = dbm.dump_continuation_token(datetime3, 12)
+        self.assertEqual(dbm.load_continuation_token(token), (datetime3, 12))
+        self.assertEqual(dbm.load_continuation_token('not a token'), None)
+
+        self.assertEqual(dbm.parse_query_json(json.dumps({
+            'queries': [
+                { 'dataset': 'somename', 'signals': ['va'], 'limit': 10, 'paginate': True },
+                { 'dataset': 'somename', 'signals': ['va'], 'limit': 10, 'after': token },
+            ]
+        })), [dbm.Query('somename', ['va'], None, limit=10, paginate=True),
+              dbm.Query('somename', ['va'], None, limit=10, paginate=True, after=token)])
+
+        with self.assertRaisesRegex(util.ValidationException, 'Invalid continuation token "nope" for parameter "queries\\[0\\].after".'):
+            dbm.parse_query_json(json.dumps({
+                'queries': [{ 'dataset': 'somename', 'signals': ['va'], 'after': 'nope' }]
+            }))
+
+    def test_data_store_paginated_results(self):
+        query = dbm.Query('somename', ['va', 'vb'], None, limit=2, paginate=True)
+        result = dbm.SignalQueryResult(query)
+        result.add([1, 2], datetime3)
+        self.assertNotIn('next', result.to_dict())
+
+        token = dbm.dump_continuation_token(datetime3, 2)
+        result.set_next(token)
+        self.assertEqual(result.to_dict()['next'], token)
+        self.assertEqual(result.to_dict()['query']['paginate'], True)
+        self.assertEqual(result.to_columnar_dict()['next'], token)
+        binary = dbm.load_binary_results(dbm.DataStore.to_binary_results_response([result]))
+        self.assertEqual(binary['results'][0]['next'], token)
+
+    def test_parse_query_bucket_jsons(self):
+        self.assertEqual(dbm.parse_query_json(json.dumps({
+            'queries': [{
+                'dataset': 'somename',
+                'signals': ['va', 'vb'],
+                'interval': { 'start': datetime_string3, 'end': datetime_string4 },
+                'aggregation': 'max',
+                'bucket': 60,
+            }]
+        })), [dbm.Query('somename', ['va', 'vb'], dbm.Interval(datetime3, datetime4), 'max', bucket=60)])
+
+        with self.assertRaisesRegex(util.ValidationException, 'Bucketed query "queries\\[0\\]" must have an "aggregation" and an "interval".'):
+            dbm.parse_query_json(json.dumps({
+                'queries': [{ 'dataset': 'somename', 'signals': ['va'], 'bucket': 60 }]
+            }))
+        with self.assertRaisesRegex(util.ValidationException, 'Expected parameter "queries\\[0\\].bucket" to be a positive number of seconds, but was "-1".'):
+            dbm.parse_query_json(json.dumps({
+                'queries': [{ 'dataset': 'somename', 'signals': ['va'], 'aggregation': 'max', 'bucket': -1 }]
+            }))
+
+    def test_data_store_bucket_query_results(self):
+        query = dbm.Query('somename', ['va', 'vb'], dbm.Interval(datetime3, datetime3 + timedelta(seconds=25)), 'max', bucket=10)
+        self.assertEqual(query.get_buckets(), [
+            (datetime3, datetime3 + timedelta(seconds=10)),
+            (datetime3 + timedelta(seconds=10), datetime3 + timedelta(seconds=20)),
+            (datetime3 + timedelta(seconds=20), datetime3 + timedelta(seconds=30)),
+        ])
+
+        # MockDataStore doesn't implement aggregate_buckets, so each bucket is aggregated on its own.
+        result, = MockDataStore().execute_queries([query])
+        self.assertIsInstance(result, dbm.BucketQueryResult)
+        self.assertEqual(result.to_dict(), {
+            'samples': [[0, 1], [0, 1], [0, 1]],
+            'times': [util.format_datetime(start) for start, end in query.get_buckets()],
+            'query': {
+                'dataset': 'somename',
+                'signals': ['va', 'vb'],
+                'aggregation': 'max',
+                'bucket': 10,
+                'interval': query.interval.to_dict(),
+            },
+        })
+
+    def test_downsamplers(self):
+        times = np.arange(1000, dtype='int64')
+        values = np.sin(times / 50) + (times == 500) * 10
+        for chunk_size in [1, 7, 1000]:
+            lttb = dbm.LTTBDownsampler(0, 999, 20)
+            minmax = dbm.MinMaxDownsampler(0, 999, 20)
+            for i in range(0, len(times), chunk_size):
+                lttb.add(times[i:i + chunk_size], values[i:i + chunk_size])
+                minmax.add(times[i:i + chunk_size], values[i:i + chunk_size])
+            lttb_times, lttb_values = lttb.finish()
+            minmax_times, minmax_values = minmax.finish()
+
+            self.assertEqual(len(lttb_times), 20)
+            self.assertEqual((lttb_times[0], lttb_times[-1]), (0, 999))
+            self.assertIn(500, lttb_times) # The spike is always kept
+            self.assertEqual(lttb_times, sorted(lttb_times))
+
+            self.assertLessEqual(len(minmax_times), 20)
+            self.assertIn(500, minmax_times)
+            self.assertEqual(min(minmax_values), values.min())
+            self.assertEqual(minmax_times, sorted(minmax_times))
+
+    def test_data_store_downsample_query_results(self):
+        class StreamingDataStore(MockDataStore):
+            def stream_signals(self, query, chunk_size):
+                for i in range(0, 100, 30):
+                    result = dbm.SignalQueryResult(query)
+                    for j in range(i, min(i + 30, 100)):
+                        result.add([float(j), None if j % 2 else float(-j)], query.interval.start + timedelta(seconds=j))
+                    yield result
+
+        query, = dbm.parse_query_json(json.dumps({
+            'queries': [{
+                'dataset': 'somename',
+                'signals': ['va', 'vb'],
+                'interval': { 'start': datetime_string3, 'end': util.format_datetime(datetime3 + timedelta(seconds=99)) },
+                'downsample': 10,
+            }]
+        }))
+        self.assertEqual(query.downsample_method, dbm.DOWNSAMPLE_LTTB)
+        result, = StreamingDataStore().execute_queries([query])
+        va = [row[0] for row in result.samples if row[0] is not None]
+        vb = [row[1] for row in result.samples if row[1] is not None]
+        self.assertEqual(len(va), 10)
+        self.assertEqual(len(vb), 10)
+        self.assertEqual((va[0], va[-1]), (0.0, 99.0))
+        self.assertEqual((vb[0], vb[-1]), (0.0, -98.0))
+        self.assertEqual(result.times, sorted(result.times))
+
+        with self.assertRaisesRegex(util.ValidationException, 'Downsampled query "queries\\[0\\]" must have an "interval" and no "aggregation".'):
+            dbm.parse_query_json(json.dumps({
+                'queries': [{ 'dataset': 'somename', 'signals': ['va'], 'downsample': 10 }]
+            }))
+
+    def test_parse_query_multiple_aggregations_jsons(self):
+        query, = dbm.parse_query_json(json.dumps({
+            'queries': [{ 'dataset': 'somename', 'signals': ['va', 'vb'], 'aggregation': ['count', 'min', 'max', 'average'] }]
+        }))
+        self.assertEqual(query, dbm.Query('somename', ['va', 'vb'], None, ['count', 'min', 'max', 'average']))
+
+        result = dbm.AggregateQueryResult(query)
+        result.set('va', [3, 1.0, 2.0, 1.5])
+        result.set('vb', [0, None, None, None])
+        self.assertEqual(result.to_dict()['values'], [[3, 1.0, 2.0, 1.5], [0, None, None, None]])
+        self.assertEqual(result.to_dict()['query']['aggregation'], ['count', 'min', 'max', 'average'])
+
+        with self.assertRaisesRegex(util.ValidationException, 'Expected parameter "queries\\[0\\].aggregation\\[1\\]" to be either "average", "count", "min" or "max", but was "median".'):
+            dbm.parse_query_json(json.dumps({
+                'queries': [{ 'dataset': 'somename', 'signals': ['va'], 'aggregation': ['count', 'median'] }]
+            }))
+        with self.assertRaisesRegex(util.ValidationException, 'Expected parameter "queries\\[0\\].aggregation" to have at least one aggregation, but was \\[\\].'):
+            dbm.parse_query_json(json.dumps({
+                'queries': [{ 'dataset': 'somename', 'signals': ['va'], 'aggregation': [] }]
+            }))
+
+    def test_data_store_get_ranges(self):
+        class RangeDataStore(MockDataStore):
+            def get_range(self, result, dataset, signal):
+                if signal == 'va':
+                    result.set_first(datetime1)
+                    result.set_last(datetime2)
+                    result.set_count(10)
+
+        self.assertEqual(RangeDataStore.execute_get_ranges({
+            'ranges': [{ 'dataset': 'somename', 'signal': 'va' }, { 'dataset': 'somename', 'signal': 'vb' }],
+        }), {
+            'results': [
+                { 'first': datetime_string1, 'last': datetime_string2, 'count': 10 },
+                { 'first': None, 'last': None },
+            ]
+        })
+
+        with self.assertRaisesRegex(util.ValidationException, 'Request is missing required parameter "ranges\\[0\\].signal".'):
+            RangeDataStore.execute_get_ranges({ 'ranges': [{ 'dataset': 'somename' }] })
+
     def test_parse_insert_jsons(self):
         self.assertEqual(dbm.parse_insert_json(f'''
 {{
@@ -299,6 +473,90 @@ class TestDatabaseManager(TestCase):
         ds.execute_inserts(inserts)
         self.assertEqual(inserts, ds.inserts)
 
+    def test_ingest_queue(self):
+        written = []
+        class QueuedDataStore(dbm.DataStore):
+            def insert_signals(self, dataset, signals, samples, times, upsert):
+                written.append(dbm.Insert(dataset, signals, samples, times, upsert))
+
+        inserts = [dbm.Insert('name1', ['s1', 's2'], [[1,2], [3,4]], [datetime1, datetime2]),
+                   dbm.Insert('name2', ['ab'], [[5]], [datetime3]),
+                   dbm.Insert('name1', ['s1', 's2'], [[5,6]], [datetime3]),
+                   dbm.Insert('name1', ['s1', 's2'], [[7,8]], [datetime4], upsert=True)]
+        self.assertEqual(dbm.merge_inserts(inserts), [
+            dbm.Insert('name1', ['s1', 's2'], [[1,2], [3,4], [5,6]], [datetime1, datetime2, datetime3]),
+            dbm.Insert('name2', ['ab'], [[5]], [datetime3]),
+            dbm.Insert('name1', ['s1', 's2'], [[7,8]], [datetime4], upsert=True),
+        ])
+
+        queue = dbm.IngestQueue(QueuedDataStore, max_size=10, writers=1)
+        self.assertTrue(queue.put(inserts[:2]))
+        self.assertTrue(queue.put(inserts[2:]))
+        queue.join()
+        self.assertEqual(sum(len(insert.times) for insert in written), 5)
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['flushed_samples'], 9)
+        self.assertEqual(stats['errors'], 0)
+
+        # Inserts are refused when the queue is full (while the writer is busy).
+        started, done = threading.Event(), threading.Event()
+        class SlowDataStore(QueuedDataStore):
+            def insert_signals(self, *args):
+                started.set()
+                done.wait()
+        queue = dbm.IngestQueue(SlowDataStore, max_size=1, writers=1)
+        self.assertTrue(queue.put(inserts[:1]))
+        started.wait()
+        self.assertTrue(queue.put(inserts[1:2]))
+        self.assertFalse(queue.put(inserts[2:3]))
+        self.assertEqual(queue.stats()['depth'], 1)
+        done.set()
+        queue.join()
+        self.assertEqual(queue.stats()['flushes'], 2)
+
+        # When a merged insert fails, only the inserts that fail on their own are lost.
+        class FailingDataStore(QueuedDataStore):
+            def insert_signals(self, dataset, signals, samples, times, upsert):
+                if [-1, -1] in samples:
+                    raise Exception('Invalid samples.')
+                super().insert_signals(dataset, signals, samples, times, upsert)
+        written.clear()
+        queue = dbm.IngestQueue(FailingDataStore, max_size=10, writers=1)
+        queue.flush(0, [inserts[0], dbm.Insert('name1', ['s1', 's2'], [[-1,-1]], [datetime5]), inserts[2]])
+        self.assertEqual(written, inserts[0:1] + inserts[2:3])
+        stats = queue.stats()
+        self.assertEqual(stats['flushed_samples'], 6)
+        self.assertEqual(stats['dropped_samples'], 2)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['last_error'], 'Invalid samples.')
+
+        # Inserts that can't be merged are lost (without stopping the writer, or losing the other requests).
+        written.clear()
+        self.assertTrue(queue.put([dbm.Insert('name1', None, [[1]], [datetime1])]))
+        self.assertTrue(queue.put(inserts[1:2]))
+        queue.join()
+        self.assertEqual(written, inserts[1:2])
+        self.assertEqual(queue.stats()['errors'], 2)
+
+        with self.assertRaises(util.ValidationException):
+            dbm.validate_inserts([dbm.Insert('name1', ['s1', 's2'], [[1,2], [3]], [datetime1, datetime2])])
+        with self.assertRaises(util.ValidationException):
+            dbm.validate_inserts([dbm.Insert('name1', ['s1'], [[1]], [])])
+        dbm.validate_inserts(inserts)
+
+        # An insert of no signals only creates its dataset.
+        empty_dataset = [dbm.Insert('name3', [], [], [])]
+        dbm.validate_inserts(empty_dataset)
+        with self.assertRaises(util.ValidationException):
+            dbm.validate_inserts([dbm.Insert('name3', [], [[1]], [datetime1])])
+        written.clear()
+        queue = dbm.IngestQueue(QueuedDataStore, max_size=10, writers=1)
+        self.assertTrue(queue.put(empty_dataset))
+        queue.join()
+        self.assertEqual(written, empty_dataset)
+        self.assertEqual(queue.stats()['errors'], 0)
+
     def test_data_store_signal_query_results(self):
         query = dbm.Query('name1', ['s1', 's2', 'sb'], dbm.Interval(datetime2, datetime4))
         result = dbm.SignalQueryResult(query)
@@ -353,6 +611,107 @@ class TestDatabaseManager(TestCase):
             result.add([1, 2, 3], datetime4)
             result.add([94, 83, 12], datetime2)
 
+    def test_data_store_signal_query_columnar_results(self):
+        query = dbm.Query('name1', ['s1', 's2', 'sb'], dbm.Interval(datetime2, datetime4))
+        result = dbm.SignalQueryResult(query)
+        result.add([1, None, 3], datetime3)
+        result.add([8, 9, 6], datetime4)
+        self.assertEqual(result.to_columnar_dict(), {
+            'values': [[1, 8], [None, 9], [3, 6]],
+            'times': [1696600802002000000, 1696604532000392000],
+            'query': query.to_dict(),
+        })
+
+        # No results
+        result = dbm.SignalQueryResult(query)
+        self.assertEqual(result.to_columnar_dict(), {
+            'values': [[], [], []],
+            'times': [],
+            'query': query.to_dict(),
+        })
+
+    def test_data_store_binary_results(self):
+        query = dbm.Query('name1', ['s1', 's2', 'sb'], dbm.Interval(datetime2, datetime4))
+        result = dbm.SignalQueryResult(query)
+        result.add([1, None, 3], datetime3)
+        result.add([8, 9, 6], datetime4)
+        aggregate_query = dbm.Query('name1', ['s1', 's2'], dbm.Interval(datetime2, datetime4), 'max')
+        aggregate_result = dbm.AggregateQueryResult(aggregate_query)
+        aggregate_result.set('s1', 4.5)
+
+        response = dbm.load_binary_results(dbm.DataStore.to_binary_results_response([result, aggregate_result]))
+        signal_result, aggregate_result = response['results']
+        self.assertEqual(signal_result['query'], query.to_dict())
+        self.assertEqual(signal_result['times'].dtype, np.int64)
+        self.assertEqual(signal_result['times'].tolist(), [1696600802002000000, 1696604532000392000])
+        self.assertEqual(signal_result['values'].dtype, np.float64)
+        np.testing.assert_array_equal(signal_result['values'], [[1, 8], [np.nan, 9], [3, 6]])
+        self.assertEqual(aggregate_result, {
+            'values': [4.5, 0],
+            'query': aggregate_query.to_dict(),
+        })
+
+        # No results
+        response = dbm.load_binary_results(dbm.DataStore.to_binary_results_response([dbm.SignalQueryResult(query)]))
+        self.assertEqual(response['results'][0]['values'].shape, (3, 0))
+        self.assertEqual(response['results'][0]['times'].shape, (0,))
+
+    def test_data_store_stream_query(self):
+        class ChunkedDataStore(dbm.DataStore):
+            def stream_signals(self, query, chunk_size):
+                for i in range(0, 5, chunk_size):
+                    result = dbm.SignalQueryResult(query)
+                    for j in range(i, min(i + chunk_size, 5)):
+                        result.add([j], query.interval.start + timedelta(seconds=j))
+                    yield result
+
+            def aggregate_signals(self, result, dataset, signals, interval, aggregation):
+                result.set(signals[0], 4)
+
+        query_json = {
+            'queries': [
+                {
+                    'dataset': 'somename',
+                    'signals': ['va'],
+                    'interval': {
+                        'start': datetime_string3,
+                        'end': datetime_string4
+                    },
+                },
+                {
+                    'dataset': 'somename',
+                    'signals': ['va'],
+                    'interval': {
+                        'start': datetime_string3,
+                        'end': datetime_string4
+                    },
+                    'aggregation': 'max'
+                },
+            ],
+        }
+        format, chunk_size = dbm.load_stream_options(dict(query_json, format='columnar', chunk_size=2))
+        lines = list(ChunkedDataStore.stream_query(query_json, format, chunk_size))
+        self.assertEqual([json.loads(line)['values'] for line in lines], [[[0, 1]], [[2, 3]], [[4]], [4]])
+        self.assertTrue(all(line.endswith('\n') for line in lines))
+
+        with self.assertRaisesRegex(util.ValidationException, 'Streaming queries can only be sent in the "rows" or "columnar" format.'):
+            dbm.load_stream_options(dict(query_json, format='binary'))
+        self.assertEqual(dbm.load_stream_options(query_json), (dbm.FORMAT_ROWS, 10000))
+        for chunk_size in [0, -1, 2.5, True]:
+            with self.assertRaisesRegex(util.ValidationException, 'Expected parameter "chunk_size" to be a positive number of rows'):
+                dbm.load_stream_options(dict(query_json, chunk_size=chunk_size))
+
+    def test_load_query_format(self):
+        self.assertEqual(dbm.load_query_format({}), dbm.FORMAT_ROWS)
+        self.assertEqual(dbm.load_query_format({ 'format': 'columnar' }), dbm.FORMAT_COLUMNAR)
+        self.assertEqual(dbm.load_query_format({}, dbm.COLUMNAR_CONTENT_TYPE), dbm.FORMAT_COLUMNAR)
+        self.assertEqual(dbm.load_query_format({ 'format': 'rows' }, dbm.COLUMNAR_CONTENT_TYPE), dbm.FORMAT_ROWS)
+        self.assertEqual(dbm.load_query_format({}, dbm.BINARY_CONTENT_TYPE), dbm.FORMAT_BINARY)
+        self.assertEqual(dbm.load_query_format({ 'format': 'columnar' }, dbm.BINARY_CONTENT_TYPE + ', application/json'), dbm.FORMAT_BINARY)
+        self.assertEqual(dbm.load_query_format({ 'format': 'rows' }, dbm.BINARY_CONTENT_TYPE), dbm.FORMAT_ROWS)
+        with self.assertRaisesRegex(util.ValidationException, 'Expected parameter "format" to be either "rows", "columnar" or "binary", but was "other".'):
+            dbm.load_query_format({ 'format': 'other' })
+
     def test_data_store_aggregate_query_results(self):
         query = dbm.Query('sampleag', ['AGGG8', 'AG9'], dbm.Interval(datetime2, datetime4), 'max')
         result = dbm.AggregateQueryResult(query)